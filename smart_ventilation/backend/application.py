@@ -1,7 +1,8 @@
 import base64
-from flask_apscheduler import APScheduler
 from flask import (
+    Blueprint,
     Flask,
+    Response,
     jsonify,
     make_response,
     render_template,
@@ -9,59 +10,72 @@ from flask import (
     session,
 )
 import logging
-import requests
 from datetime import datetime, timedelta
-from mqtt_client import (MQTTClient)
-from config.api_config_loader import load_api_config
+from werkzeug.local import LocalProxy
+from mqtt_client import get_mqtt_client
 import numpy as np
 import redis
 import os
 import time
 from helpers.mqtt_data import get_data
+from helpers.metrics import registry, render
+from helpers import plot_data
+from database.history import HistoryBusyError, stream_history
+from database.export import ExportBusyError, export_table
+from database.prediction_history import fetch_prediction_history
+from helpers.startup import startup_timer
 
 logging.basicConfig(level=logging.INFO)
 base_dir = os.path.abspath(os.path.dirname(__file__))
 frontend_dir = os.path.join(base_dir, "..", "frontend")
 
-app = Flask(
-    __name__,
-    template_folder=os.path.join(frontend_dir, "templates"),
-    static_folder=os.path.join(frontend_dir, "static"),
-)
-
-app.config["SECRET_KEY"] = os.environ.get("FLASK_SECRET_KEY", "default_secret_key")
-app.config["SESSION_TYPE"] = "redis"
-app.config["SESSION_REDIS"] = redis.from_url(
-    os.environ.get("REDIS_URL", "redis://localhost:6379")
-)
-
-config_file_path = "config/api_config.yaml"
+views = Blueprint("views", __name__)
 
-api_config = load_api_config(config_file_path)
+# the client is created by the first request that uses it (or by
+# init_services), so importing this module or booting a worker opens no
+# connections
+mqtt_client = LocalProxy(get_mqtt_client)
 
-READ_API_KEY = api_config["READ_API_KEY"]
-POST_API_KEY = api_config["POST_API_KEY"]
-API_BASE_URL = api_config["API_BASE_URL"]
-CONTENT_TYPE = api_config["CONTENT_TYPE"]
 
-mqtt_client = MQTTClient()
-mqtt_client.initialize()
+def create_app(config=None):
+    app = Flask(
+        __name__,
+        template_folder=os.path.join(frontend_dir, "templates"),
+        static_folder=os.path.join(frontend_dir, "static"),
+    )
 
+    app.config["SECRET_KEY"] = os.environ.get("FLASK_SECRET_KEY", "default_secret_key")
+    app.config["SESSION_TYPE"] = "redis"
+    # from_url does not connect until the first command
+    app.config["SESSION_REDIS"] = redis.from_url(
+        os.environ.get("REDIS_URL", "redis://localhost:6379")
+    )
+    if config:
+        app.config.update(config)
 
-class Config:
-    SCHEDULER_API_ENABLED = True
+    app.register_blueprint(views)
+    return app
 
 
-app.config.from_object(Config())
-scheduler = APScheduler()
-scheduler.init_app(app)
-scheduler.start()
+def init_services(app):
+    # initializes config, database, MQTT and models up front instead of on
+    # the first request, then logs how long each phase took
+    client = get_mqtt_client()
+    for model in getattr(client, "models", {}).values():
+        if hasattr(model, "load"):
+            try:
+                model.load()
+            except Exception as e:
+                logging.error("init_services: error loading a model %s", e)
+    return startup_timer.report()
 
 
-@app.route("/", methods=["GET", "POST"])
+@views.route("/", methods=["GET", "POST"])
 def index():
+    classroom = request.args.get("classroom", mqtt_client.default_classroom)
     try:
-        if not hasattr(mqtt_client, "combined_data") or not mqtt_client.combined_data:
+        combined_data = mqtt_client.get_classroom(classroom).combined_data()
+        if not combined_data:
             sensor_data = {}
             temperature = 0
             humidity = 0
@@ -70,7 +84,7 @@ def index():
             ambient_temp = 0
             predictions = {}
         else:
-            sensor_data = mqtt_client.combined_data
+            sensor_data = combined_data
             temperature = sensor_data.get("temperature", 0)
             humidity = sensor_data.get("humidity", 0)
             co2 = sensor_data.get("co2", 0)
@@ -88,6 +102,7 @@ def index():
                 tvoc=tvoc,
                 ambient_temp=ambient_temp,
                 predictions=predictions,
+                classroom=classroom,
                 version=time.time(),
             )
         )
@@ -111,59 +126,32 @@ def index():
         )
 
 
-@app.route("/plots")
+@views.route("/plots")
 def plots():
+    # the charts load their series from /plots/data
+    classroom = request.args.get("classroom", mqtt_client.default_classroom)
+    return render_template("plots.html", classroom=classroom)
+
+
+@views.route("/plots/data")
+def plots_data():
     try:
-        sensor_data = mqtt_client.get_latest_sensor_data()
-
-        if sensor_data:
-            time_data = [data.get("time", None) for data in sensor_data]
-            co2_data = [data.get("co2", None) for data in sensor_data]
-            temperature_data = [data.get("temperature", None) for data in sensor_data]
-            humidity_data = [data.get("humidity", None) for data in sensor_data]
-            tvoc_data = [data.get("tvoc", None) for data in sensor_data]
-            ambient_temp_data = [data.get("ambient_temp", None) for data in sensor_data]
-
-            def fill_missing_with_last_known(data):
-                last_known = None
-                for i in range(len(data)):
-                    if data[i] is not None:
-                        last_known = data[i]
-                    elif last_known is not None:
-                        data[i] = last_known
-                return data
-
-            co2_data = fill_missing_with_last_known(co2_data)
-            temperature_data = fill_missing_with_last_known(temperature_data)
-            humidity_data = fill_missing_with_last_known(humidity_data)
-            tvoc_data = fill_missing_with_last_known(tvoc_data)
-            ambient_temp_data = fill_missing_with_last_known(ambient_temp_data)
-
-            return render_template(
-                "plots.html",
-                co2_data=co2_data,
-                temperature_data=temperature_data,
-                humidity_data=humidity_data,
-                tvoc_data=tvoc_data,
-                ambient_temp_data=ambient_temp_data,
-                time_data=time_data,
-            )
-        else:
-            return render_template(
-                "plots.html",
-                co2_data=[],
-                temperature_data=[],
-                humidity_data=[],
-                tvoc_data=[],
-                ambient_temp_data=[],
-                time_data=[],
-            )
+        classroom = request.args.get("classroom", mqtt_client.default_classroom)
+        width = request.args.get("width", plot_data.DEFAULT_WIDTH, type=int)
+        width = min(max(width, plot_data.MIN_WIDTH), plot_data.MAX_WIDTH)
+
+        version, body = mqtt_client.get_plot_data(classroom, width)
+        response = Response(body, mimetype="application/json")
+        response.set_etag(f"{classroom}-{version}-{width}")
+        response.headers["Cache-Control"] = "no-cache"
+        return response.make_conditional(request)
 
     except Exception as e:
-        logging.error("error in plots(): %s", e)
-        return "an error has occurred", 500
+        logging.error("plots_data: error building plot data %s", e)
+        return jsonify({"error": str(e)}), 500
 
-@app.route("/feedback", methods=["GET", "POST"])
+
+@views.route("/feedback", methods=["GET", "POST"])
 def feedback():
     if request.method == "POST":
         try:
@@ -172,7 +160,7 @@ def feedback():
                 return "no predictions are available", 400
 
             combined_data = mqtt_client.combined_data
-            features_df = mqtt_client.latest_features_df
+            features = mqtt_client.latest_features
 
             logistic_prediction = predictions.get("Logistic Regression")
             user_feedback = int(request.form["accurate_prediction"])
@@ -183,29 +171,20 @@ def feedback():
                 accurate_prediction = 1 - int(logistic_prediction)
 
             feedback_data = {
-                "temperature": float(features_df["temperature"].iloc[0]),
-                "humidity": float(features_df["humidity"].iloc[0]),
-                "co2": float(features_df["co2"].iloc[0]),
+                "temperature": float(features["temperature"]),
+                "humidity": float(features["humidity"]),
+                "co2": float(features["co2"]),
                 "timestamp": combined_data["time"][-1],
-                "outdoor_temperature": float(features_df["ambient_temp"].iloc[0]),
+                "outdoor_temperature": float(features["ambient_temp"]),
                 "accurate_prediction": accurate_prediction,
             }
 
-            headers = {"X-Api-Key": POST_API_KEY, "Content-Type": CONTENT_TYPE}
-            response = requests.post(API_BASE_URL, headers=headers, json=feedback_data)
-
-            if response.status_code == 200:
+            if mqtt_client.store_feedback_data(feedback_data):
                 return render_template("thank_you.html")
             else:
                 return (
-                    jsonify(
-                        {
-                            "message": "no response was sent",
-                            "status": response.status_code,
-                            "response": response.text,
-                        }
-                    ),
-                    400,
+                    jsonify({"message": "the feedback could not be saved"}),
+                    500,
                 )
 
         except Exception as e:
@@ -226,13 +205,13 @@ def feedback():
             if not predictions:
                 return render_template("feedback.html", error=True)
 
-            features_df = mqtt_client.latest_features_df
+            features = mqtt_client.latest_features
 
             response = make_response(
                 render_template(
                     "feedback.html",
                     predictions=predictions,
-                    features=features_df.to_dict(orient="records")[0],
+                    features=features,
                     version=str(time.time()),
                 )
             )
@@ -248,7 +227,7 @@ def feedback():
             logging.error("feedback: error fetching predictions: %s", e)
             return str(e), 500
 
-@app.route("/leaderboard", methods=["GET", "POST"])
+@views.route("/leaderboard", methods=["GET", "POST"])
 def leaderboard():
     try:
         if request.method == "POST":
@@ -373,34 +352,25 @@ def leaderboard():
 
             future_data_response = get_future_data(adjusted_date_str)
 
-            if future_data_response.status_code != 200:
+            if future_data_response.status_code == 202:
+                # the page polls /future_data itself once the timer runs out
+                formatted_future_data = None
+            elif future_data_response.status_code != 200:
                 return future_data_response
+            else:
+                future_data = future_data_response.get_json()
+                logging.info(
+                    "latest future_data in the leaderboard: %s", future_data
+                )
 
-            future_data = future_data_response.get_json()
-            logging.info(
-                "latest future_data in the leaderboard: %s", future_data
-            )
-
-            formatted_future_data = [
-                {
-                    "timestamp": future_data.get("timestamp"),
-                    "co2_values": (
-                        float(future_data.get("co2_values"))
-                        if future_data.get("co2_values") is not None
-                        else None
-                    ),
-                    "temperature": (
-                        float(future_data.get("temperature"))
-                        if future_data.get("temperature") is not None
-                        else None
-                    ),
-                    "humidity": (
-                        float(future_data.get("humidity"))
-                        if future_data.get("humidity") is not None
-                        else None
-                    ),
-                }
-            ]
+                formatted_future_data = [
+                    {
+                        "timestamp": future_data.get("timestamp"),
+                        "co2_values": future_data.get("co2_values"),
+                        "temperature": future_data.get("temperature"),
+                        "humidity": future_data.get("humidity"),
+                    }
+                ]
 
             last_prediction = predictions.get("Logistic Regression")
 
@@ -438,73 +408,119 @@ def leaderboard():
         )
 
 
-@app.route("/future_data/<timestamp>")
+FUTURE_DATA_MAX_WAIT = 25
+FUTURE_DATA_RETRY_AFTER = 10
+
+
+def check_basic_auth():
+    auth_header = request.headers.get("Authorization")
+    if auth_header:
+        auth_type, auth_credentials = auth_header.split(" ", 1)
+        if auth_type.lower() == "basic":
+            benutzername, passwort = (
+                base64.b64decode(auth_credentials).decode("utf-8").split(":", 1)
+            )
+            if benutzername == "admin" and passwort == "HJ|*fS1i":
+                return None
+
+    return make_response(
+        "verification failed",
+        401,
+        {"WWW-Authenticate": 'Basic realm="login is required!"'},
+    )
+
+
+def future_data_response(classroom, future_timestamp_str, token=None):
+    # answers immediately unless the caller asked to wait, in which case the
+    # request is woken as soon as ingest stores a newer row
+    wait = min(request.args.get("wait", 0, type=float), FUTURE_DATA_MAX_WAIT)
+    future_data = mqtt_client.fetch_future_data(
+        future_timestamp_str, wait=wait, classroom=classroom
+    )
+
+    formatted_future_data = {
+        "timestamp": future_data.get("timestamp"),
+        "co2_values": (
+            float(future_data.get("co2_values"))
+            if future_data.get("co2_values") is not None
+            else None
+        ),
+        "temperature": (
+            float(future_data.get("temperature"))
+            if future_data.get("temperature") is not None
+            else None
+        ),
+        "humidity": (
+            float(future_data.get("humidity"))
+            if future_data.get("humidity") is not None
+            else None
+        ),
+    }
+
+    if all(
+        formatted_future_data[key] is None
+        for key in ["co2_values", "temperature", "humidity"]
+    ):
+        if token is None:
+            token = mqtt_client.future_data_waiter.register(
+                classroom, future_timestamp_str
+            )
+        logging.info("future data for %s is pending, token %s", future_timestamp_str, token)
+        formatted_future_data["status"] = "pending"
+        formatted_future_data["token"] = token
+        formatted_future_data["retry_after"] = FUTURE_DATA_RETRY_AFTER
+        response = make_response(jsonify(formatted_future_data), 202)
+        response.headers["Retry-After"] = str(FUTURE_DATA_RETRY_AFTER)
+        return response
+
+    if token is not None:
+        mqtt_client.future_data_waiter.release(token)
+
+    logging.info("future data fetched successfully %s", formatted_future_data)
+    formatted_future_data["status"] = "ready"
+    return make_response(jsonify(formatted_future_data), 200)
+
+
+@views.route("/future_data/<timestamp>")
 def get_future_data(timestamp):
     try:
-        auth_header = request.headers.get("Authorization")
-        if auth_header:
-            auth_type, auth_credentials = auth_header.split(" ", 1)
-            if auth_type.lower() == "basic":
-                benutzername, passwort = (
-                    base64.b64decode(auth_credentials).decode("utf-8").split(":", 1)
-                )
-                if benutzername != "admin" or passwort != "HJ|*fS1i":
-                    return make_response(
-                        "verification failed",
-                        401,
-                        {"WWW-Authenticate": 'Basic realm="login is required!"'},
-                    )
-            else:
-                return make_response(
-                    "verification failed",
-                    401,
-                    {"WWW-Authenticate": 'Basic realm="login is required!"'},
-                )
-        else:
-            return make_response(
-                "verification failed",
-                401,
-                {"WWW-Authenticate": 'Basic realm="login is required!"'},
-            )
+        auth_error = check_basic_auth()
+        if auth_error is not None:
+            return auth_error
 
         timestamp_dt = datetime.strptime(timestamp, "%Y-%m-%d %H:%M")
         future_timestamp_dt = timestamp_dt + timedelta(minutes=5)
         future_timestamp_str = future_timestamp_dt.strftime("%Y-%m-%d %H:%M")
         logging.info("fetching future data for timestamp %s", future_timestamp_str)
 
-        future_data = mqtt_client.fetch_future_data(future_timestamp_str)
-        if not future_data:
-            logging.info("no future dates available for timestamps: %s", future_timestamp_str)
-            return jsonify({"error": "no future data available"}), 404
-
-        formatted_future_data = {
-            "timestamp": future_data.get("timestamp"),
-            "co2_values": (
-                float(future_data.get("co2_values"))
-                if future_data.get("co2_values") is not None
-                else None
-            ),
-            "temperature": (
-                float(future_data.get("temperature"))
-                if future_data.get("temperature") is not None
-                else None
-            ),
-            "humidity": (
-                float(future_data.get("humidity"))
-                if future_data.get("humidity") is not None
-                else None
-            ),
-        }
-
-        logging.info("future data fetched successfully %s", formatted_future_data)
-        return jsonify(formatted_future_data)
+        classroom = request.args.get("classroom", mqtt_client.default_classroom)
+        return future_data_response(classroom, future_timestamp_str)
 
     except Exception as e:
         logging.error("get_future_data: error fetching future data: %s", e)
-        return jsonify({"error": str(e)}), 500
+        return make_response(jsonify({"error": str(e)}), 500)
+
+
+@views.route("/future_data/pending/<token>")
+def get_pending_future_data(token):
+    try:
+        auth_error = check_basic_auth()
+        if auth_error is not None:
+            return auth_error
 
+        pending = mqtt_client.future_data_waiter.lookup(token)
+        if pending is None:
+            return make_response(jsonify({"error": "unknown or expired token"}), 404)
 
-@app.route("/save_analysis_data", methods=["POST"])
+        classroom, future_timestamp_str = pending
+        return future_data_response(classroom, future_timestamp_str, token=token)
+
+    except Exception as e:
+        logging.error("get_pending_future_data: error fetching future data: %s", e)
+        return make_response(jsonify({"error": str(e)}), 500)
+
+
+@views.route("/save_analysis_data", methods=["POST"])
 def save_analysis_data():
     try:
         data = request.json
@@ -538,7 +554,7 @@ def save_analysis_data():
         return jsonify({"error": str(e)}), 500
 
 
-@app.route("/clear_session")
+@views.route("/clear_session")
 def clear_session():
     try:
         session.clear()
@@ -548,7 +564,7 @@ def clear_session():
         return jsonify({"error in clear_session()": str(e)}), 500
 
 
-@app.route("/clear-predictions", methods=["POST"])
+@views.route("/clear-predictions", methods=["POST"])
 def clear_predictions_route():
     try:
         mqtt_client.clear_predictions()
@@ -558,39 +574,174 @@ def clear_predictions_route():
         return jsonify({"error in clear_predictions_route()": str(e)}), 500
 
 
-@app.route("/latest_data", methods=["GET"])
+def parse_range(default_days=1):
+    # start and end as "%Y-%m-%d %H:%M" from ISO dates or times, by default
+    # the last day
+    end = request.args.get("end")
+    end = datetime.fromisoformat(end) if end else datetime.now()
+    start = request.args.get("start")
+    start = datetime.fromisoformat(start) if start else end - timedelta(days=default_days)
+    if start >= end:
+        raise ValueError("start must be before end")
+    return start.strftime("%Y-%m-%d %H:%M"), end.strftime("%Y-%m-%d %H:%M")
+
+
+@views.route("/history")
+def history():
+    # averaged buckets of a classroom, streamed as json or csv
+    auth_error = check_basic_auth()
+    if auth_error is not None:
+        return auth_error
+
+    try:
+        classroom = request.args.get("classroom", mqtt_client.default_classroom)
+        start, end = parse_range()
+        bucket_minutes = request.args.get("bucket", 60, type=int)
+        output = request.args.get("format", "json")
+        stream = stream_history(
+            mqtt_client.pool, classroom, start, end, bucket_minutes, output
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except HistoryBusyError as e:
+        return jsonify({"error": str(e)}), 429
+    except Exception as e:
+        logging.error("history: error querying history %s", e)
+        return jsonify({"error": str(e)}), 500
+
+    if output == "csv":
+        response = Response(stream, mimetype="text/csv")
+        response.headers["Content-Disposition"] = (
+            f'attachment; filename="{classroom}_{start[:10]}_{end[:10]}.csv"'
+        )
+        return response
+    return Response(stream, mimetype="application/json")
+
+
+@views.route("/predictions/history")
+def prediction_history():
+    # stored predictions of a classroom, newest first
+    auth_error = check_basic_auth()
+    if auth_error is not None:
+        return auth_error
+
+    try:
+        classroom = request.args.get("classroom", mqtt_client.default_classroom)
+        start, end = parse_range(default_days=7)
+        limit = request.args.get("limit", 1000, type=int)
+        rows = fetch_prediction_history(mqtt_client.pool, classroom, start, end, limit)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logging.error("prediction_history: error querying prediction history %s", e)
+        return jsonify({"error": str(e)}), 500
+
+    return jsonify(
+        {"classroom": classroom, "start": start, "end": end, "predictions": rows}
+    )
+
+
+EXPORT_MIMETYPES = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+
+@views.route("/export/<table>")
+def export(table):
+    # streams a table for a time range as csv or parquet
+    auth_error = check_basic_auth()
+    if auth_error is not None:
+        return auth_error
+
+    try:
+        start, end = parse_range(default_days=30)
+        output = request.args.get("format", "csv")
+        stream = export_table(
+            mqtt_client.pool,
+            table,
+            start,
+            end,
+            output=output,
+            classroom=request.args.get("classroom"),
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except ExportBusyError as e:
+        return jsonify({"error": str(e)}), 429
+    except Exception as e:
+        logging.error("export: error starting the export of %s %s", table, e)
+        return jsonify({"error": str(e)}), 500
+
+    response = Response(stream, mimetype=EXPORT_MIMETYPES[output])
+    response.headers["Content-Disposition"] = (
+        f'attachment; filename="{table}_{start[:10]}_{end[:10]}.{output}"'
+    )
+    return response
+
+
+@views.route("/latest_data", methods=["GET"])
 def get_latest_data():
+    classroom = mqtt_client.get_classroom(
+        request.args.get("classroom", mqtt_client.default_classroom)
+    )
+    combined_data = classroom.combined_data()
     latest_data = {
-        "time": mqtt_client.latest_time,
+        "time": classroom.latest_time,
         "humidity": (
-            mqtt_client.combined_data.get("humidity")[-1]
-            if mqtt_client.combined_data.get("humidity")
+            combined_data.get("humidity")[-1]
+            if combined_data.get("humidity")
             else None
         ),
         "temperature": (
-            mqtt_client.combined_data.get("temperature")[-1]
-            if mqtt_client.combined_data.get("temperature")
+            combined_data.get("temperature")[-1]
+            if combined_data.get("temperature")
             else None
         ),
         "co2": (
-            mqtt_client.combined_data.get("co2")[-1]
-            if mqtt_client.combined_data.get("co2")
+            combined_data.get("co2")[-1]
+            if combined_data.get("co2")
             else None
         ),
     }
     return jsonify(latest_data)
 
 
-@app.route("/thank_you")
+@views.route("/stream")
+def stream():
+    # server-sent events with the readings and predictions of one classroom
+    classroom = request.args.get("classroom", mqtt_client.default_classroom)
+    response = Response(
+        mqtt_client.event_broadcaster.stream(classroom),
+        mimetype="text/event-stream",
+    )
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@views.route("/metrics")
+def metrics():
+    # prometheus text format, the web role adds the snapshot of the ingest process
+    if not registry.enabled:
+        return make_response("metrics are disabled", 404)
+    return Response(
+        render(mqtt_client.collect_metrics()),
+        mimetype="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
+@views.route("/thank_you")
 def thank_you():
     return render_template("thank_you.html")
 
 
-@app.route("/contact")
+@views.route("/contact")
 def contact():
     return render_template("contact.html")
 
 
+app = create_app()
+
+
 if __name__ == "__main__":
+    init_services(app)
     port = int(os.environ.get("PORT", 8000))
     app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,97 @@
+import datetime as dt
+import json
+import sys
+import time
+
+import pytz
+
+from helpers.message_decoding import decode_uplink, format_minute, loads
+
+# messages per second on one core for the uplink decoding of on_message,
+# before (strptime, pytz lookup and strftime per message) and after the
+# helpers.message_decoding fast path. run from smart_ventilation/backend:
+#   python -m benchmarks.decode_benchmark [messages]
+
+METRICS = ["humidity", "temperature", "co2"]
+
+
+def make_payloads(count):
+    start = dt.datetime(2024, 3, 30, 22, 0, tzinfo=dt.timezone.utc)
+    payloads = []
+    for i in range(count):
+        received = start + dt.timedelta(seconds=10 * i, microseconds=123456)
+        payloads.append(
+            json.dumps(
+                {
+                    "deviceInfo": {"devEui": "0004a30b01045883"},
+                    "time": received.isoformat(),
+                    "object": {
+                        "humidity": 40 + (i % 7) * 0.137,
+                        "temperature": 21 + (i % 5) * 0.113,
+                        "co2": 600 + (i % 11) * 3.71,
+                    },
+                }
+            ).encode()
+        )
+    return payloads
+
+
+def legacy_decode(payload, metrics):
+    payload = json.loads(payload.decode())
+
+    def adjust_time(raw_time):
+        try:
+            utc_time = dt.datetime.strptime(raw_time, "%Y-%m-%dT%H:%M:%S.%f%z")
+            berlin_tz = pytz.timezone("Europe/Berlin")
+            return utc_time.astimezone(berlin_tz)
+        except Exception:
+            return None
+
+    received_time = adjust_time(payload.get("time"))
+    formatted_time = (
+        received_time.strftime("%Y-%m-%d %H:%M") if received_time is not None else None
+    )
+    sensor_object = payload.get("object") or {}
+    values = {}
+    for metric in metrics:
+        value = sensor_object.get(metric)
+        if value is not None:
+            values[metric] = round(value, 2)
+    return formatted_time, int(received_time.timestamp()), values
+
+
+def fast_decode(payload, metrics):
+    timestamp, values = decode_uplink(payload, metrics)
+    return format_minute(int(timestamp // 60)), int(timestamp), values
+
+
+def measure(decode, payloads, repeat=5):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for payload in payloads:
+            decode(payload, METRICS)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return len(payloads) / best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    payloads = make_payloads(count)
+
+    # both paths must produce the same local minute, epoch and values,
+    # including across the daylight saving change in the sample data
+    for payload in payloads:
+        if legacy_decode(payload, METRICS) != fast_decode(payload, METRICS):
+            raise SystemExit(f"decoders disagree on {payload!r}")
+
+    legacy_rate = measure(legacy_decode, payloads)
+    fast_rate = measure(fast_decode, payloads)
+    print(f"json backend: {loads.__module__}")
+    print(f"before: {legacy_rate:,.0f} messages/s")
+    print(f"after:  {fast_rate:,.0f} messages/s ({fast_rate / legacy_rate:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import importlib.util
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+# checks that the vectorized labels and targets of ml-models/models.py match
+# the former row-wise implementation and times both on a synthetic
+# multi-year, multi-room dataset. run from smart_ventilation/backend:
+#   python -m benchmarks.feature_parity [years] [rooms]
+
+spec = importlib.util.spec_from_file_location("models", "ml-models/models.py")
+models = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(models)
+
+
+def legacy_feature_engineering(final_dataset):
+    final_dataset["timestamp"] = pd.to_datetime(final_dataset["timestamp"])
+    final_dataset["hour"] = final_dataset["timestamp"].dt.hour
+    final_dataset["day_of_week"] = final_dataset["timestamp"].dt.dayofweek
+    final_dataset["month"] = final_dataset["timestamp"].dt.month
+
+    # the literal thresholds of the original create_open_window
+    thresholds = {
+        "co2": 1000,
+        "temperature_min": 15,
+        "temperature_max": 22,
+        "humidity_min": 35,
+        "humidity_max": 65,
+        "tvoc": 400,
+        "ambient_temp_min": 5,
+        "ambient_temp_max": 25,
+    }
+    conditions = (
+        (final_dataset["co2"] <= thresholds["co2"])
+        & (final_dataset["temperature"] >= thresholds["temperature_min"])
+        & (final_dataset["temperature"] <= thresholds["temperature_max"])
+        & (final_dataset["humidity"] >= thresholds["humidity_min"])
+        & (final_dataset["humidity"] <= thresholds["humidity_max"])
+        & (final_dataset["tvoc"] <= thresholds["tvoc"])
+        & (final_dataset["ambient_temp"] >= thresholds["ambient_temp_min"])
+        & (final_dataset["ambient_temp"] <= thresholds["ambient_temp_max"])
+    )
+    final_dataset["open_window"] = (~conditions).astype(int)
+    return final_dataset
+
+
+def legacy_duration_open(final_dataset):
+    def calculate_duration(row):
+        duration = 0
+        if row["co2"] > 1000:
+            duration += (row["co2"] - 1000) / 45
+        if row["temperature"] > 21:
+            duration += row["temperature"] - 21 * 1.05
+        return duration
+
+    return final_dataset.apply(calculate_duration, axis=1).to_numpy(dtype=np.float64)
+
+
+def legacy_prepare_data(co2_frames, temp_frames):
+    for df in co2_frames + temp_frames:
+        df["time"] = pd.to_datetime(df["time"], format="ISO8601").dt.strftime(
+            "%d/%m/%Y %H:%M"
+        )
+        df.drop(columns=["dev_eui"], inplace=True)
+    merged_df = pd.merge(
+        pd.concat(co2_frames, ignore_index=True),
+        pd.concat(temp_frames, ignore_index=True),
+        on="time",
+        suffixes=("", "_dup"),
+    )
+    merged_df.drop(columns=["temperature_dup"], inplace=True)
+    merged_df["time"] = pd.to_datetime(merged_df["time"], format="%d/%m/%Y %H:%M")
+    return merged_df
+
+
+def make_dataset(years, rooms):
+    rng = np.random.default_rng(42)
+    timestamps = pd.date_range("2022-01-01", periods=years * 365 * 24 * 60 // 5, freq="5min")
+    frames = []
+    for room in range(rooms):
+        count = len(timestamps)
+        frames.append(
+            pd.DataFrame(
+                {
+                    "timestamp": timestamps,
+                    "classroom_number": f"room-{room}",
+                    "co2": rng.normal(900, 300, count).round(),
+                    "temperature": rng.normal(21, 2.5, count).round(2),
+                    "humidity": rng.normal(50, 12, count).round(2),
+                    "tvoc": rng.normal(250, 120, count).round(),
+                    "ambient_temp": rng.normal(12, 8, count).round(1),
+                }
+            )
+        )
+    dataset = pd.concat(frames, ignore_index=True)
+    # a few gaps, like the sensor exports
+    dataset.loc[rng.random(len(dataset)) < 0.001, "tvoc"] = np.nan
+    return dataset
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+
+def main():
+    years = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    rooms = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    dataset = make_dataset(years, rooms)
+    print(f"{len(dataset):,} rows ({years} years, {rooms} rooms)")
+
+    expected, legacy_seconds = timed(legacy_feature_engineering, dataset.copy())
+    actual, vectorized_seconds = timed(models.feature_engineering, dataset.copy())
+    pd.testing.assert_frame_equal(actual, expected)
+    print(f"feature_engineering: {legacy_seconds:.2f}s before, {vectorized_seconds:.2f}s after")
+
+    # the row-wise duration is slow, so it is compared on a sample
+    sample = dataset.dropna().iloc[:200000]
+    expected, legacy_seconds = timed(legacy_duration_open, sample)
+    actual, vectorized_seconds = timed(models.calculate_duration_open, sample)
+    np.testing.assert_allclose(actual, expected, rtol=0, atol=1e-12)
+    print(
+        f"duration_open on {len(sample):,} rows: {legacy_seconds:.2f}s before, "
+        f"{vectorized_seconds:.3f}s after"
+    )
+
+    co2_export = "datasets/10c_co2_last_30_days.csv"
+    temp_export = "datasets/10c_temp_last_30_days.csv"
+    if os.path.exists(co2_export) and os.path.exists(temp_export):
+        co2 = pd.read_csv(co2_export)
+        temp = pd.read_csv(temp_export)
+        expected = legacy_prepare_data([co2.copy(), co2.copy()], [temp.copy(), temp.copy()])
+        actual = models.prepare_data(co2.copy(), co2.copy(), temp.copy(), temp.copy())
+        pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+        print(f"prepare_data matches on {len(actual):,} merged rows")
+
+    print("parity ok")
+
+
+if __name__ == "__main__":
+    main()
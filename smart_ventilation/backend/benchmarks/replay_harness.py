@@ -0,0 +1,282 @@
+import argparse
+import glob
+import json
+import logging
+import queue
+import threading
+import time
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import paho.mqtt.client as mqtt
+
+from helpers.device_registry import APPLICATION_ID, DEFAULT_DEVICES
+from config.api_config_loader import get_api_config
+from mqtt_client import MQTTClient
+
+# replays the bundled sensor exports as chirpstack uplinks into MQTTClient,
+# for any number of classrooms and at any speed-up, and reports ingest
+# throughput, per-message latency, the database insert rate and the cost of
+# one prediction tick. run from smart_ventilation/backend:
+#   python -m benchmarks.replay_harness --classrooms 20 --speedup 0
+#
+# the client is created with the configured database, so point
+# config/db_config.yaml at a scratch database or pass --no-store, which builds
+# the client without database pool, writers, feedback sender or online updater.
+# --mode direct calls on_message inline; --mode loop publishes into an
+# in-process broker stand-in whose single delivery thread calls on_message
+# like the paho network loop, so latency includes the queueing delay.
+
+STORE_DEVICE = "0004a30b01045883"
+AMBIENT_DEVICE = "647fda000000aa92"
+
+
+def load_streams(datasets_directory, ambient_source):
+    # (epoch seconds, iso time, device, payload object) per source reading
+    readings = pd.concat(
+        [pd.read_csv(path) for path in sorted(glob.glob(f"{datasets_directory}/10c_co2_*.csv"))],
+        ignore_index=True,
+    )
+    times = pd.to_datetime(readings["time"], format="ISO8601", utc=True)
+    streams = [
+        (time_.timestamp(), time_.isoformat(), STORE_DEVICE, {
+            "humidity": humidity, "temperature": temperature, "co2": co2,
+        })
+        for time_, humidity, temperature, co2 in zip(
+            times, readings["humidity"], readings["temperature"], readings["co2"]
+        )
+    ]
+
+    if ambient_source == "dwd":
+        outdoor = pd.read_csv(f"{datasets_directory}/outdoor_temperature.txt", delimiter=";")
+        outdoor_times = pd.to_datetime(
+            outdoor["MESS_DATUM"].astype(str), format="%Y%m%d%H"
+        ).dt.tz_localize("UTC")
+        in_range = (outdoor_times >= times.min()) & (outdoor_times <= times.max())
+        ambient = zip(outdoor_times[in_range], outdoor["TT_TU"][in_range])
+    else:
+        temperatures = pd.concat(
+            [pd.read_csv(path) for path in sorted(glob.glob(f"{datasets_directory}/10c_temp_*.csv"))],
+            ignore_index=True,
+        )
+        ambient = zip(
+            pd.to_datetime(temperatures["time"], format="ISO8601", utc=True),
+            temperatures["temperature"],
+        )
+    streams.extend(
+        (time_.timestamp(), time_.isoformat(), AMBIENT_DEVICE, {"ambient_temp": value})
+        for time_, value in ambient
+    )
+    streams.sort(key=lambda reading: reading[0])
+    return streams
+
+
+def replay_devices(classrooms, store):
+    # every replayed classroom gets copies of the 10c devices whose EUIs
+    # start with the classroom index
+    devices = {}
+    for index in range(classrooms):
+        classroom = f"replay-{index}"
+        for dev_eui, device in DEFAULT_DEVICES.items():
+            devices[f"{index:04x}{dev_eui[4:]}"] = {
+                "application": APPLICATION_ID,
+                "classrooms": [classroom],
+                "metrics": list(device["metrics"]),
+                "store": device.get("store", False) and store,
+            }
+    return devices
+
+
+def build_messages(streams, classrooms, limit):
+    # payloads are serialized up front so the replay only measures ingest
+    messages = []
+    for epoch, iso_time, dev_eui, sensor_object in streams[:limit]:
+        for index in range(classrooms):
+            topic = f"application/{APPLICATION_ID}/device/{index:04x}{dev_eui[4:]}/event/up"
+            payload = json.dumps({"time": iso_time, "object": sensor_object}).encode()
+            messages.append((epoch, topic, payload))
+    return messages
+
+
+def make_message(topic, payload):
+    message = mqtt.MQTTMessage(topic=topic.encode())
+    message.payload = payload
+    return message
+
+
+def schedule(messages, speedup):
+    # wall-clock offset of every message, all zero when speedup is 0
+    if not speedup:
+        return [0.0] * len(messages)
+    first_epoch = messages[0][0]
+    return [(epoch - first_epoch) / speedup for epoch, _, _ in messages]
+
+
+def replay_direct(client, messages, speedup):
+    latencies = np.empty(len(messages))
+    offsets = schedule(messages, speedup)
+    started = time.perf_counter()
+    for i, ((_, topic, payload), offset) in enumerate(zip(messages, offsets)):
+        delay = started + offset - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        message = make_message(topic, payload)
+        received = time.perf_counter()
+        client.on_message(client.client, None, message)
+        latencies[i] = time.perf_counter() - received
+    return time.perf_counter() - started, latencies
+
+
+def replay_loop(client, messages, speedup):
+    deliveries = queue.Queue()
+    latencies = np.empty(len(messages))
+    offsets = schedule(messages, speedup)
+
+    def deliver():
+        for i in range(len(messages)):
+            published, message = deliveries.get()
+            client.on_message(client.client, None, message)
+            latencies[i] = time.perf_counter() - published
+
+    delivery_thread = threading.Thread(target=deliver, name="broker-stand-in")
+    delivery_thread.start()
+    started = time.perf_counter()
+    for (_, topic, payload), offset in zip(messages, offsets):
+        delay = started + offset - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        deliveries.put((time.perf_counter(), make_message(topic, payload)))
+    delivery_thread.join()
+    return time.perf_counter() - started, latencies
+
+
+def measure_prediction_ticks(client, ticks):
+    # (seconds of the ticks that produced predictions, number of failed ticks).
+    # predict_classrooms logs its errors instead of raising, so a tick counts
+    # as failed when no classroom got a new prediction id
+    states = list(client.classrooms.values())
+    costs = []
+    failed = 0
+    for _ in range(ticks):
+        for state in states:
+            state.predictions_cleared = False
+        before = [state.latest_predictions.get("id") for state in states]
+        started = time.perf_counter()
+        client.predict_classrooms(states)
+        cost = time.perf_counter() - started
+        predicted = sum(
+            state.latest_predictions.get("id") not in (None, previous)
+            for state, previous in zip(states, before)
+        )
+        if predicted:
+            costs.append(cost)
+        else:
+            failed += 1
+    return np.array(costs), failed
+
+
+def without_storage():
+    # --no-store: the client is built without a database pool, schema setup
+    # and background writers, so none of their threads run while measuring
+    class Stopped:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def start(self):
+            pass
+
+        def enqueue(self, row):
+            return False
+
+        def stop(self, timeout=None):
+            pass
+
+    class NoPool:
+        def when_ready(self, setup):
+            pass
+
+        def closeall(self):
+            pass
+
+    return mock.patch.multiple(
+        "mqtt_client",
+        create_connection_pool=lambda config: NoPool(),
+        SensorDataWriter=Stopped,
+        FeedbackSender=Stopped,
+        PredictionWriter=Stopped,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--classrooms", type=int, default=1)
+    parser.add_argument("--speedup", type=float, default=0, help="0 replays as fast as possible")
+    parser.add_argument("--mode", choices=["direct", "loop"], default="direct")
+    parser.add_argument("--limit", type=int, default=None, help="source readings to replay")
+    parser.add_argument("--ambient-source", choices=["sensor", "dwd"], default="sensor")
+    parser.add_argument("--prediction-ticks", type=int, default=20)
+    parser.add_argument("--no-store", action="store_true", help="do not write to the database")
+    parser.add_argument("--datasets", default="datasets")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    streams = load_streams(arguments.datasets, arguments.ambient_source)
+    messages = build_messages(streams, arguments.classrooms, arguments.limit)
+
+    if arguments.no_store:
+        with without_storage():
+            client = MQTTClient(
+                role="standalone",
+                api_config=dict(get_api_config(), ONLINE_UPDATE_INTERVAL=0),
+                db_config={},
+            )
+    else:
+        client = MQTTClient(role="standalone")
+    client.devices = replay_devices(arguments.classrooms, not arguments.no_store)
+    for device in client.devices.values():
+        for classroom in device["classrooms"]:
+            client.get_classroom(classroom)
+
+    writer = None if arguments.no_store else getattr(client, "sensor_writer", None)
+    flushed_before = writer.get_counters()["flushed"] if writer else 0
+
+    replay = replay_direct if arguments.mode == "direct" else replay_loop
+    elapsed, latencies = replay(client, messages, arguments.speedup)
+
+    # the insert rate includes draining the write-behind queue
+    insert_rate = None
+    if writer is not None and client.pool is not None and not arguments.no_store:
+        drain_started = time.perf_counter()
+        writer.stop()
+        drain_seconds = time.perf_counter() - drain_started
+        writer_counters = writer.get_counters()
+        insert_rate = (writer_counters["flushed"] - flushed_before) / (elapsed + drain_seconds)
+    ticks, failed_ticks = measure_prediction_ticks(client, arguments.prediction_ticks)
+    client.stop()
+
+    print(f"mode {arguments.mode}, {arguments.classrooms} classrooms, speedup {arguments.speedup or 'max'}")
+    print(f"messages:   {len(messages):,} in {elapsed:.2f}s ({len(messages) / elapsed:,.0f} messages/s)")
+    print(
+        "latency:    p50 {:.1f} us, p99 {:.1f} us, max {:.1f} us".format(
+            *(np.percentile(latencies, [50, 99, 100]) * 1e6)
+        )
+    )
+    if insert_rate is None:
+        print("db inserts: not measured (no database or --no-store)")
+    else:
+        print(f"db inserts: {insert_rate:,.0f} rows/s {writer_counters}")
+    if not len(ticks):
+        print(f"prediction: no predictions made in {failed_ticks} ticks, see the log for the errors")
+        raise SystemExit(1)
+    print(
+        "prediction: {:.2f} ms mean, {:.2f} ms p99 per tick over {} classrooms{}".format(
+            ticks.mean() * 1e3,
+            np.percentile(ticks, 99) * 1e3,
+            len(client.classrooms),
+            f", {failed_ticks} of {failed_ticks + len(ticks)} ticks failed" if failed_ticks else "",
+        )
+    )
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,29 @@
+import functools
+import os
+
 import yaml
 
+from database.database_connection import load_config
+from helpers.startup import startup_timer
+
+API_CONFIG_PATH = os.environ.get("SMART_VENTILATION_API_CONFIG", "config/api_config.yaml")
+DB_CONFIG_PATH = os.environ.get("SMART_VENTILATION_DB_CONFIG", "config/db_config.yaml")
+
+
 def load_api_config(config_file_path):
     with open(config_file_path, "r") as file:
         api_config = yaml.safe_load(file)
     return api_config
+
+
+# the configs are read once per process on first use, never at import time
+@functools.lru_cache(maxsize=None)
+def get_api_config():
+    with startup_timer.phase("config"):
+        return load_api_config(API_CONFIG_PATH)
+
+
+@functools.lru_cache(maxsize=None)
+def get_db_config():
+    with startup_timer.phase("config"):
+        return load_config(DB_CONFIG_PATH)
@@ -0,0 +1,192 @@
+import argparse
+import io
+import logging
+import os
+import time
+
+import pandas as pd
+
+from config.api_config_loader import get_db_config
+from database.database_connection import connect_to_database
+from database.rollups import SCHEMA_QUERIES as ROLLUP_SCHEMA_QUERIES, refresh_rollups
+
+# loads sensor exports (time, dev_eui, co2, humidity, temperature CSVs like
+# datasets/10c_co2_last_30_days.csv) into classroom_environmental_data.
+# every chunk is parsed with pandas, copied into a temporary staging table
+# with COPY FROM STDIN and moved over with one INSERT ... SELECT that skips
+# (classroom, timestamp) pairs the table already has, so files can be
+# imported again or overlap without creating duplicates. timestamps are
+# stored like the sensor writer stores them: Berlin local time, per minute.
+# the rollups of the imported classrooms and range are rebuilt at the end.
+#
+# run from smart_ventilation/backend:
+#   python -m database.backfill datasets/10c_co2_*.csv [--classroom 10c]
+
+CHUNK_ROWS = 500000
+REQUIRED_COLUMNS = ["time", "co2", "humidity", "temperature"]
+
+STAGING_QUERY = """
+    CREATE TEMPORARY TABLE IF NOT EXISTS backfill_staging (
+        timestamp TIMESTAMP NOT NULL,
+        co2_values DOUBLE PRECISION,
+        temperature DOUBLE PRECISION,
+        humidity DOUBLE PRECISION,
+        classroom_number TEXT NOT NULL
+    ) ON COMMIT DELETE ROWS
+"""
+
+COPY_QUERY = """
+    COPY backfill_staging (timestamp, co2_values, temperature, humidity, classroom_number)
+    FROM STDIN WITH (FORMAT csv)
+"""
+
+# the first reading of a minute wins, like a duplicate that is already stored
+MERGE_QUERY = """
+    INSERT INTO classroom_environmental_data
+    (timestamp, co2_values, temperature, humidity, classroom_number)
+    SELECT DISTINCT ON (s.classroom_number, s.timestamp)
+        s.timestamp, s.co2_values, s.temperature, s.humidity, s.classroom_number
+    FROM backfill_staging s
+    WHERE NOT EXISTS (
+        SELECT 1 FROM classroom_environmental_data t
+        WHERE t.classroom_number = s.classroom_number
+        AND t.timestamp = s.timestamp
+    )
+    ORDER BY s.classroom_number, s.timestamp
+"""
+
+# NOT EXISTS only sees committed rows, so concurrent backfills or the sensor
+# writer could insert the same minute while the merge runs. the lock is held
+# until the chunk commits; the writer only waits for the merge, not the COPY
+LOCK_QUERY = "LOCK TABLE classroom_environmental_data IN SHARE ROW EXCLUSIVE MODE"
+
+
+def classroom_from_path(path):
+    # "10c_co2_last_30_days.csv" -> "10c"
+    return os.path.basename(path).split("_", 1)[0]
+
+
+def prepare_chunk(chunk, classroom):
+    # rows of the chunk in the column order of backfill_staging
+    chunk = chunk.dropna(subset=REQUIRED_COLUMNS)
+    times = (
+        pd.to_datetime(chunk["time"], format="ISO8601", utc=True)
+        .dt.tz_convert("Europe/Berlin")
+        .dt.strftime("%Y-%m-%d %H:%M")
+    )
+    return pd.DataFrame(
+        {
+            "timestamp": times,
+            "co2_values": chunk["co2"].round(2),
+            "temperature": chunk["temperature"].round(2),
+            "humidity": chunk["humidity"].round(2),
+            "classroom_number": classroom,
+        }
+    )
+
+
+def copy_chunk(conn, rows):
+    # returns the number of rows that were new
+    buffer = io.StringIO()
+    rows.to_csv(buffer, header=False, index=False)
+    buffer.seek(0)
+    with conn.cursor() as cursor:
+        cursor.copy_expert(COPY_QUERY, buffer)
+        cursor.execute(LOCK_QUERY)
+        cursor.execute(MERGE_QUERY)
+        inserted = cursor.rowcount
+    conn.commit()
+    return inserted
+
+
+def backfill_file(conn, path, classroom=None, chunk_rows=CHUNK_ROWS, progress=None):
+    classroom = classroom or classroom_from_path(path)
+    header = pd.read_csv(path, nrows=0).columns
+    missing = [column for column in REQUIRED_COLUMNS if column not in header]
+    if missing:
+        logging.warning("backfill: skipping %s, it has no %s column", path, ", ".join(missing))
+        return 0, 0, None, None
+
+    read = inserted = 0
+    first_timestamp = last_timestamp = None
+    for chunk in pd.read_csv(path, usecols=REQUIRED_COLUMNS, chunksize=chunk_rows):
+        rows = prepare_chunk(chunk, classroom)
+        if rows.empty:
+            continue
+        chunk_first, chunk_last = rows["timestamp"].min(), rows["timestamp"].max()
+        first_timestamp = chunk_first if first_timestamp is None else min(first_timestamp, chunk_first)
+        last_timestamp = chunk_last if last_timestamp is None else max(last_timestamp, chunk_last)
+        inserted += copy_chunk(conn, rows)
+        read += len(rows)
+        if progress is not None:
+            progress(path, read, inserted)
+    return read, inserted, first_timestamp, last_timestamp
+
+
+def backfill(conn, paths, classroom=None, chunk_rows=CHUNK_ROWS, rollups=True):
+    with conn.cursor() as cursor:
+        for query in ROLLUP_SCHEMA_QUERIES:
+            cursor.execute(query)
+        cursor.execute(STAGING_QUERY)
+    conn.commit()
+
+    started = time.perf_counter()
+    totals = {"read": 0, "inserted": 0}
+
+    def progress(path, read, inserted):
+        elapsed = time.perf_counter() - started
+        logging.info(
+            "%s: %d rows read, %d new, %.0f rows/s overall",
+            path,
+            read,
+            inserted,
+            (totals["read"] + read) / elapsed if elapsed else 0,
+        )
+
+    first_timestamp = last_timestamp = None
+    classrooms = set()
+    for path in paths:
+        read, inserted, file_first, file_last = backfill_file(conn, path, classroom, chunk_rows, progress)
+        totals["read"] += read
+        totals["inserted"] += inserted
+        if file_first is not None:
+            first_timestamp = file_first if first_timestamp is None else min(first_timestamp, file_first)
+            last_timestamp = file_last if last_timestamp is None else max(last_timestamp, file_last)
+            classrooms.add(classroom or classroom_from_path(path))
+
+    if rollups and first_timestamp is not None and totals["inserted"]:
+        logging.info(
+            "backfill: refreshing rollups of %s from %s through %s",
+            ", ".join(sorted(classrooms)),
+            first_timestamp,
+            last_timestamp,
+        )
+        refresh_rollups(conn, first_timestamp, last_timestamp, classrooms)
+
+    totals["seconds"] = round(time.perf_counter() - started, 1)
+    totals["skipped"] = totals["read"] - totals["inserted"]
+    logging.info("backfill: done %s", totals)
+    return totals
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--classroom", help="defaults to the file name prefix, e.g. 10c")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    parser.add_argument("--no-rollups", action="store_true", help="skip rebuilding the rollups")
+    arguments = parser.parse_args()
+
+    conn = connect_to_database(get_db_config())
+    if conn is not None:
+        try:
+            backfill(
+                conn,
+                arguments.paths,
+                arguments.classroom,
+                arguments.chunk_rows,
+                rollups=not arguments.no_rollups,
+            )
+        finally:
+            conn.close()
@@ -1,6 +1,21 @@
 import psycopg2
+import psycopg2.pool
 import logging
+import threading
+import time
 import yaml
+from contextlib import contextmanager
+
+from helpers.metrics import registry
+
+CHECKOUT_SECONDS = registry.histogram(
+    "smart_ventilation_db_pool_checkout_seconds",
+    "Time spent waiting for a pooled database connection.",
+)
+DISCARDED_CONNECTIONS = registry.counter(
+    "smart_ventilation_db_connections_discarded",
+    "Broken database connections closed and replaced by the pool.",
+)
 
 logger = logging.getLogger(__name__)
 
@@ -27,4 +42,242 @@ def connect_to_database(config):
         return connection
     except Exception as e:
         logging.error("failed to connect to database: %s", e)
-        return None
\ No newline at end of file
+        return None
+
+
+class PoolTimeoutError(psycopg2.pool.PoolError):
+    pass
+
+
+class ConnectionPool:
+    # the psycopg2 pool is opened on the first checkout and reopened with
+    # backoff while the database is unreachable, so a database that starts
+    # after the client only delays the first queries
+    def __init__(
+        self,
+        config,
+        min_size=1,
+        max_size=10,
+        timeout=10,
+        health_check_interval=30,
+        retry_interval=1,
+        max_retry_interval=30,
+    ):
+        self.config = config
+        self.min_size = min_size
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.retry_at = 0.0
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.next_retry_interval = retry_interval
+        self.pending_setup = []
+        self.timeout = timeout
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+        # ThreadedConnectionPool raises as soon as it is exhausted, the
+        # semaphore makes callers wait up to timeout seconds for a free slot
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.last_used = {}
+        try:
+            self.open_pool()
+        except psycopg2.Error as e:
+            logging.warning("ConnectionPool: database not reachable yet %s", e)
+
+    def open_pool(self):
+        if self.pool is not None:
+            return self.pool
+        with self.pool_lock:
+            if self.pool is None:
+                if time.monotonic() < self.retry_at:
+                    raise psycopg2.OperationalError(
+                        "database unavailable, next attempt in %.0f seconds"
+                        % (self.retry_at - time.monotonic())
+                    )
+                try:
+                    self.pool = psycopg2.pool.ThreadedConnectionPool(
+                        self.min_size,
+                        self.max_size,
+                        dbname=self.config["NAME"],
+                        user=self.config["USER"],
+                        password=self.config["PASSWORD"],
+                        host=self.config["HOST"],
+                        port=self.config["PORT"],
+                    )
+                except psycopg2.Error:
+                    self.retry_at = time.monotonic() + self.next_retry_interval
+                    self.next_retry_interval = min(
+                        self.next_retry_interval * 2, self.max_retry_interval
+                    )
+                    raise
+                self.next_retry_interval = self.retry_interval
+                logging.info("database connection pool opened")
+            setup, self.pending_setup = self.pending_setup, []
+        for function in setup:
+            function(self)
+        return self.pool
+
+    def when_ready(self, setup):
+        # runs setup(pool) now if the database is reachable, otherwise once
+        # the pool was opened by a later checkout
+        with self.pool_lock:
+            if self.pool is None:
+                self.pending_setup.append(setup)
+                return
+        setup(self)
+
+    def getconn(self):
+        started = time.perf_counter() if registry.enabled else None
+        self.open_pool()
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PoolTimeoutError(
+                "no database connection available after %s seconds" % self.timeout
+            )
+        try:
+            conn = self.pool.getconn()
+            # several idle connections may have died together, every
+            # replacement is checked as well
+            attempts = 0
+            while not self.is_healthy(conn):
+                attempts += 1
+                logging.warning("getconn: discarding broken database connection")
+                self.discard(conn)
+                if attempts > self.max_size:
+                    raise psycopg2.OperationalError("no healthy database connection available")
+                conn = self.pool.getconn()
+            if started is not None:
+                CHECKOUT_SECONDS.observe(time.perf_counter() - started)
+            return conn
+        except Exception:
+            self.slots.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        try:
+            if close or conn.closed:
+                self.discard(conn)
+            else:
+                self.last_used[id(conn)] = time.monotonic()
+                self.pool.putconn(conn)
+        finally:
+            self.slots.release()
+
+    def discard(self, conn):
+        DISCARDED_CONNECTIONS.inc()
+        self.last_used.pop(id(conn), None)
+        try:
+            self.pool.putconn(conn, close=True)
+        except Exception as e:
+            logging.error("discard: error closing database connection %s", e)
+
+    def is_healthy(self, conn):
+        if conn.closed:
+            return False
+
+        last_used = self.last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < self.health_check_interval:
+            return True
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception as e:
+            logging.warning("is_healthy: health check failed %s", e)
+            return False
+
+    @contextmanager
+    def connection(self, commit=False):
+        # a clean exit commits when asked and otherwise rolls back, so no
+        # connection goes back to the pool idle in a transaction
+        conn = self.getconn()
+        broken = False
+        try:
+            yield conn
+            if commit:
+                conn.commit()
+            else:
+                conn.rollback()
+        except psycopg2.OperationalError:
+            broken = True
+            raise
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self.putconn(conn, close=broken)
+
+    def closeall(self):
+        if self.pool is None:
+            return
+        try:
+            self.pool.closeall()
+        except Exception as e:
+            logging.error("closeall: error closing connection pool %s", e)
+
+
+class PooledStream:
+    # iterates `chunks`, which reads from `conn`, and gives the connection
+    # back to the pool once the chunks are exhausted, fail or the stream is
+    # closed. werkzeug closes response iterables after the response or when
+    # the client disconnects, even before the first chunk was read
+    def __init__(self, pool, conn, chunks, name="stream", on_close=None):
+        self.pool = pool
+        self.conn = conn
+        self.chunks = chunks
+        self.name = name
+        self.on_close = on_close
+        self.broken = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.conn is None:
+            raise StopIteration
+        try:
+            return next(self.chunks)
+        except StopIteration:
+            self.close()
+            raise
+        except psycopg2.OperationalError as e:
+            logging.error("%s: db connection error while streaming %s", self.name, e)
+            self.broken = True
+        except Exception as e:
+            logging.error("%s: error while streaming %s", self.name, e)
+        self.close()
+        raise StopIteration
+
+    def close(self):
+        conn, self.conn = self.conn, None
+        if conn is None:
+            return
+        try:
+            self.chunks.close()
+            if not conn.closed:
+                conn.rollback()
+        except Exception:
+            self.broken = True
+        try:
+            self.pool.putconn(conn, close=self.broken)
+        finally:
+            if self.on_close is not None:
+                self.on_close()
+
+
+def create_connection_pool(config):
+    try:
+        connection_pool = ConnectionPool(
+            config,
+            min_size=config.get("POOL_MIN_SIZE", 1),
+            max_size=config.get("POOL_MAX_SIZE", 10),
+            timeout=config.get("POOL_TIMEOUT", 10),
+            health_check_interval=config.get("POOL_HEALTH_CHECK_INTERVAL", 30),
+        )
+        logging.info("successfully created database connection pool")
+        return connection_pool
+    except Exception as e:
+        logging.error("failed to create database connection pool: %s", e)
+        return None
@@ -0,0 +1,319 @@
+import logging
+import queue
+import threading
+
+import psycopg2
+
+# bulk exports of the tables analysts need, for a time range. the rows are
+# produced by COPY (SELECT ...) TO STDOUT on a background thread and handed
+# to the response through a small bounded queue, so neither side holds more
+# than a few chunks and a slow client only slows down its own export. COPY
+# reads a snapshot like any SELECT, so the sensor writer is never blocked.
+# parquet is converted from the CSV stream in bounded row groups.
+
+EXPORT_TABLES = {
+    "classroom_environmental_data": {"time_column": "timestamp", "classroom_column": "classroom_number"},
+    "feedback_tabelle": {"time_column": "timestamp", "classroom_column": None},
+    "environmental_data_analysis": {"time_column": "timestamp", "classroom_column": None},
+}
+
+EXPORT_FORMATS = ("csv", "parquet")
+
+# exports share the connection pool with ingest, so only a few may run at once
+EXPORT_MAX_CONCURRENT = 2
+export_slots = threading.BoundedSemaphore(EXPORT_MAX_CONCURRENT)
+
+CHUNK_BYTES = 64 * 1024
+QUEUE_CHUNKS = 16
+PARQUET_ROW_GROUP_ROWS = 65536
+
+COLUMNS_QUERY = """
+    SELECT column_name, data_type FROM information_schema.columns
+    WHERE table_name = %s
+    ORDER BY ordinal_position
+"""
+
+
+class ExportBusyError(Exception):
+    pass
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+class QueueWriter:
+    # file-like target of copy_expert. psycopg2 writes one row per call, the
+    # rows are collected into CHUNK_BYTES chunks before they are queued
+    def __init__(self, chunks, cancelled):
+        self.chunks = chunks
+        self.cancelled = cancelled
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= CHUNK_BYTES:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        chunk = "".join(self.buffer).encode() if isinstance(self.buffer[0], str) else b"".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.put(chunk)
+
+    def put(self, item):
+        while True:
+            if self.cancelled.is_set():
+                raise ExportCancelled()
+            try:
+                self.chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+
+class QueueReader:
+    # file-like view of the queued chunks for the parquet conversion
+    def __init__(self, stream):
+        self.stream = stream
+        self.pending = b""
+        self.closed = False
+
+    def read(self, size=-1):
+        while size < 0 or len(self.pending) < size:
+            chunk = next(self.stream, None)
+            if chunk is None:
+                break
+            self.pending += chunk
+        if size < 0:
+            data, self.pending = self.pending, b""
+        else:
+            data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+
+def copy_query(cursor, table, start, end, classroom=None):
+    config = EXPORT_TABLES[table]
+    conditions = [f"{config['time_column']} >= %s", f"{config['time_column']} < %s"]
+    params = [start, end]
+    if classroom is not None and config["classroom_column"]:
+        conditions.append(f"{config['classroom_column']} = %s")
+        params.append(classroom)
+    select = cursor.mogrify(
+        f"SELECT * FROM {table} WHERE {' AND '.join(conditions)} ORDER BY {config['time_column']}",
+        params,
+    ).decode()
+    return f"COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER true)"
+
+
+class CopyStream:
+    # iterates the CSV bytes of one COPY ... TO STDOUT. the copy runs on its
+    # own thread and blocks whenever QUEUE_CHUNKS chunks are waiting; closing
+    # the stream cancels it and gives the connection back
+    def __init__(self, pool, table, start, end, classroom=None):
+        self.pool = pool
+        self.chunks = queue.Queue(maxsize=QUEUE_CHUNKS)
+        self.cancelled = threading.Event()
+        self.finished = False
+
+        self.conn = pool.getconn()
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute(COLUMNS_QUERY, (table,))
+                self.columns = cursor.fetchall()
+                self.query = copy_query(cursor, table, start, end, classroom)
+            # the copy starts its own read-only transaction
+            self.conn.rollback()
+        except Exception as e:
+            broken = isinstance(e, psycopg2.OperationalError)
+            if not broken:
+                self.conn.rollback()
+            pool.putconn(self.conn, close=broken)
+            raise
+
+        self.thread = threading.Thread(target=self.run, name="table-export", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        writer = QueueWriter(self.chunks, self.cancelled)
+        broken = False
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute("SET TRANSACTION READ ONLY")
+                cursor.copy_expert(self.query, writer)
+            writer.flush()
+            self.conn.rollback()
+            writer.put(None)
+        except ExportCancelled:
+            # the connection may still be in COPY mode
+            broken = True
+        except Exception as e:
+            broken = True
+            logging.error("CopyStream: error exporting %s", e)
+            try:
+                writer.put(e)
+            except ExportCancelled:
+                pass
+        finally:
+            self.pool.putconn(self.conn, close=broken)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.finished:
+            raise StopIteration
+        chunk = self.chunks.get()
+        if chunk is None:
+            self.finished = True
+            raise StopIteration
+        if isinstance(chunk, Exception):
+            self.finished = True
+            raise chunk
+        return chunk
+
+    def close(self):
+        self.finished = True
+        self.cancelled.set()
+
+
+class ChunkSink:
+    # write-only file for the parquet writer whose bytes are handed out by
+    # drain() as soon as a row group is written
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def arrow_type(data_type):
+    import pyarrow as pa
+
+    if data_type in ("smallint", "integer", "bigint"):
+        return pa.int64()
+    if data_type in ("real", "double precision", "numeric"):
+        return pa.float64()
+    if data_type == "boolean":
+        return pa.bool_()
+    if data_type == "timestamp with time zone":
+        return pa.timestamp("us", tz="UTC")
+    if data_type.startswith("timestamp"):
+        return pa.timestamp("us")
+    return pa.string()
+
+
+def parquet_chunks(copy_stream):
+    # opens the CSV reader right away, so a missing pyarrow or an unreadable
+    # header fails before the response starts
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+
+    column_types = {name: arrow_type(data_type) for name, data_type in copy_stream.columns}
+    reader = pa_csv.open_csv(
+        QueueReader(copy_stream),
+        read_options=pa_csv.ReadOptions(block_size=1 << 20),
+        convert_options=pa_csv.ConvertOptions(
+            column_types=column_types,
+            timestamp_parsers=[pa_csv.ISO8601, "%Y-%m-%d %H:%M"],
+            true_values=["t", "true"],
+            false_values=["f", "false"],
+        ),
+    )
+    schema = pa.schema([(name, column_types[name]) for name in reader.schema.names])
+
+    def write_row_groups():
+        sink = ChunkSink()
+        writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema)
+        try:
+            batches = []
+            rows = 0
+            for batch in reader:
+                batches.append(batch)
+                rows += batch.num_rows
+                if rows >= PARQUET_ROW_GROUP_ROWS:
+                    writer.write_table(pa.Table.from_batches(batches, schema))
+                    batches, rows = [], 0
+                    yield sink.drain()
+            if batches:
+                writer.write_table(pa.Table.from_batches(batches, schema))
+        finally:
+            writer.close()
+        yield sink.drain()
+
+    return write_row_groups()
+
+
+class ExportStream:
+    # response iterable: releases the export slot and cancels the copy when
+    # werkzeug closes it
+    def __init__(self, copy_stream, chunks):
+        self.copy_stream = copy_stream
+        self.chunks = chunks
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.chunks)
+        except StopIteration:
+            self.close()
+            raise
+        except Exception as e:
+            logging.error("export_table: error while streaming %s", e)
+            self.close()
+            raise StopIteration
+
+    def close(self):
+        if self.copy_stream is not None:
+            self.copy_stream.close()
+            self.copy_stream = None
+            export_slots.release()
+
+
+def export_table(pool, table, start, end, output="csv", classroom=None):
+    if table not in EXPORT_TABLES:
+        raise ValueError(f"unknown table {table}")
+    if output not in EXPORT_FORMATS:
+        raise ValueError(f"unknown format {output}")
+    if not export_slots.acquire(blocking=False):
+        raise ExportBusyError(f"{EXPORT_MAX_CONCURRENT} exports are already running")
+
+    try:
+        copy_stream = CopyStream(pool, table, start, end, classroom)
+    except Exception:
+        export_slots.release()
+        raise
+
+    try:
+        chunks = parquet_chunks(copy_stream) if output == "parquet" else copy_stream
+    except Exception:
+        copy_stream.close()
+        export_slots.release()
+        raise
+    return ExportStream(copy_stream, chunks)
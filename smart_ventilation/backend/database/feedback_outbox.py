@@ -0,0 +1,221 @@
+import json
+import logging
+import threading
+
+import psycopg2
+import requests
+from requests.adapters import HTTPAdapter
+
+# feedback is committed to feedback_outbox together with feedback_tabelle, so
+# the /feedback request only waits for one local insert. the sender thread
+# delivers the rows to API_BASE_URL over one keep-alive session and retries
+# failed rows with exponential backoff.
+SCHEMA_QUERIES = [
+    """
+    CREATE TABLE IF NOT EXISTS feedback_outbox (
+        id BIGSERIAL PRIMARY KEY,
+        payload TEXT NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT now(),
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at TIMESTAMP NOT NULL DEFAULT now(),
+        delivered_at TIMESTAMP,
+        last_error TEXT
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS feedback_outbox_pending_idx
+    ON feedback_outbox (next_attempt_at) WHERE delivered_at IS NULL
+    """,
+]
+
+ENQUEUE_QUERY = "INSERT INTO feedback_outbox (payload) VALUES (%s) RETURNING id"
+
+# due rows are claimed in a short transaction by pushing next_attempt_at past
+# the time the sender needs to post them, so other senders skip them while no
+# connection is held during the requests. rows locked by a concurrent claim
+# are skipped as well
+CLAIM_QUERY = """
+    UPDATE feedback_outbox
+    SET next_attempt_at = now() + %s * INTERVAL '1 second'
+    WHERE id IN (
+        SELECT id FROM feedback_outbox
+        WHERE delivered_at IS NULL
+        AND next_attempt_at <= now()
+        AND attempts < %s
+        ORDER BY id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, payload
+"""
+
+RELEASE_QUERY = "UPDATE feedback_outbox SET next_attempt_at = now() WHERE id = ANY(%s)"
+
+DELIVERED_QUERY = """
+    UPDATE feedback_outbox
+    SET delivered_at = now(), attempts = attempts + 1, last_error = NULL
+    WHERE id = ANY(%s)
+"""
+
+FAILED_QUERY = """
+    UPDATE feedback_outbox
+    SET attempts = attempts + 1,
+        next_attempt_at = now() + LEAST(%s * power(2, attempts), %s) * INTERVAL '1 second',
+        last_error = %s
+    WHERE id = %s
+"""
+
+
+def ensure_outbox_schema(pool):
+    try:
+        with pool.connection() as conn:
+            with conn.cursor() as cursor:
+                for query in SCHEMA_QUERIES:
+                    cursor.execute(query)
+            conn.commit()
+        logging.info("feedback outbox is ready")
+    except Exception as e:
+        logging.error("ensure_outbox_schema: error creating feedback_outbox %s", e)
+
+
+def enqueue_feedback(cursor, feedback_data):
+    # runs inside the caller's transaction
+    cursor.execute(ENQUEUE_QUERY, (json.dumps(feedback_data),))
+    return cursor.fetchone()[0]
+
+
+class FeedbackSender:
+    def __init__(
+        self,
+        pool,
+        url,
+        headers,
+        batch_size=50,
+        interval=5.0,
+        timeout=10.0,
+        base_backoff=5.0,
+        max_backoff=600.0,
+        max_attempts=20,
+    ):
+        self.pool = pool
+        self.url = url
+        self.headers = headers
+        self.batch_size = batch_size
+        self.interval = interval
+        self.timeout = timeout
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.counters_lock = threading.Lock()
+        self.counters = {"delivered": 0, "failed": 0}
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="feedback-sender", daemon=True)
+        self.thread.start()
+
+    def wake(self):
+        # new feedback in this process, send it without waiting for the poll
+        self.wake_event.set()
+
+    def increment(self, name, amount=1):
+        with self.counters_lock:
+            self.counters[name] += amount
+
+    def get_counters(self):
+        with self.counters_lock:
+            return dict(self.counters)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            sent = self.send_pending()
+            if sent < self.batch_size:
+                self.wake_event.wait(self.interval)
+                self.wake_event.clear()
+
+    def post(self, payload):
+        try:
+            response = self.session.post(self.url, data=payload, timeout=self.timeout)
+        except requests.RequestException as e:
+            return str(e)
+        if response.status_code != 200:
+            return f"status {response.status_code}: {response.text[:200]}"
+        return None
+
+    def claim(self):
+        # the lease covers posting the whole batch with every request timing out
+        lease = self.batch_size * self.timeout + 60
+        with self.pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(CLAIM_QUERY, (lease, self.max_attempts, self.batch_size))
+                rows = sorted(cursor.fetchall())
+            conn.commit()
+        return rows
+
+    def record(self, delivered, failed, unsent):
+        with self.pool.connection() as conn:
+            with conn.cursor() as cursor:
+                if delivered:
+                    cursor.execute(DELIVERED_QUERY, (delivered,))
+                for outbox_id, error in failed:
+                    cursor.execute(
+                        FAILED_QUERY,
+                        (self.base_backoff, self.max_backoff, error, outbox_id),
+                    )
+                if unsent:
+                    cursor.execute(RELEASE_QUERY, (unsent,))
+            conn.commit()
+
+    def send_pending(self):
+        try:
+            rows = self.claim()
+        except psycopg2.OperationalError as e:
+            logging.error("send_pending: db connection error while reading the outbox %s", e)
+            return 0
+        except Exception as e:
+            logging.error("send_pending: error reading the outbox %s", e)
+            return 0
+
+        # no connection is held while posting
+        delivered, failed, unsent = [], [], []
+        for outbox_id, payload in rows:
+            if self.stop_event.is_set():
+                unsent.append(outbox_id)
+                continue
+            error = self.post(payload)
+            if error is None:
+                delivered.append(outbox_id)
+            else:
+                logging.warning("send_pending: feedback %s not delivered %s", outbox_id, error)
+                failed.append((outbox_id, error))
+
+        try:
+            self.record(delivered, failed, unsent)
+        except Exception as e:
+            # the claimed rows are retried once their lease ran out
+            logging.error(
+                "send_pending: error recording %d delivered and %d failed feedback rows %s",
+                len(delivered),
+                len(failed),
+                e,
+            )
+        self.increment("delivered", len(delivered))
+        self.increment("failed", len(failed))
+        return len(rows)
+
+    def stop(self, timeout=30):
+        self.stop_event.set()
+        self.wake_event.set()
+        if self.thread is not None and self.thread.is_alive():
+            self.thread.join(timeout)
+        self.session.close()
+        logging.info("feedback sender stopped %s", self.get_counters())
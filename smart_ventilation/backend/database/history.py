@@ -0,0 +1,149 @@
+import csv
+import io
+import json
+import threading
+import uuid
+
+import psycopg2
+
+from database.database_connection import PooledStream
+from database.rollups import ROLLUP_TABLES
+
+# aggregated history of a classroom over any range. buckets are computed in
+# SQL from the rollup tables, so every bucket is an exact average of the raw
+# rows without reading them. results are read from a named (server-side)
+# cursor in chunks and written to the response as they arrive, so memory
+# stays bounded by the chunk size however long the range is.
+
+# every running history holds a pooled connection until its client has read
+# the whole response, so only a few may run at once
+HISTORY_MAX_CONCURRENT = 4
+history_slots = threading.BoundedSemaphore(HISTORY_MAX_CONCURRENT)
+
+HISTORY_COLUMNS = ["time", "co2", "temperature", "humidity", "samples"]
+
+MAX_BUCKET_MINUTES = 31 * 24 * 60
+
+# buckets are aligned to multiples of their length since the epoch of the
+# stored (local) timestamps, so day buckets start at local midnight
+class HistoryBusyError(Exception):
+    pass
+
+
+HISTORY_QUERY = """
+    SELECT
+        to_timestamp(
+            floor(extract(epoch FROM bucket) / %(seconds)s) * %(seconds)s
+        ) AT TIME ZONE 'UTC' AS bucket_start,
+        SUM(co2_sum) / NULLIF(SUM(sample_count), 0) AS co2,
+        SUM(temperature_sum) / NULLIF(SUM(sample_count), 0) AS temperature,
+        SUM(humidity_sum) / NULLIF(SUM(sample_count), 0) AS humidity,
+        SUM(sample_count) AS samples
+    FROM {table}
+    WHERE classroom_number = %(classroom)s
+    AND bucket >= CAST(%(start)s AS timestamp)
+    AND bucket < CAST(%(end)s AS timestamp)
+    GROUP BY 1
+    ORDER BY 1
+"""
+
+
+def rollup_table(bucket_minutes):
+    # whole hours are summed from the hourly rollup, anything else from the
+    # minutely one. with hour buckets, start and end are effectively rounded
+    # up to whole hours
+    if bucket_minutes % 60 == 0:
+        return ROLLUP_TABLES["hour"]
+    return ROLLUP_TABLES["minute"]
+
+
+def format_row(row):
+    bucket_start, co2, temperature, humidity, samples = row
+    return [
+        bucket_start.strftime("%Y-%m-%d %H:%M"),
+        None if co2 is None else round(float(co2), 2),
+        None if temperature is None else round(float(temperature), 2),
+        None if humidity is None else round(float(humidity), 2),
+        int(samples),
+    ]
+
+
+def json_chunks(cursor, header, chunk_size):
+    yield json.dumps(header)[:-1] + ', "rows": ['
+    first = True
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        chunk = ",".join(json.dumps(format_row(row)) for row in rows)
+        yield chunk if first else "," + chunk
+        first = False
+    yield "]}"
+
+
+def csv_chunks(cursor, header, chunk_size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(HISTORY_COLUMNS)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        writer.writerows(format_row(row) for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+STREAM_FORMATS = {"json": json_chunks, "csv": csv_chunks}
+
+
+def stream_history(pool, classroom, start, end, bucket_minutes=60, output="json", chunk_size=2000):
+    # runs the query before returning, so errors surface before the response
+    # starts. the returned stream holds the connection until it is exhausted
+    # or closed
+    if output not in STREAM_FORMATS:
+        raise ValueError(f"unknown format {output}")
+    if not 1 <= bucket_minutes <= MAX_BUCKET_MINUTES:
+        raise ValueError(f"bucket must be between 1 and {MAX_BUCKET_MINUTES} minutes")
+
+    if not history_slots.acquire(blocking=False):
+        raise HistoryBusyError(f"{HISTORY_MAX_CONCURRENT} history requests are already running")
+
+    try:
+        conn = pool.getconn()
+    except Exception:
+        history_slots.release()
+        raise
+    try:
+        cursor = conn.cursor(name=f"history_{uuid.uuid4().hex}")
+        cursor.itersize = chunk_size
+        cursor.execute(
+            HISTORY_QUERY.format(table=rollup_table(bucket_minutes)),
+            {
+                "seconds": bucket_minutes * 60,
+                "classroom": classroom,
+                "start": start,
+                "end": end,
+            },
+        )
+    except Exception as e:
+        broken = isinstance(e, psycopg2.OperationalError)
+        if not broken:
+            conn.rollback()
+        pool.putconn(conn, close=broken)
+        history_slots.release()
+        raise
+
+    header = {
+        "classroom": classroom,
+        "start": start,
+        "end": end,
+        "bucket_minutes": bucket_minutes,
+        "columns": HISTORY_COLUMNS,
+    }
+    chunks = STREAM_FORMATS[output](cursor, header, chunk_size)
+    return PooledStream(
+        pool, conn, chunks, name="stream_history", on_close=history_slots.release
+    )
@@ -0,0 +1,118 @@
+import json
+import logging
+
+from psycopg2.extras import execute_values
+
+from database.sensor_writer import BatchWriter
+from helpers.metrics import registry
+
+# every periodic prediction is kept in prediction_history together with the
+# features it was computed from and the versions of the models that made it,
+# so model behavior can be audited after the in-memory copy is cleared. rows
+# are written behind the prediction thread in batches, like sensor rows.
+
+SCHEMA_QUERIES = [
+    """
+    CREATE TABLE IF NOT EXISTS prediction_history (
+        id UUID PRIMARY KEY,
+        classroom_number TEXT NOT NULL,
+        predicted_at TIMESTAMP NOT NULL,
+        predictions JSONB NOT NULL,
+        features JSONB NOT NULL,
+        model_versions JSONB NOT NULL
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS prediction_history_classroom_time_idx
+    ON prediction_history (classroom_number, predicted_at DESC)
+    """,
+]
+
+# the id makes a retried batch harmless
+INSERT_QUERY = """
+    INSERT INTO prediction_history
+    (id, classroom_number, predicted_at, predictions, features, model_versions)
+    VALUES %s
+    ON CONFLICT (id) DO NOTHING
+"""
+
+HISTORY_QUERY = """
+    SELECT id, predicted_at, predictions, features, model_versions
+    FROM prediction_history
+    WHERE classroom_number = %s
+    AND predicted_at >= CAST(%s AS timestamp)
+    AND predicted_at < CAST(%s AS timestamp)
+    ORDER BY predicted_at DESC
+    LIMIT %s
+"""
+
+MAX_HISTORY_ROWS = 10000
+
+INSERTED_PREDICTIONS = registry.counter(
+    "smart_ventilation_db_inserted_predictions", "Predictions written to prediction_history."
+)
+
+
+def ensure_prediction_schema(pool):
+    try:
+        with pool.connection() as conn:
+            with conn.cursor() as cursor:
+                for query in SCHEMA_QUERIES:
+                    cursor.execute(query)
+            conn.commit()
+        logging.info("prediction history is ready")
+    except Exception as e:
+        logging.error("ensure_prediction_schema: error creating prediction_history %s", e)
+
+
+def to_json(values):
+    # model outputs and features are numpy scalars
+    return json.dumps(
+        {name: value.item() if hasattr(value, "item") else value for name, value in values.items()}
+    )
+
+
+def prediction_row(classroom, predicted_at, predictions, features, model_versions):
+    outputs = {
+        name: value for name, value in predictions.items() if name not in ("id", "prediction_time")
+    }
+    return (
+        predictions["id"],
+        classroom,
+        predicted_at,
+        to_json(outputs),
+        to_json(features),
+        json.dumps(model_versions),
+    )
+
+
+class PredictionWriter(BatchWriter):
+    # rows come from prediction_row
+    thread_name = "prediction-writer"
+    inserted_rows = INSERTED_PREDICTIONS
+
+    def write_batch(self, cursor, batch):
+        execute_values(cursor, INSERT_QUERY, batch, page_size=len(batch))
+
+
+def fetch_prediction_history(pool, classroom, start, end, limit=1000):
+    # newest first, served from the (classroom, time) index
+    if not 1 <= limit <= MAX_HISTORY_ROWS:
+        raise ValueError(f"limit must be between 1 and {MAX_HISTORY_ROWS}")
+
+    with pool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(HISTORY_QUERY, (classroom, start, end, limit))
+            rows = cursor.fetchall()
+        conn.commit()
+
+    return [
+        {
+            "id": str(prediction_id),
+            "predicted_at": predicted_at.strftime("%Y-%m-%d %H:%M:%S"),
+            "predictions": predictions,
+            "features": features,
+            "model_versions": model_versions,
+        }
+        for prediction_id, predicted_at, predictions, features, model_versions in rows
+    ]
@@ -0,0 +1,166 @@
+import logging
+import sys
+
+from psycopg2.extras import execute_values
+
+from database.database_connection import load_config, connect_to_database
+
+# per-minute and per-hour sums and counts of classroom_environmental_data.
+# sums are kept instead of averages so that buckets can be extended by every
+# write batch and averages over any range of buckets stay exact.
+ROLLUP_TABLES = {
+    "minute": "classroom_environmental_data_minutely",
+    "hour": "classroom_environmental_data_hourly",
+}
+
+SCHEMA_QUERIES = [
+    """
+    CREATE INDEX IF NOT EXISTS classroom_environmental_data_classroom_timestamp_idx
+    ON classroom_environmental_data (classroom_number, timestamp)
+    """,
+] + [
+    f"""
+    CREATE TABLE IF NOT EXISTS {table} (
+        classroom_number TEXT NOT NULL,
+        bucket TIMESTAMP NOT NULL,
+        co2_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+        temperature_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+        humidity_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+        sample_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (classroom_number, bucket)
+    )
+    """
+    for table in ROLLUP_TABLES.values()
+]
+
+UPSERT_QUERY = """
+    INSERT INTO {table}
+    (classroom_number, bucket, co2_sum, temperature_sum, humidity_sum, sample_count)
+    VALUES %s
+    ON CONFLICT (classroom_number, bucket) DO UPDATE SET
+        co2_sum = {table}.co2_sum + EXCLUDED.co2_sum,
+        temperature_sum = {table}.temperature_sum + EXCLUDED.temperature_sum,
+        humidity_sum = {table}.humidity_sum + EXCLUDED.humidity_sum,
+        sample_count = {table}.sample_count + EXCLUDED.sample_count
+"""
+
+REFRESH_QUERY = """
+    INSERT INTO {table}
+    (classroom_number, bucket, co2_sum, temperature_sum, humidity_sum, sample_count)
+    SELECT
+        classroom_number,
+        date_trunc('{unit}', timestamp) AS bucket,
+        SUM(co2_values),
+        SUM(temperature),
+        SUM(humidity),
+        COUNT(*)
+    FROM classroom_environmental_data
+    WHERE timestamp >= date_trunc('{unit}', CAST(%(since)s AS timestamp))
+    AND timestamp < date_trunc('{unit}', CAST(%(through)s AS timestamp)) + INTERVAL '1 {unit}'
+    AND (CAST(%(classrooms)s AS TEXT[]) IS NULL OR classroom_number = ANY(%(classrooms)s))
+    GROUP BY classroom_number, date_trunc('{unit}', timestamp)
+    ON CONFLICT (classroom_number, bucket) DO UPDATE SET
+        co2_sum = EXCLUDED.co2_sum,
+        temperature_sum = EXCLUDED.temperature_sum,
+        humidity_sum = EXCLUDED.humidity_sum,
+        sample_count = EXCLUDED.sample_count
+"""
+
+# the writer extends buckets under the shared lock, a refresh overwrites
+# them under the exclusive one, so a refresh never races a write batch
+ROLLUP_LOCK_KEY = 7401001
+SHARED_LOCK_QUERY = "SELECT pg_advisory_xact_lock_shared(%s)"
+EXCLUSIVE_LOCK_QUERY = "SELECT pg_advisory_xact_lock(%s)"
+
+# average of the buckets in (start, start + window minutes]
+WINDOW_QUERY = """
+    SELECT
+        SUM(co2_sum) / NULLIF(SUM(sample_count), 0) AS co2_values,
+        SUM(temperature_sum) / NULLIF(SUM(sample_count), 0) AS temperature,
+        SUM(humidity_sum) / NULLIF(SUM(sample_count), 0) AS humidity
+    FROM classroom_environmental_data_minutely
+    WHERE classroom_number = %s
+    AND bucket > CAST(%s AS timestamp)
+    AND bucket <= CAST(%s AS timestamp) + %s * INTERVAL '1 minute';
+"""
+
+
+def ensure_rollup_schema(pool):
+    try:
+        with pool.connection() as conn:
+            with conn.cursor() as cursor:
+                for query in SCHEMA_QUERIES:
+                    cursor.execute(query)
+            conn.commit()
+        logging.info("rollup tables are ready")
+    except Exception as e:
+        logging.error("ensure_rollup_schema: error creating rollup tables %s", e)
+
+
+def bucket_key(timestamp, unit):
+    # sensor rows carry "%Y-%m-%d %H:%M" strings, so buckets are prefixes
+    timestamp = str(timestamp)
+    if unit == "minute":
+        return timestamp[:16]
+    return timestamp[:13] + ":00"
+
+
+def update_rollups(cursor, rows):
+    # rows are (timestamp, co2, temperature, humidity, classroom) tuples of one
+    # write batch; runs inside the transaction that inserts the raw rows
+    cursor.execute(SHARED_LOCK_QUERY, (ROLLUP_LOCK_KEY,))
+    for unit, table in ROLLUP_TABLES.items():
+        buckets = {}
+        for timestamp, co2, temperature, humidity, classroom in rows:
+            key = (classroom, bucket_key(timestamp, unit))
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = [co2, temperature, humidity, 1]
+            else:
+                bucket[0] += co2
+                bucket[1] += temperature
+                bucket[2] += humidity
+                bucket[3] += 1
+
+        values = [(classroom, bucket, *sums) for (classroom, bucket), sums in buckets.items()]
+        execute_values(
+            cursor, UPSERT_QUERY.format(table=table), values, page_size=len(values)
+        )
+
+
+def refresh_rollups(conn, since, through=None, classrooms=None):
+    # rebuilds the buckets from `since` up to and including the bucket of
+    # `through` (default: all of them) of the given classrooms (default: all),
+    # e.g. after rows were imported without going through the sensor writer.
+    # write batches wait until the refresh is committed
+    params = {
+        "since": since,
+        "through": through or "infinity",
+        "classrooms": list(classrooms) if classrooms else None,
+    }
+    with conn.cursor() as cursor:
+        cursor.execute(EXCLUSIVE_LOCK_QUERY, (ROLLUP_LOCK_KEY,))
+        for unit, table in ROLLUP_TABLES.items():
+            cursor.execute(REFRESH_QUERY.format(table=table, unit=unit), params)
+    conn.commit()
+
+
+def fetch_window_average(conn, classroom, start, window_minutes):
+    with conn.cursor() as cursor:
+        cursor.execute(WINDOW_QUERY, (classroom, start, start, window_minutes))
+        return cursor.fetchone()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    since = sys.argv[1] if len(sys.argv) > 1 else "1970-01-01 00:00"
+    classrooms = sys.argv[2:] or None
+    conn = connect_to_database(load_config("config/db_config.yaml"))
+    if conn is not None:
+        for query in SCHEMA_QUERIES:
+            with conn.cursor() as cursor:
+                cursor.execute(query)
+        conn.commit()
+        refresh_rollups(conn, since, classrooms=classrooms)
+        conn.close()
+        logging.info("rollups refreshed since %s", since)
@@ -0,0 +1,194 @@
+import abc
+import logging
+import queue
+import threading
+import time
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from database.rollups import update_rollups
+from helpers.metrics import registry
+
+INSERT_SECONDS = registry.histogram(
+    "smart_ventilation_db_insert_seconds",
+    "Duration of one sensor batch insert including the rollups.",
+)
+INSERTED_ROWS = registry.counter(
+    "smart_ventilation_db_inserted_rows", "Sensor rows written to the database."
+)
+
+INSERT_QUERY = """
+    INSERT INTO classroom_environmental_data
+    (timestamp, co2_values, temperature, humidity, classroom_number)
+    VALUES %s
+"""
+
+
+# write-behind queue: rows are written by write_batch with one commit per
+# batch, flushed when the batch reaches batch_size rows or its oldest row is
+# max_delay seconds old. subclasses provide the insert.
+class BatchWriter(abc.ABC):
+    thread_name = "batch-writer"
+    insert_seconds = None
+    inserted_rows = None
+
+    def __init__(self, pool, batch_size=500, max_delay=5.0, max_queue_size=10000):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.counters_lock = threading.Lock()
+        self.counters = {"queued": 0, "flushed": 0, "dropped": 0}
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name=self.thread_name, daemon=True)
+        self.thread.start()
+
+    def enqueue(self, row):
+        try:
+            self.queue.put_nowait(row)
+            self.increment("queued")
+            return True
+        except queue.Full:
+            self.increment("dropped")
+            logging.warning("enqueue: write queue is full, dropping row %s", row)
+            return False
+
+    def increment(self, name, amount=1):
+        with self.counters_lock:
+            self.counters[name] += amount
+
+    def get_counters(self):
+        with self.counters_lock:
+            counters = dict(self.counters)
+        counters["pending"] = self.queue.qsize()
+        return counters
+
+    def run(self):
+        while not self.stop_event.is_set():
+            batch = self.collect_batch()
+            if batch:
+                self.flush_batch(batch)
+
+        # drain whatever is left once stop() was requested
+        batch = self.drain()
+        while batch:
+            self.flush_batch(batch)
+            batch = self.drain()
+
+    def collect_batch(self):
+        try:
+            first_row = self.queue.get(timeout=self.max_delay)
+        except queue.Empty:
+            return []
+
+        batch = [first_row]
+        deadline = time.monotonic() + self.max_delay
+
+        while len(batch) < self.batch_size and not self.stop_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def drain(self):
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    @abc.abstractmethod
+    def write_batch(self, cursor, batch):
+        # inserts the batch with cursor, the caller commits
+        pass
+
+    def flushed(self, batch):
+        pass
+
+    def flush_batch(self, batch, retry=True):
+        try:
+            started = time.perf_counter()
+            with self.pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    self.write_batch(cursor, batch)
+                conn.commit()
+            if registry.enabled:
+                if self.insert_seconds is not None:
+                    self.insert_seconds.observe(time.perf_counter() - started)
+                if self.inserted_rows is not None:
+                    self.inserted_rows.inc(len(batch))
+            self.increment("flushed", len(batch))
+            logging.debug("flush_batch: %s wrote %d rows", self.thread_name, len(batch))
+
+        except psycopg2.OperationalError as e:
+            logging.error("flush_batch: %s lost the db connection while writing %s", self.thread_name, e)
+            if retry:
+                self.flush_batch(batch, retry=False)
+            else:
+                self.increment("dropped", len(batch))
+            return
+
+        except Exception as e:
+            logging.error("flush_batch: %s failed writing %d rows %s", self.thread_name, len(batch), e)
+            self.increment("dropped", len(batch))
+            return
+
+        # the rows are committed, a failing callback must not count them as dropped
+        try:
+            self.flushed(batch)
+        except Exception as e:
+            logging.error("flush_batch: %s error after writing %s", self.thread_name, e)
+
+    def stop(self, timeout=30):
+        self.stop_event.set()
+        if self.thread is not None and self.thread.is_alive():
+            self.thread.join(timeout)
+            if self.thread.is_alive():
+                logging.warning("stop: %s did not finish flushing in time", self.thread_name)
+        else:
+            batch = self.drain()
+            while batch:
+                self.flush_batch(batch)
+                batch = self.drain()
+        logging.info("%s stopped %s", self.thread_name, self.get_counters())
+
+
+# classroom_environmental_data rows; the per-minute and per-hour rollups are
+# extended in the same transaction
+class SensorDataWriter(BatchWriter):
+    thread_name = "sensor-writer"
+    insert_seconds = INSERT_SECONDS
+    inserted_rows = INSERTED_ROWS
+
+    def __init__(self, pool, batch_size=500, max_delay=5.0, max_queue_size=10000, on_flush=None):
+        super().__init__(pool, batch_size, max_delay, max_queue_size)
+        self.on_flush = on_flush
+
+    def write_batch(self, cursor, batch):
+        execute_values(cursor, INSERT_QUERY, batch, page_size=len(batch))
+        update_rollups(cursor, batch)
+
+    def flushed(self, batch):
+        if self.on_flush is None:
+            return
+        latest_timestamps = {}
+        for row in batch:
+            classroom = row[4]
+            if classroom not in latest_timestamps or row[0] > latest_timestamps[classroom]:
+                latest_timestamps[classroom] = row[0]
+        for classroom, timestamp in latest_timestamps.items():
+            self.on_flush(classroom, timestamp)
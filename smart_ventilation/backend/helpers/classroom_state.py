@@ -0,0 +1,62 @@
+import threading
+import time
+
+from helpers.metrics import registry
+from helpers.ring_buffer import SensorRingBuffer
+
+LOCK_WAIT_SECONDS = registry.histogram(
+    "smart_ventilation_classroom_lock_wait_seconds",
+    "Time spent waiting for a classroom lock to collect a reading.",
+)
+LOCK_HOLD_SECONDS = registry.histogram(
+    "smart_ventilation_classroom_lock_hold_seconds",
+    "Time a classroom lock is held to collect a reading.",
+)
+
+
+def build_combined_data(latest_time, latest_values, latest_predictions):
+    # latest reading per metric in the shape the templates expect
+    # (a list per key whose last element is the current value)
+    combined_data = {}
+    if latest_values:
+        if latest_time is not None:
+            combined_data["time"] = [latest_time]
+        for key, value in latest_values.items():
+            combined_data[key] = [value]
+    if latest_predictions:
+        combined_data["predictions"] = latest_predictions
+    return combined_data
+
+
+# in-memory state of one classroom. every classroom has its own lock so
+# messages and predictions for one room never wait on another room.
+class ClassroomState:
+    def __init__(self, classroom, capacity, retention):
+        self.classroom = classroom
+        self.lock = threading.Lock()
+        self.sensor_buffer = SensorRingBuffer(capacity=capacity, retention=retention)
+        self.latest_values = {}
+        self.latest_time = None
+        self.latest_predictions = {}
+        self.latest_features = {}
+        self.predictions_cleared = False
+
+    def collect(self, timestamp, values):
+        if not registry.enabled:
+            with self.lock:
+                self.sensor_buffer.append(timestamp, values)
+                self.latest_values.update(values)
+            return
+
+        started = time.perf_counter()
+        with self.lock:
+            acquired = time.perf_counter()
+            self.sensor_buffer.append(timestamp, values)
+            self.latest_values.update(values)
+        LOCK_HOLD_SECONDS.observe(time.perf_counter() - acquired)
+        LOCK_WAIT_SECONDS.observe(acquired - started)
+
+    def combined_data(self):
+        return build_combined_data(
+            self.latest_time, self.latest_values, self.latest_predictions
+        )
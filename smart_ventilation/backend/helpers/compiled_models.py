@@ -0,0 +1,190 @@
+import logging
+import os
+import struct
+import threading
+import time
+import zipfile
+
+import numpy as np
+
+from helpers.startup import startup_timer
+
+# runtime for the .npz artifacts written by export_compiled_models in
+# ml-models/models.py. scoring only needs numpy, so the server does not have
+# to import sklearn or imblearn, and a batch of rows is scored in one call.
+#
+# np.savez stores its members uncompressed, so the arrays are memory-mapped
+# straight out of the archive instead of being read. every process that
+# loads the same artifact shares one page-cache copy of the forest, and
+# models are only loaded on their first prediction.
+
+# size of the fixed part of a zip local file header, followed by the file
+# name and the extra field
+LOCAL_HEADER_SIZE = 30
+
+ARRAY_HEADER_READERS = {
+    (1, 0): np.lib.format.read_array_header_1_0,
+    (2, 0): np.lib.format.read_array_header_2_0,
+}
+
+
+class CompiledLogisticRegression:
+    def __init__(self, artifact):
+        self.impute_values = artifact["impute_values"]
+        self.weights = artifact["weights"]
+        self.bias = artifact["bias"]
+        self.classes = artifact["classes"]
+
+    def decision_function(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        X = np.where(np.isnan(X), self.impute_values, X)
+        return X @ self.weights + self.bias
+
+    def predict(self, X):
+        scores = self.decision_function(X)
+        if scores.shape[1] == 1:
+            return self.classes[(scores[:, 0] > 0).astype(np.int64)]
+        return self.classes[np.argmax(scores, axis=1)]
+
+
+class CompiledRandomForest:
+    def __init__(self, artifact):
+        self.roots = artifact["roots"]
+        self.feature = artifact["feature"]
+        self.threshold = artifact["threshold"]
+        self.children_left = artifact["children_left"]
+        self.children_right = artifact["children_right"]
+        self.value = artifact["value"]
+        self.max_depth = int(artifact["max_depth"])
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        rows = np.arange(X.shape[0])[:, None]
+        # one node index per (sample, tree); leaves point to themselves
+        nodes = np.broadcast_to(self.roots, (X.shape[0], len(self.roots)))
+        for _ in range(self.max_depth):
+            go_left = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(
+                go_left, self.children_left[nodes], self.children_right[nodes]
+            )
+        return self.value[nodes].mean(axis=1)
+
+
+COMPILED_MODEL_TYPES = {
+    "logistic_regression": CompiledLogisticRegression,
+    "random_forest_regressor": CompiledRandomForest,
+}
+
+
+def mmap_npz(filename):
+    # {name: array} of an .npz archive. members that are stored uncompressed
+    # are memory-mapped read-only, scalars, object arrays and compressed
+    # members are read into memory as np.load would
+    arrays = {}
+    with zipfile.ZipFile(filename) as archive, open(filename, "rb") as file:
+        for info in archive.infolist():
+            name = info.filename[: -len(".npy")]
+            if info.compress_type == zipfile.ZIP_STORED:
+                file.seek(info.header_offset)
+                local_header = file.read(LOCAL_HEADER_SIZE)
+                name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+                file.seek(info.header_offset + LOCAL_HEADER_SIZE + name_length + extra_length)
+                version = np.lib.format.read_magic(file)
+                read_header = ARRAY_HEADER_READERS.get(version)
+                shape, fortran_order, dtype = read_header(file) if read_header else ((), False, None)
+                if shape and not dtype.hasobject:
+                    arrays[name] = np.memmap(
+                        filename,
+                        dtype=dtype,
+                        mode="r",
+                        offset=file.tell(),
+                        shape=shape,
+                        order="F" if fortran_order else "C",
+                    )
+                    continue
+            with archive.open(info) as member:
+                arrays[name] = np.lib.format.read_array(member)
+    return arrays
+
+
+def load_compiled_model(filename, mmap=True):
+    if mmap:
+        artifact = mmap_npz(filename)
+    else:
+        with np.load(filename) as npz:
+            artifact = {key: npz[key] for key in npz.files}
+    return COMPILED_MODEL_TYPES[str(artifact["kind"])](artifact)
+
+
+def load_model(basename, name):
+    # prefers the compiled .npz artifact and only falls back to unpickling
+    # the sklearn pipeline when none was exported
+    if os.path.exists(basename + ".npz"):
+        return load_compiled_model(basename + ".npz")
+
+    import joblib
+
+    logging.warning("no compiled artifact for %s, loading the pickle", name)
+    # arrays of pickles written by joblib.dump are memory-mapped as well
+    return joblib.load(basename + ".pkl", mmap_mode="r")
+
+
+class ModelUnavailableError(Exception):
+    pass
+
+
+class LazyModel:
+    # stands in for a model until its first prediction. a failed load is
+    # remembered and only retried after a backoff that doubles up to
+    # max_retry_interval, so a missing artifact is logged once per retry
+    # instead of on every prediction
+    def __init__(self, basename, name, retry_interval=60, max_retry_interval=3600):
+        self.basename = basename
+        self.name = name
+        self.model = None
+        self.lock = threading.Lock()
+        self.error = None
+        self.retry_at = 0.0
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.next_retry_interval = retry_interval
+
+    def load(self):
+        if self.model is None:
+            with self.lock:
+                if self.model is None:
+                    if self.error is not None and time.monotonic() < self.retry_at:
+                        raise ModelUnavailableError(f"{self.name} is unavailable: {self.error}")
+                    try:
+                        with startup_timer.phase("models"):
+                            self.model = load_model(self.basename, self.name)
+                    except Exception as e:
+                        self.error = e
+                        self.retry_at = time.monotonic() + self.next_retry_interval
+                        logging.error(
+                            "load: error loading %s, retrying in %d s %s",
+                            self.name,
+                            self.next_retry_interval,
+                            e,
+                        )
+                        self.next_retry_interval = min(
+                            self.next_retry_interval * 2, self.max_retry_interval
+                        )
+                        raise ModelUnavailableError(f"{self.name} is unavailable: {e}") from e
+                    self.error = None
+                    self.next_retry_interval = self.retry_interval
+                    logging.info("loaded %s from %s", self.name, self.basename)
+        return self.model
+
+    def predict(self, X):
+        return self.load().predict(X)
+
+
+def load_models(directory, names, lazy=True):
+    # missing artifacts only raise once the model is used, so one missing
+    # model does not keep the others from serving
+    models = {}
+    for name in names:
+        basename = f"{directory}/{name.replace(' ', '_')}"
+        models[name] = LazyModel(basename, name) if lazy else load_model(basename, name)
+    return models
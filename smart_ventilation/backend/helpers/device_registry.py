@@ -0,0 +1,58 @@
+APPLICATION_ID = "f4994b60-cc34-4cb5-b77c-dc9a5f9de541"
+
+# the sensors of classroom 10c, used when the config does not define DEVICES.
+# "store" marks the device whose complete readings are written to
+# classroom_environmental_data and whose uplink time is the classroom time.
+DEFAULT_DEVICES = {
+    # for Co2, temperature, etc.
+    "0004a30b01045883": {
+        "classrooms": ["10c"],
+        "metrics": ["humidity", "temperature", "co2"],
+        "store": True,
+    },
+    # for datetime and TVOC
+    "24e124707c481005": {
+        "classrooms": ["10c"],
+        "metrics": ["tvoc"],
+    },
+    # for outdoor temperature
+    "647fda000000aa92": {
+        "classrooms": ["10c"],
+        "metrics": ["ambient_temp"],
+    },
+}
+
+
+def load_device_registry(config):
+    # DEVICES in api_config.yaml maps a device EUI to the classrooms it
+    # reports for, e.g.
+    #   DEVICES:
+    #     0004a30b01045883: {classroom: "10c", metrics: [co2, temperature, humidity], store: true}
+    #     647fda000000aa92: {classrooms: ["10c", "9a"], metrics: [ambient_temp]}
+    devices = config.get("DEVICES") or DEFAULT_DEVICES
+    application_id = config.get("APPLICATION_ID", APPLICATION_ID)
+
+    registry = {}
+    for dev_eui, device in devices.items():
+        classrooms = device.get("classrooms") or [device["classroom"]]
+        registry[str(dev_eui).lower()] = {
+            "application": device.get("application", application_id),
+            "classrooms": [str(classroom) for classroom in classrooms],
+            "metrics": list(device["metrics"]),
+            "store": bool(device.get("store", False)),
+        }
+    return registry
+
+
+def subscription_topics(registry):
+    # one wildcard per chirpstack application instead of one topic per device
+    applications = sorted({device["application"] for device in registry.values()})
+    return [f"application/{application}/device/+/event/up" for application in applications]
+
+
+def parse_device_eui(topic):
+    # application/<application id>/device/<dev eui>/event/up
+    parts = topic.split("/")
+    if len(parts) >= 6 and parts[2] == "device" and parts[4] == "event":
+        return parts[3].lower()
+    return None
@@ -0,0 +1,86 @@
+import json
+import queue
+import threading
+
+
+def to_json_value(value):
+    # numpy scalars from the models and the ring buffer
+    if hasattr(value, "item"):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def format_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=to_json_value)}\n\n"
+
+
+# fans server-sent events out to every subscriber of a channel (one channel
+# per classroom). every event is serialized once and the same string is put
+# into each subscriber queue, so a message costs one fan-out however many
+# dashboards are connected.
+class EventBroadcaster:
+    def __init__(self, max_queue_size=100, heartbeat=15, retry=5000):
+        self.max_queue_size = max_queue_size
+        self.heartbeat = heartbeat
+        self.retry = retry
+        self.lock = threading.Lock()
+        self.channels = {}
+        self.last_events = {}
+
+    def subscribe(self, channel):
+        subscriber = queue.Queue(maxsize=self.max_queue_size)
+        with self.lock:
+            self.channels.setdefault(channel, set()).add(subscriber)
+            # new dashboards start with the latest reading and prediction
+            for (event_channel, _), message in self.last_events.items():
+                if event_channel == channel:
+                    subscriber.put_nowait(message)
+        return subscriber
+
+    def unsubscribe(self, channel, subscriber):
+        with self.lock:
+            subscribers = self.channels.get(channel)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.channels[channel]
+
+    def publish(self, channel, event, data):
+        message = format_event(event, data)
+        with self.lock:
+            self.last_events[(channel, event)] = message
+            subscribers = list(self.channels.get(channel, ()))
+
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(message)
+            except queue.Full:
+                # a slow dashboard loses its oldest event instead of
+                # blocking ingest
+                try:
+                    subscriber.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    subscriber.put_nowait(message)
+                except queue.Full:
+                    pass
+
+    def subscriber_count(self, channel=None):
+        with self.lock:
+            if channel is not None:
+                return len(self.channels.get(channel, ()))
+            return sum(len(subscribers) for subscribers in self.channels.values())
+
+    def stream(self, channel):
+        subscriber = self.subscribe(channel)
+        try:
+            # tells EventSource how long to wait before reconnecting
+            yield f"retry: {self.retry}\n\n"
+            while True:
+                try:
+                    yield subscriber.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+        finally:
+            self.unsubscribe(channel, subscriber)
@@ -0,0 +1,68 @@
+import threading
+import time
+import uuid
+
+
+# tracks the newest timestamp written to classroom_environmental_data per
+# classroom so that requests for "data newer than T" can be answered or woken
+# without polling
+class FutureDataWaiter:
+    def __init__(self, token_ttl=600, max_tokens=1000):
+        self.condition = threading.Condition()
+        self.latest_timestamps = {}
+        self.token_ttl = token_ttl
+        self.max_tokens = max_tokens
+        self.tokens = {}
+        self.tokens_lock = threading.Lock()
+
+    def notify(self, classroom, timestamp):
+        with self.condition:
+            latest_timestamp = self.latest_timestamps.get(classroom)
+            if latest_timestamp is None or timestamp > latest_timestamp:
+                self.latest_timestamps[classroom] = timestamp
+                self.condition.notify_all()
+
+    def has_data_after(self, classroom, timestamp):
+        # None means nothing was written by this process yet, so only the
+        # database can tell
+        latest_timestamp = self.latest_timestamps.get(classroom)
+        if latest_timestamp is None:
+            return None
+        return latest_timestamp > timestamp
+
+    def wait_for(self, classroom, timestamp, timeout):
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: self.has_data_after(classroom, timestamp) is True,
+                timeout,
+            )
+
+    def register(self, classroom, timestamp):
+        token = uuid.uuid4().hex
+        now = time.monotonic()
+        with self.tokens_lock:
+            self.expire_tokens(now)
+            if len(self.tokens) >= self.max_tokens:
+                oldest_token = min(self.tokens, key=lambda key: self.tokens[key][2])
+                del self.tokens[oldest_token]
+            self.tokens[token] = (classroom, timestamp, now)
+        return token
+
+    def lookup(self, token):
+        with self.tokens_lock:
+            self.expire_tokens(time.monotonic())
+            entry = self.tokens.get(token)
+        return entry[:2] if entry else None
+
+    def release(self, token):
+        with self.tokens_lock:
+            self.tokens.pop(token, None)
+
+    def expire_tokens(self, now):
+        expired = [
+            token
+            for token, (_, _, created) in self.tokens.items()
+            if now - created > self.token_ttl
+        ]
+        for token in expired:
+            del self.tokens[token]
@@ -0,0 +1,91 @@
+import functools
+import json
+from datetime import datetime
+
+import pytz
+
+# decoding of ChirpStack uplinks on the MQTT thread. timestamps are parsed by
+# slicing the fixed ISO-8601 layout into epoch seconds, and the local
+# "%Y-%m-%d %H:%M" string is formatted once per epoch minute instead of once
+# per message. orjson is used when installed.
+try:
+    import orjson
+
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+BERLIN_TZ = pytz.timezone("Europe/Berlin")
+
+
+def days_from_civil(year, month, day):
+    # days since 1970-01-01 in the proleptic gregorian calendar
+    year -= month <= 2
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def parse_timestamp(raw_time):
+    # "2024-05-06T07:08:09.123456789+00:00" (or "Z") to epoch seconds,
+    # None if the string does not have that layout
+    try:
+        year = int(raw_time[0:4])
+        month = int(raw_time[5:7])
+        day = int(raw_time[8:10])
+        hour = int(raw_time[11:13])
+        minute = int(raw_time[14:16])
+        second = int(raw_time[17:19])
+        if raw_time[4] != "-" or raw_time[10] not in "Tt ":
+            return None
+
+        position = 19
+        fraction = 0.0
+        if raw_time[19:20] == ".":
+            position = 20
+            while position < len(raw_time) and raw_time[position].isdigit():
+                position += 1
+            fraction = float(raw_time[19:position])
+
+        zone = raw_time[position:]
+        if zone in ("Z", "z"):
+            offset = 0
+        elif len(zone) == 6 and zone[0] in "+-" and zone[3] == ":":
+            offset = int(zone[1:3]) * 3600 + int(zone[4:6]) * 60
+            if zone[0] == "-":
+                offset = -offset
+        else:
+            return None
+    except (TypeError, ValueError, IndexError):
+        return None
+
+    if not (1 <= month <= 12 and 1 <= day <= 31 and hour < 24 and minute < 60 and second < 61):
+        return None
+
+    return (
+        days_from_civil(year, month, day) * 86400
+        + hour * 3600
+        + minute * 60
+        + second
+        - offset
+        + fraction
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def format_minute(epoch_minute):
+    return datetime.fromtimestamp(epoch_minute * 60, BERLIN_TZ).strftime("%Y-%m-%d %H:%M")
+
+
+def decode_uplink(payload, metrics):
+    # returns (epoch seconds or None, rounded values of the device metrics)
+    message = loads(payload)
+    sensor_object = message.get("object") or {}
+    values = {}
+    for metric in metrics:
+        value = sensor_object.get(metric)
+        if value is not None:
+            values[metric] = round(value, 2)
+    return parse_timestamp(message.get("time")), values
@@ -0,0 +1,200 @@
+import bisect
+import threading
+import time
+
+# minimal prometheus-style registry. call sites check `registry.enabled`
+# before reading the clock, so a disabled registry costs one attribute lookup
+# per instrumented step. metrics are collected as plain families so the web
+# workers can merge their own with the snapshot published by ingest before
+# rendering the text format.
+
+DEFAULT_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Counter:
+    def __init__(self, label_values=()):
+        self.label_values = label_values
+        self.lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, label_names):
+        return [[f"{name}_total", dict(zip(label_names, self.label_values)), self.value]]
+
+
+class Histogram:
+    def __init__(self, label_values=(), buckets=DEFAULT_BUCKETS):
+        self.label_values = label_values
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, name, label_names):
+        labels = dict(zip(label_names, self.label_values))
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            samples.append([f"{name}_bucket", dict(labels, le=le), cumulative])
+        samples.append([f"{name}_sum", labels, total])
+        samples.append([f"{name}_count", labels, cumulative])
+        return samples
+
+
+class MetricFamily:
+    def __init__(self, registry, name, kind, documentation, label_names, factory):
+        self.registry = registry
+        self.name = name
+        self.kind = kind
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.factory = factory
+        self.children = {}
+        self.children_lock = threading.Lock()
+        if not self.label_names:
+            self.default = self.labels()
+
+    def labels(self, *label_values):
+        child = self.children.get(label_values)
+        if child is None:
+            with self.children_lock:
+                child = self.children.setdefault(label_values, self.factory(label_values))
+        return child
+
+    # shortcuts for metrics without labels
+    def inc(self, amount=1):
+        self.default.inc(amount)
+
+    def observe(self, value):
+        self.default.observe(value)
+
+    def collect(self):
+        samples = []
+        for child in list(self.children.values()):
+            samples.extend(child.samples(self.name, self.label_names))
+        return samples
+
+
+class GaugeFamily:
+    # values are read from a callback at scrape time, e.g. queue lengths
+    def __init__(self, name, documentation, label_names, callback):
+        self.name = name
+        self.kind = "gauge"
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.callback = callback
+
+    def collect(self):
+        return [
+            [self.name, dict(zip(self.label_names, label_values)), value]
+            for label_values, value in self.callback().items()
+        ]
+
+
+class MetricsRegistry:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.families = {}
+        self.lock = threading.Lock()
+
+    def register(self, family):
+        with self.lock:
+            self.families.setdefault(family.name, family)
+            return self.families[family.name]
+
+    def counter(self, name, documentation, label_names=()):
+        return self.register(
+            MetricFamily(self, name, "counter", documentation, label_names, Counter)
+        )
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(
+            MetricFamily(
+                self,
+                name,
+                "histogram",
+                documentation,
+                label_names,
+                lambda label_values: Histogram(label_values, buckets),
+            )
+        )
+
+    def gauge(self, name, documentation, callback, label_names=()):
+        return self.register(GaugeFamily(name, documentation, label_names, callback))
+
+    def collect(self, **constant_labels):
+        families = []
+        for family in list(self.families.values()):
+            try:
+                samples = family.collect()
+            except Exception:
+                continue
+            for sample in samples:
+                sample[1] = dict(constant_labels, **sample[1])
+            families.append(
+                {
+                    "name": family.name,
+                    "type": family.kind,
+                    "help": family.documentation,
+                    "samples": samples,
+                }
+            )
+        return families
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        f'{key}="{escape_label_value(value)}"' for key, value in labels.items()
+    ) + "}"
+
+
+def render(families):
+    # families of the same name from several processes are merged into one
+    # block so HELP and TYPE appear once
+    merged = {}
+    for family in families:
+        entry = merged.setdefault(
+            family["name"], {"type": family["type"], "help": family["help"], "samples": []}
+        )
+        entry["samples"].extend(family["samples"])
+
+    lines = []
+    for name, family in merged.items():
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for sample_name, labels, value in family["samples"]:
+            lines.append(f"{sample_name}{format_labels(labels)} {float(value)!r}")
+    return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+PROCESS_STARTED = time.time()
+
+registry.gauge(
+    "smart_ventilation_process_start_time_seconds",
+    "Start time of the process since the epoch.",
+    lambda: {(): PROCESS_STARTED},
+)
@@ -1,12 +1,10 @@
-from backend.mqtt_client import MQTTClient
+from mqtt_client import get_mqtt_client
 import logging
 
-mqtt_client = MQTTClient()
-mqtt_client.initialize()
 
 def get_data(timestamp):
     try:
-        return mqtt_client.fetch_data(timestamp)
+        return get_mqtt_client().fetch_data(timestamp)
     except Exception as e:
         logging.error("get_data: could not fetch data: %s", e)
         return {}
\ No newline at end of file
@@ -0,0 +1,284 @@
+import copy
+import glob
+import logging
+import os
+import re
+import threading
+from datetime import datetime
+
+import numpy as np
+import psycopg2
+
+from helpers.compiled_models import CompiledLogisticRegression
+
+# incremental updates of the logistic regression from feedback_tabelle. the
+# model is trained with plain SGD on the logistic loss in the standardized
+# feature space of the original scaler and written back as a regular compiled
+# artifact, so the server scores it like any exported model. every update is
+# saved as Logistic_Regression-v<version>.npz and swapped into the serving
+# models dict with a single assignment.
+
+# feedback_tabelle has no key of its own in older databases; a serial column
+# lets the updater remember the last row it consumed
+SCHEMA_QUERIES = [
+    "ALTER TABLE feedback_tabelle ADD COLUMN IF NOT EXISTS id BIGSERIAL",
+]
+
+FEEDBACK_QUERY = """
+    SELECT id, co2, temperature, humidity, outdoor_temperature, timestamp, accurate_prediction
+    FROM feedback_tabelle
+    WHERE id > %s
+    ORDER BY id
+    LIMIT %s
+"""
+
+VERSION_PATTERN = re.compile(r"-v(\d+)\.npz$")
+
+
+def ensure_feedback_id(pool):
+    try:
+        with pool.connection() as conn:
+            with conn.cursor() as cursor:
+                for query in SCHEMA_QUERIES:
+                    cursor.execute(query)
+            conn.commit()
+    except Exception as e:
+        logging.error("ensure_feedback_id: error preparing feedback_tabelle %s", e)
+
+
+def feedback_features(rows, feature_order):
+    # rows of FEEDBACK_QUERY to (ids, X, y). tvoc is not part of the feedback,
+    # so it is left NaN and imputed like a missing reading
+    ids = np.array([row[0] for row in rows], dtype=np.int64)
+    X = np.full((len(rows), len(feature_order)), np.nan)
+    y = np.empty(len(rows), dtype=np.int64)
+    columns = {name: index for index, name in enumerate(feature_order)}
+    for i, (_, co2, temperature, humidity, outdoor_temperature, timestamp, label) in enumerate(rows):
+        timestamp = datetime.strptime(str(timestamp)[:16], "%Y-%m-%d %H:%M")
+        X[i, columns["co2"]] = co2
+        X[i, columns["temperature"]] = temperature
+        X[i, columns["humidity"]] = humidity
+        X[i, columns["ambient_temp"]] = outdoor_temperature
+        X[i, columns["hour"]] = timestamp.hour
+        X[i, columns["day_of_week"]] = timestamp.weekday()
+        X[i, columns["month"]] = timestamp.month
+        y[i] = int(label)
+    return ids, X, y
+
+
+class OnlineLogisticRegression:
+    def __init__(self, artifact, learning_rate=0.01, alpha=0.0001):
+        self.impute_values = np.asarray(artifact["impute_values"], dtype=np.float64)
+        self.classes = np.asarray(artifact["classes"])
+        self.learning_rate = learning_rate
+        self.alpha = alpha
+        weights = np.asarray(artifact["weights"], dtype=np.float64)[:, 0]
+        bias = float(np.asarray(artifact["bias"]).reshape(-1)[0])
+
+        if "scaler_mean" in artifact:
+            self.mean = np.asarray(artifact["scaler_mean"], dtype=np.float64)
+            self.scale = np.asarray(artifact["scaler_scale"], dtype=np.float64)
+        else:
+            logging.warning("artifact has no scaler statistics, updating in raw feature space")
+            self.mean = np.zeros_like(weights)
+            self.scale = np.ones_like(weights)
+
+        # raw weights w and bias b back to the standardized space:
+        # x @ w + b == ((x - mean) / scale) @ (w * scale) + (b + mean @ w)
+        self.coef = weights * self.scale
+        self.intercept = bias + self.mean @ weights
+        self.version = int(artifact.get("version", 0))
+        self.samples_seen = int(artifact.get("samples_seen", 0))
+        self.feedback_id = int(artifact.get("feedback_id", 0))
+
+    def partial_fit(self, X, y, epochs=1, batch_size=32):
+        X = np.asarray(X, dtype=np.float64)
+        X = np.where(np.isnan(X), self.impute_values, X)
+        Z = (X - self.mean) / self.scale
+        target = (np.asarray(y) == self.classes[1]).astype(np.float64)
+
+        for _ in range(epochs):
+            for start in range(0, len(Z), batch_size):
+                Z_batch = Z[start : start + batch_size]
+                error = (
+                    1.0 / (1.0 + np.exp(-(Z_batch @ self.coef + self.intercept)))
+                    - target[start : start + batch_size]
+                )
+                # inverse scaling keeps late feedback from overwriting the model
+                step = self.learning_rate / np.sqrt(1.0 + self.samples_seen / 1000.0)
+                self.coef -= step * (Z_batch.T @ error / len(Z_batch) + self.alpha * self.coef)
+                self.intercept -= step * error.mean()
+                self.samples_seen += len(Z_batch)
+        return self
+
+    def to_artifact(self):
+        weights = self.coef / self.scale
+        return {
+            "kind": np.array("logistic_regression"),
+            "impute_values": self.impute_values,
+            "weights": weights[:, None],
+            "bias": np.array([self.intercept - self.mean @ weights]),
+            "classes": self.classes,
+            "scaler_mean": self.mean,
+            "scaler_scale": self.scale,
+            "version": np.array(self.version),
+            "samples_seen": np.array(self.samples_seen),
+            "feedback_id": np.array(self.feedback_id),
+        }
+
+
+def load_artifact(filename):
+    with np.load(filename) as artifact:
+        return {key: artifact[key] for key in artifact.files}
+
+
+def latest_version(directory, name):
+    versions = []
+    for filename in glob.glob(f"{directory}/{name}-v*.npz"):
+        match = VERSION_PATTERN.search(filename)
+        if match:
+            versions.append((int(match.group(1)), filename))
+    return max(versions) if versions else None
+
+
+def save_version(artifact, directory, name, keep_versions=10):
+    os.makedirs(directory, exist_ok=True)
+    filename = f"{directory}/{name}-v{int(artifact['version'])}.npz"
+    # np.savez appends .npz to names without it
+    temporary_filename = f"{filename}.tmp.npz"
+    np.savez(temporary_filename, **artifact)
+    os.replace(temporary_filename, filename)
+
+    versions = sorted(
+        int(VERSION_PATTERN.search(path).group(1))
+        for path in glob.glob(f"{directory}/{name}-v*.npz")
+        if VERSION_PATTERN.search(path)
+    )
+    # the new version is already saved, pruning may fail without undoing it
+    for version in versions[:-keep_versions]:
+        try:
+            os.remove(f"{directory}/{name}-v{version}.npz")
+        except OSError as e:
+            logging.warning("save_version: could not remove version %d %s", version, e)
+    return filename
+
+
+class OnlineModelUpdater:
+    def __init__(
+        self,
+        pool,
+        models,
+        model_name,
+        base_filename,
+        feature_order,
+        directory="ml-models/online",
+        interval=3600,
+        min_batch_size=20,
+        max_batch_size=5000,
+        keep_versions=10,
+        learning_rate=0.01,
+    ):
+        self.pool = pool
+        self.models = models
+        self.model_name = model_name
+        self.base_filename = base_filename
+        self.feature_order = feature_order
+        self.directory = directory
+        self.file_prefix = model_name.replace(" ", "_")
+        self.interval = interval
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.keep_versions = keep_versions
+        self.learning_rate = learning_rate
+        self.learner = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.pool.when_ready(ensure_feedback_id)
+
+        self.learner = self.load_learner()
+        if self.learner is None:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="online-updater", daemon=True)
+        self.thread.start()
+
+    def load_learner(self):
+        # continues from the newest saved version, or from the exported model
+        latest = latest_version(self.directory, self.file_prefix)
+        filename = latest[1] if latest else self.base_filename
+        if not os.path.exists(filename):
+            logging.warning("online updates disabled, %s does not exist", filename)
+            return None
+
+        artifact = load_artifact(filename)
+        if str(artifact.get("kind")) != "logistic_regression":
+            logging.warning("online updates disabled, %s is not a logistic regression", filename)
+            return None
+
+        learner = OnlineLogisticRegression(artifact, learning_rate=self.learning_rate)
+        if latest:
+            self.models[self.model_name] = CompiledLogisticRegression(artifact)
+            logging.info("serving %s version %d", self.model_name, learner.version)
+        return learner
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.update()
+            except Exception as e:
+                logging.error("run: online update failed %s", e)
+
+    def update(self):
+        try:
+            with self.pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(
+                        FEEDBACK_QUERY, (self.learner.feedback_id, self.max_batch_size)
+                    )
+                    rows = [row for row in cursor.fetchall() if None not in row]
+                conn.commit()
+        except psycopg2.OperationalError as e:
+            logging.error("update: db connection error while reading feedback %s", e)
+            return None
+        except Exception as e:
+            logging.error("update: error reading feedback %s", e)
+            return None
+
+        if len(rows) < self.min_batch_size:
+            logging.info("update: %d new feedback rows, waiting for %d", len(rows), self.min_batch_size)
+            return None
+
+        # the update is trained on a copy, so the serving learner and the
+        # newest file on disk only change together once the save succeeded
+        learner = copy.deepcopy(self.learner)
+        try:
+            ids, X, y = feedback_features(rows, self.feature_order)
+            learner.partial_fit(X, y)
+            learner.feedback_id = int(ids.max())
+            learner.version += 1
+
+            artifact = learner.to_artifact()
+            filename = save_version(artifact, self.directory, self.file_prefix, self.keep_versions)
+            model = CompiledLogisticRegression(artifact)
+        except Exception as e:
+            logging.error("update: error updating %s %s", self.model_name, e)
+            return None
+
+        self.learner = learner
+        # predict_classrooms picks the new model up with its next batch
+        self.models[self.model_name] = model
+        logging.info(
+            "update: %s version %d trained on %d feedback rows, saved to %s",
+            self.model_name,
+            learner.version,
+            len(rows),
+            filename,
+        )
+        return filename
+
+    def stop(self):
+        self.stop_event.set()
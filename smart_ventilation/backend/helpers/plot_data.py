@@ -0,0 +1,105 @@
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from helpers.message_decoding import format_minute
+
+# columnar, downsampled series for the charts on /plots. gaps are forward
+# filled like the former template loop, then every series is reduced to about
+# one point per pixel with largest-triangle-three-buckets, which keeps the
+# peaks that plain striding would drop.
+
+DEFAULT_WIDTH = 800
+MIN_WIDTH = 10
+MAX_WIDTH = 5000
+
+
+def forward_fill(values):
+    # NaN takes the last preceding reading, leading NaNs stay NaN
+    present = ~np.isnan(values)
+    index = np.where(present, np.arange(len(values)), 0)
+    np.maximum.accumulate(index, out=index)
+    # leading gaps point at row 0, which is NaN itself
+    return values[index]
+
+
+def lttb(x, y, threshold):
+    # indices of the points kept by largest-triangle-three-buckets. the first
+    # and last point are always kept, the others are split into threshold - 2
+    # buckets and each bucket keeps the point that spans the largest triangle
+    # with the previously kept point and the mean of the next bucket
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    # the mean of every bucket, the last point standing in for the bucket
+    # after the last one
+    lengths = np.diff(edges)
+    mean_x = np.append(np.add.reduceat(x[:-1], edges[:-1]) / lengths, x[-1])
+    mean_y = np.append(np.add.reduceat(y[:-1], edges[:-1]) / lengths, y[-1])
+
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        areas = np.abs(
+            (x[previous] - mean_x[bucket + 1]) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (mean_y[bucket + 1] - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        selected[bucket + 1] = previous
+    return selected
+
+
+def build_plot_data(times, columns, width=DEFAULT_WIDTH):
+    # {name: {"time": [...], "values": [...], "mean", "min", "max"}} with at
+    # most `width` points per series. times are formatted like the rest of
+    # the dashboard, the statistics cover every reading of the window
+    series = {}
+    for name, values in columns.items():
+        values = forward_fill(np.asarray(values, dtype=np.float64))
+        present = ~np.isnan(values)
+        series_times = times[present]
+        series_values = values[present]
+        kept = lttb(series_times, series_values, width)
+        series[name] = {
+            "time": [format_minute(int(t) // 60) for t in series_times[kept]],
+            "values": series_values[kept].tolist(),
+            "mean": float(series_values.mean()) if len(series_values) else None,
+            "min": float(series_values.min()) if len(series_values) else None,
+            "max": float(series_values.max()) if len(series_values) else None,
+        }
+    return {"points": int(len(times)), "width": width, "series": series}
+
+
+class PlotDataCache:
+    # serialized responses keyed by (classroom, data version, width); a new
+    # reading bumps the version, so entries never have to be invalidated
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            body = self.entries.get(key)
+            if body is not None:
+                self.entries.move_to_end(key)
+            return body
+
+    def put(self, key, plot_data):
+        body = json.dumps(plot_data)
+        with self.lock:
+            self.entries[key] = body
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return body
@@ -0,0 +1,149 @@
+import numpy as np
+
+SENSOR_COLUMNS = ("humidity", "temperature", "co2", "tvoc", "ambient_temp")
+
+
+# fixed-capacity columnar history of sensor readings. every row is written
+# twice (at i and i + capacity) so any window of the newest rows is one
+# contiguous slice and can be handed out as a view without copying.
+# missing readings are stored as NaN, timestamps as epoch seconds.
+#
+# running sums, sums of squares and counts over the retention window are
+# updated on every append and on every eviction, so means and variances of
+# the window are available without touching the rows.
+class SensorRingBuffer:
+    def __init__(self, capacity=4096, retention=3600, columns=SENSOR_COLUMNS):
+        self.capacity = capacity
+        self.retention = retention
+        self.columns = tuple(columns)
+        self.column_index = {name: i for i, name in enumerate(self.columns)}
+        self.times = np.zeros(2 * capacity, dtype=np.int64)
+        self.values = np.full((len(self.columns), 2 * capacity), np.nan)
+        self.total = 0
+        self.size = 0
+        self.version = 0
+        self.reset_aggregates()
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def start(self):
+        return (self.total - self.size) % self.capacity
+
+    def reset_aggregates(self):
+        # rows with a logical index >= aggregate_first are part of the sums
+        self.aggregate_first = self.total
+        self.sums = np.zeros(len(self.columns))
+        self.squares = np.zeros(len(self.columns))
+        self.counts = np.zeros(len(self.columns), dtype=np.int64)
+        self.time_sum = 0
+        self.time_count = 0
+
+    def add_to_aggregates(self, position):
+        row = self.values[:, position]
+        present = ~np.isnan(row)
+        self.sums[present] += row[present]
+        self.squares[present] += row[present] ** 2
+        self.counts += present
+        self.time_sum += int(self.times[position])
+        self.time_count += 1
+
+    def remove_from_aggregates(self, position):
+        row = self.values[:, position]
+        present = ~np.isnan(row)
+        self.sums[present] -= row[present]
+        self.squares[present] -= row[present] ** 2
+        self.counts -= present
+        self.time_sum -= int(self.times[position])
+        self.time_count -= 1
+        self.aggregate_first += 1
+
+    def append(self, timestamp, values):
+        if self.size == self.capacity:
+            evicted = self.total - self.capacity
+            if self.aggregate_first <= evicted:
+                self.remove_from_aggregates(evicted % self.capacity)
+
+        position = self.total % self.capacity
+        mirror = position + self.capacity
+
+        self.times[position] = self.times[mirror] = timestamp
+        self.values[:, position] = np.nan
+        for name, value in values.items():
+            row = self.column_index.get(name)
+            if row is not None and value is not None:
+                self.values[row, position] = value
+        self.values[:, mirror] = self.values[:, position]
+
+        self.total += 1
+        if self.size < self.capacity:
+            self.size += 1
+        self.add_to_aggregates(position)
+
+        if self.retention is not None:
+            cutoff = timestamp - self.retention
+            while (
+                self.aggregate_first < self.total - 1
+                and self.times[self.aggregate_first % self.capacity] < cutoff
+            ):
+                self.remove_from_aggregates(self.aggregate_first % self.capacity)
+
+        self.version += 1
+
+    def window(self, since=None):
+        # returns read-only views of the rows newer than `since`, by default
+        # the configured retention window counted back from the newest row
+        if self.size == 0:
+            return self.times[0:0], self.values[:, 0:0]
+
+        start = self.start
+        end = start + self.size
+        if since is None and self.retention is not None:
+            since = self.times[end - 1] - self.retention
+
+        begin = start
+        if since is not None:
+            begin += int(np.searchsorted(self.times[start:end], since, side="left"))
+
+        times = self.times[begin:end]
+        values = self.values[:, begin:end]
+        times.flags.writeable = False
+        values.flags.writeable = False
+        return times, values
+
+    def column(self, values, name):
+        return values[self.column_index[name]]
+
+    def aggregates(self):
+        # {name: (mean, variance, count)} for the columns with readings in
+        # the retention window, plus the mean timestamp under "time"
+        if self.time_count == 0:
+            return {}
+
+        aggregates = {}
+        for name, i in self.column_index.items():
+            count = int(self.counts[i])
+            if count > 0:
+                mean = self.sums[i] / count
+                variance = max(self.squares[i] / count - mean**2, 0.0)
+                aggregates[name] = (float(mean), float(variance), count)
+        aggregates["time"] = (self.time_sum / self.time_count, None, self.time_count)
+        return aggregates
+
+    def clear(self):
+        self.size = 0
+        self.reset_aggregates()
+        self.version += 1
+
+
+def format_times(times, timezone="Europe/Berlin", time_format="%Y-%m-%d %H:%M"):
+    # imported here so loading the web app does not pay for pandas
+    import pandas as pd
+
+    return (
+        pd.to_datetime(times, unit="s", utc=True)
+        .tz_convert(timezone)
+        .strftime(time_format)
+        .tolist()
+    )
@@ -0,0 +1,305 @@
+import json
+import logging
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from helpers.classroom_state import build_combined_data
+from helpers.event_broadcaster import to_json_value
+from helpers.future_data_waiter import FutureDataWaiter
+from helpers.ring_buffer import format_times
+
+# the ingest process owns MQTT, the database writer, the models and the
+# prediction thread and publishes snapshots of every classroom to redis.
+# web workers only read these snapshots and relay the published events to
+# their own dashboards, so they open no MQTT session and load no models.
+KEY_PREFIX = "smart_ventilation"
+EVENTS_CHANNEL = f"{KEY_PREFIX}:events"
+FLUSHED_CHANNEL = f"{KEY_PREFIX}:flushed"
+COMMANDS_CHANNEL = f"{KEY_PREFIX}:commands"
+METRICS_KEY = f"{KEY_PREFIX}:metrics:ingest"
+
+
+def snapshot_key(classroom):
+    return f"{KEY_PREFIX}:classroom:{classroom}"
+
+
+def window_key(classroom):
+    return f"{KEY_PREFIX}:window:{classroom}"
+
+
+def window_version_key(classroom):
+    return f"{KEY_PREFIX}:window_version:{classroom}"
+
+
+def token_key(token):
+    return f"{KEY_PREFIX}:future_data:{token}"
+
+
+def dumps(data):
+    return json.dumps(data, default=to_json_value)
+
+
+def listen_forever(redis_client, channels, handle, name, max_delay=30):
+    # subscribes to the channels and hands every message to handle. a lost
+    # connection is retried with exponential backoff and subscribed again,
+    # so the thread outlives redis restarts
+    delay = 1
+    while True:
+        pubsub = None
+        subscribed = time.monotonic()
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(*channels)
+            for message in pubsub.listen():
+                try:
+                    handle(message)
+                except Exception as e:
+                    logging.error("%s: error handling message %s", name, e)
+        except Exception as e:
+            # a subscription that held for a while starts the backoff over
+            if time.monotonic() - subscribed > max_delay:
+                delay = 1
+            logging.error("%s: redis subscription lost, retrying in %d s %s", name, delay, e)
+        finally:
+            if pubsub is not None:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+
+# read-only stand-in for ClassroomState built from a redis snapshot
+class ClassroomSnapshot:
+    def __init__(self, classroom, snapshot):
+        self.classroom = classroom
+        self.lock = threading.Lock()
+        self.latest_time = snapshot.get("time")
+        self.latest_values = snapshot.get("values", {})
+        self.latest_predictions = snapshot.get("predictions", {})
+        self.latest_features = snapshot.get("features", {})
+
+    def combined_data(self):
+        return build_combined_data(
+            self.latest_time, self.latest_values, self.latest_predictions
+        )
+
+
+class SharedStatePublisher:
+    def __init__(self, redis_client):
+        self.redis = redis_client
+
+    def publish_snapshot(self, state, event=None):
+        # latest values and predictions, sent with every reading. the window
+        # is published separately by the window publisher
+        with state.lock:
+            snapshot = {
+                "time": state.latest_time,
+                "values": dict(state.latest_values),
+                "predictions": dict(state.latest_predictions),
+                "features": dict(state.latest_features),
+            }
+
+        try:
+            # one round trip for the snapshot and the event
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.set(snapshot_key(state.classroom), dumps(snapshot))
+            if event is not None:
+                pipeline.publish(
+                    EVENTS_CHANNEL,
+                    dumps({"classroom": state.classroom, "event": event[0], "data": event[1]}),
+                )
+            pipeline.execute()
+        except Exception as e:
+            logging.error("publish_snapshot: error publishing state of %s %s", state.classroom, e)
+
+    def publish_window(self, state):
+        # only the copy is made under the lock, the window is serialized
+        # without blocking ingest
+        with state.lock:
+            sensor_buffer = state.sensor_buffer
+            version = sensor_buffer.version
+            times, values = sensor_buffer.window()
+            times = times.copy()
+            columns = {
+                name: sensor_buffer.column(values, name).copy()
+                for name in sensor_buffer.columns
+            }
+
+        window = {"time": times.tolist(), "version": version}
+        for name, column in columns.items():
+            window[name] = np.where(np.isnan(column), None, column).tolist()
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.set(window_key(state.classroom), dumps(window))
+            pipeline.set(window_version_key(state.classroom), version)
+            pipeline.execute()
+            return version
+        except Exception as e:
+            logging.error("publish_window: error publishing window of %s %s", state.classroom, e)
+            return None
+
+    def start_window_publisher(self, get_states, interval=5.0):
+        # publishes the window of every classroom whose buffer changed, at
+        # most once per interval
+        self.window_stop = threading.Event()
+        thread = threading.Thread(
+            target=self.run_window_publisher,
+            args=(get_states, interval),
+            name="shared-window",
+            daemon=True,
+        )
+        thread.start()
+        return thread
+
+    def run_window_publisher(self, get_states, interval):
+        published = {}
+        while not self.window_stop.wait(interval):
+            for state in get_states():
+                try:
+                    if published.get(state.classroom) == state.sensor_buffer.version:
+                        continue
+                    version = self.publish_window(state)
+                    if version is not None:
+                        published[state.classroom] = version
+                except Exception as e:
+                    logging.error("run_window_publisher: error publishing %s %s", state.classroom, e)
+
+    def stop(self):
+        window_stop = getattr(self, "window_stop", None)
+        if window_stop is not None:
+            window_stop.set()
+
+    def publish_flushed(self, classroom, timestamp):
+        try:
+            self.redis.publish(
+                FLUSHED_CHANNEL, dumps({"classroom": classroom, "timestamp": timestamp})
+            )
+        except Exception as e:
+            logging.error("publish_flushed: error publishing flush of %s %s", classroom, e)
+
+    def publish_metrics(self, families, ttl=60):
+        try:
+            self.redis.setex(METRICS_KEY, ttl, dumps(families))
+        except Exception as e:
+            logging.error("publish_metrics: error publishing metrics %s", e)
+
+    def listen_for_commands(self, handler):
+        thread = threading.Thread(
+            target=self.run_command_listener, args=(handler,), name="shared-commands", daemon=True
+        )
+        thread.start()
+        return thread
+
+    def run_command_listener(self, handler):
+        listen_forever(
+            self.redis,
+            [COMMANDS_CHANNEL],
+            lambda message: handler(json.loads(message["data"])),
+            "run_command_listener",
+        )
+
+
+class SharedStateReader:
+    def __init__(self, redis_client):
+        self.redis = redis_client
+
+    def load_classroom(self, classroom):
+        try:
+            raw_snapshot = self.redis.get(snapshot_key(classroom))
+            snapshot = json.loads(raw_snapshot) if raw_snapshot else {}
+        except Exception as e:
+            logging.error("load_classroom: error reading state of %s %s", classroom, e)
+            snapshot = {}
+        return ClassroomSnapshot(classroom, snapshot)
+
+    def load_window(self, classroom):
+        raw_window = self.redis.get(window_key(classroom))
+        if not raw_window:
+            return {}
+        window = json.loads(raw_window)
+        window.pop("version", None)
+        window["time"] = format_times(np.asarray(window["time"], dtype=np.int64))
+        return window
+
+    def load_window_version(self, classroom):
+        # lets the web workers answer from their plot cache without
+        # fetching the window itself
+        version = self.redis.get(window_version_key(classroom))
+        return int(version) if version is not None else None
+
+    def load_window_columns(self, classroom):
+        # (version, epoch seconds, {column: float array with NaN gaps})
+        raw_window = self.redis.get(window_key(classroom))
+        if not raw_window:
+            return None, np.zeros(0, dtype=np.int64), {}
+        window = json.loads(raw_window)
+        times = np.asarray(window.pop("time"), dtype=np.int64)
+        version = window.pop("version", None)
+        columns = {
+            name: np.asarray(values, dtype=np.float64) for name, values in window.items()
+        }
+        return version, times, columns
+
+    def load_metrics(self):
+        # families of the ingest process, empty if it stopped publishing
+        try:
+            raw_metrics = self.redis.get(METRICS_KEY)
+            return json.loads(raw_metrics) if raw_metrics else []
+        except Exception as e:
+            logging.error("load_metrics: error reading ingest metrics %s", e)
+            return []
+
+    def send_command(self, command, **arguments):
+        self.redis.publish(COMMANDS_CHANNEL, dumps(dict(arguments, command=command)))
+
+    def start_relay(self, event_broadcaster, future_data_waiter):
+        # one redis subscription per worker, fanned out locally to every
+        # dashboard of this worker
+        thread = threading.Thread(
+            target=self.run_relay,
+            args=(event_broadcaster, future_data_waiter),
+            name="shared-relay",
+            daemon=True,
+        )
+        thread.start()
+        return thread
+
+    def run_relay(self, event_broadcaster, future_data_waiter):
+        def relay(message):
+            channel = message["channel"]
+            if isinstance(channel, bytes):
+                channel = channel.decode()
+            data = json.loads(message["data"])
+            if channel == FLUSHED_CHANNEL:
+                future_data_waiter.notify(data["classroom"], data["timestamp"])
+            else:
+                event_broadcaster.publish(data["classroom"], data["event"], data["data"])
+
+        listen_forever(self.redis, [EVENTS_CHANNEL, FLUSHED_CHANNEL], relay, "run_relay")
+
+
+# pending /future_data tokens live in redis so that a poll can be answered by
+# any web worker, not only by the one that handed out the token
+class SharedFutureDataWaiter(FutureDataWaiter):
+    def __init__(self, redis_client, token_ttl=600, max_tokens=1000):
+        super().__init__(token_ttl=token_ttl, max_tokens=max_tokens)
+        self.redis = redis_client
+
+    def register(self, classroom, timestamp):
+        token = uuid.uuid4().hex
+        self.redis.setex(
+            token_key(token), self.token_ttl, dumps([classroom, timestamp])
+        )
+        return token
+
+    def lookup(self, token):
+        raw_entry = self.redis.get(token_key(token))
+        return tuple(json.loads(raw_entry)) if raw_entry else None
+
+    def release(self, token):
+        self.redis.delete(token_key(token))
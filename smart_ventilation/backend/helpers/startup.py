@@ -0,0 +1,48 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from helpers.metrics import PROCESS_STARTED, registry
+
+# durations of the startup phases of this process (config, database, redis,
+# mqtt, models, ...). every phase is initialized once, on first use or by
+# application.init_services, and timed here. report() logs the phases so
+# far, /metrics exposes them as smart_ventilation_startup_phase_seconds.
+
+
+class StartupTimer:
+    def __init__(self):
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def report(self):
+        with self.lock:
+            phases = dict(self.phases)
+        logging.info(
+            "startup: %s, %.1f ms since process start",
+            ", ".join(f"{name} {seconds * 1000:.1f} ms" for name, seconds in phases.items())
+            or "nothing initialized",
+            (time.time() - PROCESS_STARTED) * 1000,
+        )
+        return phases
+
+
+startup_timer = StartupTimer()
+
+registry.gauge(
+    "smart_ventilation_startup_phase_seconds",
+    "Time spent initializing each startup phase of the process.",
+    lambda: {(name,): seconds for name, seconds in dict(startup_timer.phases).items()},
+    label_names=("phase",),
+)
@@ -6,9 +6,52 @@ from imblearn.over_sampling import SMOTE
 from sklearn.pipeline import Pipeline
 from imblearn.pipeline import Pipeline
 from sklearn.impute import SimpleImputer
+import numpy as np
 import pandas as pd
 import joblib
+import hashlib
+import logging
 import os
+import sys
+
+# parsed and merged datasets are cached as parquet files named after the
+# sha256 of their source files, so retraining on unchanged inputs skips the
+# csv/excel parsing and the merge. bump CACHE_VERSION when the preparation
+# steps change.
+CACHE_DIRECTORY = "datasets/cache"
+CACHE_VERSION = "1"
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(source_paths):
+    digest = hashlib.sha256(CACHE_VERSION.encode())
+    for path in source_paths:
+        digest.update(file_digest(path).encode())
+    return digest.hexdigest()[:16]
+
+
+def cached_frame(name, source_paths, build, cache_directory=CACHE_DIRECTORY):
+    filename = f"{cache_directory}/{name}-{cache_key(source_paths)}.parquet"
+    if os.path.exists(filename):
+        logging.info("using cached %s from %s", name, filename)
+        return pd.read_parquet(filename)
+
+    df = build()
+    try:
+        os.makedirs(cache_directory, exist_ok=True)
+        temporary_filename = f"{filename}.{os.getpid()}.tmp"
+        df.to_parquet(temporary_filename, index=False)
+        os.replace(temporary_filename, filename)
+    except ImportError as e:
+        logging.warning("%s is not cached, parquet support is missing %s", name, e)
+    return df
 
 
 def read_data(
@@ -42,8 +85,11 @@ def prepare_data(
         df_temp_last_30_days,
         df_temp_older_30_days,
     ]:
-        df["time"] = pd.to_datetime(df["time"], format="ISO8601").dt.strftime(
-            "%d/%m/%Y %H:%M"
+        # wall-clock minute of the reading, as the former "%d/%m/%Y %H:%M" key
+        df["time"] = (
+            pd.to_datetime(df["time"], format="ISO8601")
+            .dt.tz_localize(None)
+            .dt.floor("min")
         )
         df.drop(columns=["dev_eui"], inplace=True)
 
@@ -61,13 +107,7 @@ def prepare_data(
 def prepare_outdoor_data(outdoor_temp_path):
     df_outdoor_temp = pd.read_csv(outdoor_temp_path, delimiter=";")
     df_outdoor_temp["MESS_DATUM"] = pd.to_datetime(
-        df_outdoor_temp["MESS_DATUM"], format="%Y%m%d%H"
-    )
-    df_outdoor_temp["MESS_DATUM"] = df_outdoor_temp["MESS_DATUM"].dt.strftime(
-        "%d/%m/%Y %H:%M"
-    )
-    df_outdoor_temp["MESS_DATUM"] = pd.to_datetime(
-        df_outdoor_temp["MESS_DATUM"], format="%d/%m/%Y %H:%M"
+        df_outdoor_temp["MESS_DATUM"].astype(str), format="%Y%m%d%H"
     )
     return df_outdoor_temp
 
@@ -88,11 +128,9 @@ def prepare_main_dataset(main_dataset_path):
     return data_set_ml
 
 
-def merge_data(merged_df, df_outdoor_temp, data_set_ml, output_path):
+def merge_data(merged_df, df_outdoor_temp, data_set_ml, output_path=None):
     merged_df.rename(columns={"time": "timestamp"}, inplace=True)
-    merged_df["timestamp"] = pd.to_datetime(
-        merged_df["timestamp"], format="%d/%m/%Y %H:%M"
-    )
+    merged_df["timestamp"] = pd.to_datetime(merged_df["timestamp"])
 
     start_date = merged_df["timestamp"].min()
     end_date = merged_df["timestamp"].max()
@@ -126,59 +164,87 @@ def merge_data(merged_df, df_outdoor_temp, data_set_ml, output_path):
         (merged_data["ambient_temp"] < 0) | (merged_data["ambient_temp"] > 31.2),
         "ambient_temp",
     ] = median_temp
-    merged_data.to_excel(output_path, index=False)
+    if output_path is not None:
+        merged_data.to_excel(output_path, index=False)
 
     return merged_data
 
 
-def feature_engineering(final_dataset):
+OPEN_WINDOW_THRESHOLDS = {
+    "co2": 1000,
+    "temperature_min": 15,
+    "temperature_max": 22,
+    "humidity_min": 35,
+    "humidity_max": 65,
+    "tvoc": 400,
+    "ambient_temp_min": 5,
+    "ambient_temp_max": 25,
+}
+DURATION_CO2_LIMIT = 1000
+DURATION_TEMP_LIMIT = 21
 
-    def add_temporal_features(final_dataset):
-        final_dataset["timestamp"] = pd.to_datetime(final_dataset["timestamp"])
-        final_dataset["hour"] = final_dataset["timestamp"].dt.hour
-        final_dataset["day_of_week"] = final_dataset["timestamp"].dt.dayofweek
-        final_dataset["month"] = final_dataset["timestamp"].dt.month
-        return final_dataset
-
-    def create_open_window(final_dataset):
-        adjusted_thresholds = {
-            "co2": 1000,
-            "temperature_min": 15,
-            "temperature_max": 22,
-            "humidity_min": 35,
-            "humidity_max": 65,
-            "tvoc": 400,
-            "ambient_temp_min": 5,
-            "ambient_temp_max": 25,
-        }
-
-        adjusted_conditions = (
-            (final_dataset["co2"] <= adjusted_thresholds["co2"])
-            & (final_dataset["temperature"] >= adjusted_thresholds["temperature_min"])
-            & (final_dataset["temperature"] <= adjusted_thresholds["temperature_max"])
-            & (final_dataset["humidity"] >= adjusted_thresholds["humidity_min"])
-            & (final_dataset["humidity"] <= adjusted_thresholds["humidity_max"])
-            & (final_dataset["tvoc"] <= adjusted_thresholds["tvoc"])
-            & (final_dataset["ambient_temp"] >= adjusted_thresholds["ambient_temp_min"])
-            & (final_dataset["ambient_temp"] <= adjusted_thresholds["ambient_temp_max"])
-        )
 
-        final_dataset["open_window"] = (~adjusted_conditions).astype(int)
-        return final_dataset
+# labels and targets are computed column-wise on numpy arrays, so their cost
+# grows with the number of rows only by vector operations
+
+
+def add_temporal_features(final_dataset):
+    timestamp = pd.to_datetime(final_dataset["timestamp"])
+    final_dataset["timestamp"] = timestamp
+    final_dataset["hour"] = timestamp.dt.hour
+    final_dataset["day_of_week"] = timestamp.dt.dayofweek
+    final_dataset["month"] = timestamp.dt.month
+    return final_dataset
+
+
+def create_open_window(final_dataset, thresholds=OPEN_WINDOW_THRESHOLDS):
+    co2 = final_dataset["co2"].to_numpy()
+    temperature = final_dataset["temperature"].to_numpy()
+    humidity = final_dataset["humidity"].to_numpy()
+    tvoc = final_dataset["tvoc"].to_numpy()
+    ambient_temp = final_dataset["ambient_temp"].to_numpy()
+
+    comfortable = (
+        (co2 <= thresholds["co2"])
+        & (temperature >= thresholds["temperature_min"])
+        & (temperature <= thresholds["temperature_max"])
+        & (humidity >= thresholds["humidity_min"])
+        & (humidity <= thresholds["humidity_max"])
+        & (tvoc <= thresholds["tvoc"])
+        & (ambient_temp >= thresholds["ambient_temp_min"])
+        & (ambient_temp <= thresholds["ambient_temp_max"])
+    )
+
+    final_dataset["open_window"] = (~comfortable).astype(int)
+    return final_dataset
+
+
+def calculate_duration_open(
+    final_dataset, co2_limit=DURATION_CO2_LIMIT, temp_limit=DURATION_TEMP_LIMIT
+):
+    co2 = final_dataset["co2"].to_numpy(dtype=np.float64)
+    temperature = final_dataset["temperature"].to_numpy(dtype=np.float64)
+    # the temperature term subtracts temp_limit * 1.05 like the original
+    # per-row rule, so it can be negative just above the limit
+    return np.where(co2 > co2_limit, (co2 - co2_limit) / 45, 0.0) + np.where(
+        temperature > temp_limit, temperature - temp_limit * 1.05, 0.0
+    )
+
 
+def feature_engineering(final_dataset):
     final_dataset = add_temporal_features(final_dataset)
     final_dataset = create_open_window(final_dataset)
 
     return final_dataset
 
 
-def random_forest_classifier_model(final_dataset):
+def random_forest_classifier_model(final_dataset, n_jobs=None):
     X = final_dataset[["co2", "temperature", "ambient_temp", "humidity", "tvoc"]]
     y = final_dataset["open_window"]
     X_train, X_test, y_train, y_test = train_test_split(
         X, y, test_size=0.2, random_state=42
     )
-    model = RandomForestClassifier(random_state=42)
+    model = RandomForestClassifier(random_state=42, n_jobs=n_jobs)
     model.fit(X_train, y_train)
 
     return model
@@ -218,26 +284,10 @@ def logistic_regression_model(final_dataset):
     return pipeline
 
 
-def random_forest_model(final_dataset):
+def random_forest_model(final_dataset, n_jobs=None):
     feature_order = ["co2", "temperature"]
-    final_dataset = final_dataset.dropna()
-    final_dataset["timestamp"] = pd.to_datetime(final_dataset["timestamp"])
-    final_dataset["hour"] = final_dataset["timestamp"].dt.hour
-    final_dataset["day_of_week"] = final_dataset["timestamp"].dt.dayofweek
-    final_dataset["month"] = final_dataset["timestamp"].dt.month
-
-    co2_limit = 1000
-    temp_limit = 21
-
-    def calculate_duration(row):
-        duration = 0
-        if row["co2"] > co2_limit:
-            duration += (row["co2"] - co2_limit) / 45
-        if row["temperature"] > temp_limit:
-            duration += row["temperature"] - temp_limit * 1.05
-        return duration
-
-    final_dataset["duration_open"] = final_dataset.apply(calculate_duration, axis=1)
+    final_dataset = add_temporal_features(final_dataset.dropna().copy())
+    final_dataset["duration_open"] = calculate_duration_open(final_dataset)
 
     X = final_dataset[feature_order]
     y = final_dataset["duration_open"].values
@@ -245,7 +295,10 @@ def random_forest_model(final_dataset):
     model = Pipeline(
         steps=[
             ("scaler", StandardScaler()),
-            ("regressor", RandomForestRegressor(n_estimators=20, random_state=20)),
+            (
+                "regressor",
+                RandomForestRegressor(n_estimators=20, random_state=20, n_jobs=n_jobs),
+            ),
         ]
     )
 
@@ -268,15 +321,104 @@ def save_models(models, directory):
         filename = f"{directory}/{name.replace(' ', '_')}.pkl"
         joblib.dump(model, filename)
 
-def main(
+def compile_logistic_regression(pipeline):
+    # folds the mean imputer and the standard scaler into the linear model:
+    # ((x - mean) / scale) @ w + b == x @ (w / scale) + (b - (mean / scale) @ w)
+    imputer = pipeline.named_steps["imputer"]
+    scaler = pipeline.named_steps["scaler"]
+    model = pipeline.named_steps["model"]
+
+    weights = model.coef_ / scaler.scale_
+    bias = model.intercept_ - (scaler.mean_ / scaler.scale_) @ model.coef_.T
+
+    return {
+        "kind": np.array("logistic_regression"),
+        "impute_values": imputer.statistics_,
+        "weights": weights.T,
+        "bias": bias,
+        "classes": model.classes_,
+        # kept for the online updates in helpers/online_learning.py
+        "scaler_mean": scaler.mean_,
+        "scaler_scale": scaler.scale_,
+    }
+
+
+def compile_random_forest(pipeline):
+    # flattens all trees into one set of node arrays. thresholds are mapped
+    # back through the scaler (x_scaled <= t  <=>  x <= t * scale + mean), so
+    # raw feature values can be compared directly.
+    scaler = pipeline.named_steps["scaler"]
+    forest = pipeline.named_steps["regressor"]
+
+    roots = []
+    features, thresholds, left, right, values = [], [], [], [], []
+    offset = 0
+    max_depth = 0
+    for estimator in forest.estimators_:
+        tree = estimator.tree_
+        is_leaf = tree.children_left == -1
+        feature = np.where(is_leaf, 0, tree.feature)
+
+        roots.append(offset)
+        features.append(feature)
+        thresholds.append(
+            np.where(
+                is_leaf,
+                0.0,
+                tree.threshold * scaler.scale_[feature] + scaler.mean_[feature],
+            )
+        )
+        # leaves point to themselves so every sample can take max_depth steps
+        node_ids = np.arange(tree.node_count) + offset
+        left.append(np.where(is_leaf, node_ids, tree.children_left + offset))
+        right.append(np.where(is_leaf, node_ids, tree.children_right + offset))
+        values.append(tree.value[:, 0, 0])
+        offset += tree.node_count
+        max_depth = max(max_depth, tree.max_depth)
+
+    return {
+        "kind": np.array("random_forest_regressor"),
+        "roots": np.array(roots, dtype=np.int64),
+        "feature": np.concatenate(features).astype(np.int64),
+        "threshold": np.concatenate(thresholds),
+        "children_left": np.concatenate(left).astype(np.int64),
+        "children_right": np.concatenate(right).astype(np.int64),
+        "value": np.concatenate(values),
+        "max_depth": np.array(max_depth),
+    }
+
+
+def export_compiled_models(models, directory):
+    compilers = {
+        "Logistic Regression": compile_logistic_regression,
+        "Random Forest": compile_random_forest,
+    }
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    for name, model in models.items():
+        compiler = compilers.get(name)
+        if compiler is None:
+            continue
+        filename = f"{directory}/{name.replace(' ', '_')}.npz"
+        np.savez(filename, **compiler(model))
+
+
+def export_saved_models(directory):
+    models = {}
+    for name in ["Logistic Regression", "Random Forest"]:
+        filename = f"{directory}/{name.replace(' ', '_')}.pkl"
+        if os.path.exists(filename):
+            models[name] = joblib.load(filename)
+    export_compiled_models(models, directory)
+
+
+def build_final_dataset(
     co2_last_30_days_path,
     co2_older_30_days_path,
     temp_last_30_days_path,
     temp_older_30_days_path,
     outdoor_temp_path,
     main_dataset_path,
-    final_dataset_path,
-    models_directory,
 ):
     (
         df_co2_last_30_days,
@@ -299,14 +441,37 @@ def main(
 
     df_outdoor_temp = prepare_outdoor_data(outdoor_temp_path)
 
-    data_set_ml = prepare_main_dataset(main_dataset_path)
+    data_set_ml = cached_frame(
+        "main_dataset",
+        [main_dataset_path],
+        lambda: prepare_main_dataset(main_dataset_path),
+    )
+
+    return merge_data(merged_df, df_outdoor_temp, data_set_ml)
 
-    merged_data = merge_data(
-        merged_df, df_outdoor_temp, data_set_ml, final_dataset_path
+
+def load_final_dataset(
+    co2_last_30_days_path,
+    co2_older_30_days_path,
+    temp_last_30_days_path,
+    temp_older_30_days_path,
+    outdoor_temp_path,
+    main_dataset_path,
+):
+    source_paths = [
+        co2_last_30_days_path,
+        co2_older_30_days_path,
+        temp_last_30_days_path,
+        temp_older_30_days_path,
+        outdoor_temp_path,
+        main_dataset_path,
+    ]
+    return cached_frame(
+        "final_dataset", source_paths, lambda: build_final_dataset(*source_paths)
     )
 
-    final_dataset = pd.read_excel(final_dataset_path)
 
+def train_models(final_dataset, n_jobs=None):
     final_dataset["timestamp"] = pd.to_datetime(final_dataset["timestamp"])
 
     final_dataset = final_dataset.ffill().dropna()
@@ -315,18 +480,52 @@ def main(
 
     log_model = logistic_regression_model(final_dataset)
 
-    rf_model = random_forest_model(final_dataset)
+    rf_model = random_forest_model(final_dataset, n_jobs=n_jobs)
 
-    models = {
+    return {
         "Logistic Regression": log_model,
         "Random Forest": rf_model,
     }
 
+
+def main(
+    co2_last_30_days_path,
+    co2_older_30_days_path,
+    temp_last_30_days_path,
+    temp_older_30_days_path,
+    outdoor_temp_path,
+    main_dataset_path,
+    final_dataset_path,
+    models_directory,
+):
+    final_dataset = load_final_dataset(
+        co2_last_30_days_path,
+        co2_older_30_days_path,
+        temp_last_30_days_path,
+        temp_older_30_days_path,
+        outdoor_temp_path,
+        main_dataset_path,
+    )
+
+    # the excel file is only a report for people, training never reads it
+    if final_dataset_path is not None:
+        final_dataset.to_excel(final_dataset_path, index=False)
+
+    models = train_models(final_dataset)
+
     save_models(models, models_directory)
 
+    export_compiled_models(models, models_directory)
+
 
 if __name__ == "__main__":
 
+    logging.basicConfig(level=logging.INFO)
+
+    if "--export-only" in sys.argv:
+        export_saved_models("ml-models")
+        sys.exit(0)
+
     main(
         co2_last_30_days_path="datasets/10c_co2_last_30_days.csv",
         co2_older_30_days_path="datasets/10c_co2_older_30_days.csv",
@@ -334,6 +533,8 @@ if __name__ == "__main__":
         temp_older_30_days_path="datasets/10c_temp_older_30_days.csv",
         outdoor_temp_path="datasets/outdoor_temperature.txt",
         main_dataset_path="datasets/dataset.xlsx",
-        final_dataset_path="datasets/final_dataset.xlsx",
+        final_dataset_path=(
+            "datasets/final_dataset.xlsx" if "--excel-report" in sys.argv else None
+        ),
         models_directory="ml-models",
     )
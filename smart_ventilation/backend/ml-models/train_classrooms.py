@@ -0,0 +1,171 @@
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from datetime import datetime
+
+import models
+
+# trains the models of every classroom in its own worker process. rooms run in
+# parallel, the forests of a room share the remaining cores through n_jobs.
+# every worker handles a single room (maxtasksperchild=1), so its peak RSS is
+# the peak of that room. artifacts go to <models_directory>/<classroom>/ and
+# are listed in <models_directory>/manifest.json, which keeps the entries of
+# rooms that were trained in earlier runs.
+#
+# run from smart_ventilation/backend:
+#   python ml-models/train_classrooms.py [classroom ...] [--processes N]
+
+DATASETS_DIRECTORY = "datasets"
+MODELS_DIRECTORY = "ml-models/classrooms"
+MANIFEST_NAME = "manifest.json"
+
+
+def discover_classrooms(directory=DATASETS_DIRECTORY):
+    suffix = "_co2_last_30_days.csv"
+    return sorted(
+        os.path.basename(path)[: -len(suffix)]
+        for path in glob.glob(f"{directory}/*{suffix}")
+    )
+
+
+def classroom_sources(classroom, directory=DATASETS_DIRECTORY):
+    # the tvoc export and the outdoor temperature are shared unless a room
+    # has its own <classroom>_dataset.xlsx
+    main_dataset_path = f"{directory}/{classroom}_dataset.xlsx"
+    if not os.path.exists(main_dataset_path):
+        main_dataset_path = f"{directory}/dataset.xlsx"
+    return {
+        "co2_last_30_days_path": f"{directory}/{classroom}_co2_last_30_days.csv",
+        "co2_older_30_days_path": f"{directory}/{classroom}_co2_older_30_days.csv",
+        "temp_last_30_days_path": f"{directory}/{classroom}_temp_last_30_days.csv",
+        "temp_older_30_days_path": f"{directory}/{classroom}_temp_older_30_days.csv",
+        "outdoor_temp_path": f"{directory}/outdoor_temperature.txt",
+        "main_dataset_path": main_dataset_path,
+    }
+
+
+def peak_memory_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def load_manifest(manifest_path):
+    try:
+        with open(manifest_path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logging.error("load_manifest: error reading %s %s", manifest_path, e)
+        return {}
+
+
+def train_classroom(task):
+    classroom, sources, models_directory, n_jobs = task
+    started = time.perf_counter()
+    report = {"classroom": classroom, "sources": sources}
+    try:
+        final_dataset = models.load_final_dataset(**sources)
+        report["rows"] = len(final_dataset)
+
+        trained_models = models.train_models(final_dataset, n_jobs=n_jobs)
+        directory = f"{models_directory}/{classroom}"
+        models.save_models(trained_models, directory)
+        models.export_compiled_models(trained_models, directory)
+
+        report["directory"] = directory
+        report["artifacts"] = sorted(os.listdir(directory))
+        report["source_key"] = models.cache_key(list(sources.values()))
+    except Exception as e:
+        logging.error("train_classroom: training %s failed %s", classroom, e)
+        report["error"] = str(e)
+
+    report["wall_seconds"] = round(time.perf_counter() - started, 3)
+    report["peak_memory_mb"] = round(peak_memory_mb(), 1)
+    report["trained_at"] = datetime.now().isoformat(timespec="seconds")
+    return report
+
+
+def train_classrooms(classrooms, models_directory=MODELS_DIRECTORY, processes=None):
+    cpu_count = os.cpu_count() or 1
+    processes = min(processes or cpu_count, len(classrooms)) or 1
+    n_jobs = max(1, cpu_count // processes)
+    tasks = [
+        (classroom, classroom_sources(classroom), models_directory, n_jobs)
+        for classroom in classrooms
+    ]
+    logging.info(
+        "training %d classrooms with %d processes and n_jobs=%d",
+        len(tasks),
+        processes,
+        n_jobs,
+    )
+
+    started = time.perf_counter()
+    reports = {}
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(processes, maxtasksperchild=1) as pool:
+        for report in pool.imap_unordered(train_classroom, tasks):
+            reports[report["classroom"]] = report
+            logging.info(
+                "%s: %s in %.1fs, peak memory %.0f MB",
+                report["classroom"],
+                "failed" if "error" in report else "trained",
+                report["wall_seconds"],
+                report["peak_memory_mb"],
+            )
+
+    manifest_path = f"{models_directory}/{MANIFEST_NAME}"
+    # rooms that were not part of this run keep their entries, a room that
+    # failed keeps its last successful entry and only records the error
+    entries = load_manifest(manifest_path).get("classrooms", {})
+    failed = []
+    for classroom, report in reports.items():
+        previous = entries.get(classroom)
+        if "error" in report:
+            failed.append(classroom)
+            if previous is not None and "error" not in previous:
+                previous["last_error"] = report["error"]
+                previous["last_failed_at"] = report["trained_at"]
+                continue
+        entries[classroom] = report
+
+    manifest = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "wall_seconds": round(time.perf_counter() - started, 3),
+        "processes": processes,
+        "n_jobs": n_jobs,
+        "trained": sorted(reports),
+        "failed": sorted(failed),
+        "classrooms": {classroom: entries[classroom] for classroom in sorted(entries)},
+    }
+    os.makedirs(models_directory, exist_ok=True)
+    with open(manifest_path + ".tmp", "w") as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    logging.info("manifest written to %s after %.1fs", manifest_path, manifest["wall_seconds"])
+    return manifest
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    arguments = sys.argv[1:]
+    processes = None
+    if "--processes" in arguments:
+        index = arguments.index("--processes")
+        processes = int(arguments[index + 1])
+        del arguments[index : index + 2]
+
+    classrooms = arguments or discover_classrooms()
+    if not classrooms:
+        sys.exit(f"no *_co2_last_30_days.csv exports found in {DATASETS_DIRECTORY}")
+
+    manifest = train_classrooms(classrooms, processes=processes)
+    sys.exit(1 if manifest["failed"] else 0)
@@ -1,91 +1,320 @@
-from database.database_connection import load_config, connect_to_database
-import time
+from database.database_connection import create_connection_pool
+from database.sensor_writer import SensorDataWriter
+from database.rollups import ensure_rollup_schema, fetch_window_average
+from database.prediction_history import (
+    PredictionWriter,
+    ensure_prediction_schema,
+    prediction_row,
+)
+from database.feedback_outbox import (
+    FeedbackSender,
+    enqueue_feedback,
+    ensure_outbox_schema,
+)
+from helpers.future_data_waiter import FutureDataWaiter
+from helpers.ring_buffer import format_times
+from helpers.classroom_state import ClassroomState
+from helpers.compiled_models import ModelUnavailableError, load_models
+from helpers.event_broadcaster import EventBroadcaster
+from helpers.online_learning import OnlineModelUpdater
+from helpers.metrics import registry
+from helpers.plot_data import PlotDataCache, build_plot_data
+from helpers.message_decoding import BERLIN_TZ, decode_uplink, format_minute
+from helpers.shared_state import (
+    SharedFutureDataWaiter,
+    SharedStatePublisher,
+    SharedStateReader,
+)
+from helpers.device_registry import (
+    load_device_registry,
+    parse_device_eui,
+    subscription_topics,
+)
+import numpy as np
 import psycopg2
-import pytz
 import paho.mqtt.client as mqtt
-import pandas as pd
+import redis
+import os
+import signal
 import threading
+import time
 import uuid
-import copy
-import joblib
-import json
 import logging
-import datetime as dt
 from datetime import datetime, timedelta
-from config.api_config_loader import load_api_config
-
-config_file_path = "config/api_config.yaml"
-db_config_path = "config/db_config.yaml"
-db = load_config(db_config_path)
-
-api_config = load_api_config(config_file_path)
-
-CLOUD_SERVICE_URL = api_config["CLOUD_SERVICE_URL"]
-USERNAME = api_config["USERNAME"]
-PASSWORD = api_config["PASSWORD"]
+from config.api_config_loader import get_api_config, get_db_config
+from helpers.startup import startup_timer
+
+# nothing here reads a config file or opens a connection at import time: the
+# configs are loaded by the first MQTTClient, and the client is created by the
+# first call to get_mqtt_client
+
+# "standalone" runs everything in one process. in production one "ingest"
+# process (python mqtt_client.py) owns MQTT, the writer and the models and
+# the gunicorn workers run as "web", reading the shared state from redis
+PROCESS_ROLE = os.environ.get("SMART_VENTILATION_ROLE", "standalone")
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379")
+
+FEATURE_ORDER = [
+    "co2",
+    "temperature",
+    "humidity",
+    "tvoc",
+    "ambient_temp",
+    "hour",
+    "day_of_week",
+    "month",
+]
+RESTRICTED_FEATURE_ORDER = ["co2", "temperature"]
+
+MESSAGES = registry.counter(
+    "smart_ventilation_mqtt_messages", "MQTT uplinks received per topic.", ("topic",)
+)
+ON_MESSAGE_SECONDS = registry.histogram(
+    "smart_ventilation_on_message_seconds", "Duration of MQTTClient.on_message."
+)
+CONNECTS = registry.counter(
+    "smart_ventilation_mqtt_connects",
+    "Connections to the MQTT broker, reconnects included, per result code.",
+    ("result",),
+)
+QUERY_SECONDS = registry.histogram(
+    "smart_ventilation_db_query_seconds", "Duration of rollup window queries.", ("query",)
+)
+PREDICTION_TICK_SECONDS = registry.histogram(
+    "smart_ventilation_prediction_tick_seconds",
+    "Duration of one prediction tick over all classrooms.",
+)
+PREDICTED_CLASSROOMS = registry.counter(
+    "smart_ventilation_predictions", "Classroom predictions made by the prediction thread."
+)
 
 
 class MQTTClient:
-    def __init__(self):
+    def __init__(self, role=None, api_config=None, db_config=None):
+        self.role = role or PROCESS_ROLE
+        self.api_config = api_config = api_config if api_config is not None else get_api_config()
+        db = db_config if db_config is not None else get_db_config()
+        self.default_classroom = str(api_config.get("DEFAULT_CLASSROOM", "10c"))
+        self.sensor_buffer_capacity = api_config.get("SENSOR_BUFFER_CAPACITY", 4096)
+        self.sensor_retention = api_config.get("SENSOR_RETENTION_MINUTES", 60) * 60
+        registry.enabled = bool(api_config.get("METRICS_ENABLED", True))
+        self.shared_state = None
+        self.feedback_sender = None
+        self.prediction_writer = None
+        self.online_updater = None
         try:
+            self.event_broadcaster = EventBroadcaster()
+            self.devices = load_device_registry(api_config)
+            self.classrooms = {}
+            self.classrooms_lock = threading.Lock()
+            self.plot_cache = PlotDataCache()
+            with startup_timer.phase("database"):
+                self.pool = create_connection_pool(db)
+            write_config = db or {}
+            self.rollup_window = write_config.get("ROLLUP_WINDOW_MINUTES", 15)
+
+            if self.role == "web":
+                with startup_timer.phase("redis"):
+                    redis_client = redis.from_url(REDIS_URL)
+                    self.shared_state = SharedStateReader(redis_client)
+                    self.future_data_waiter = SharedFutureDataWaiter(redis_client)
+                    self.shared_state.start_relay(
+                        self.event_broadcaster, self.future_data_waiter
+                    )
+                return
+
             self.client = mqtt.Client()
             self.client.tls_set()
-            self.client.username_pw_set(username=USERNAME, password=PASSWORD)
+            self.client.username_pw_set(
+                username=api_config["USERNAME"], password=api_config["PASSWORD"]
+            )
             self.client.on_connect = self.on_connect
             self.client.on_message = self.on_message
             self.parameters = {}
-            self.latest_predictions = {}
-            self.combined_data = {}
-            self.data_points = []
+            for device in self.devices.values():
+                for classroom in device["classrooms"]:
+                    self.get_classroom(classroom)
+            self.get_classroom(self.default_classroom)
             self.thread_alive = True
-            self.predictions_cleared = False
 
             self.prediction_event = threading.Event()
             self.prediction_thread = threading.Thread(
                 target=self.run_periodic_predictions
             )
             self.prediction_thread.start()
-            self.data_lock = threading.Lock()
-            self.first_time = None
-            self.first_topic_data = []
-            self.latest_time = None
             self.last_clear_date = datetime.now().replace(
                 minute=0, second=0, microsecond=0
             )
-            self.conn = connect_to_database(db)
+            if self.role == "ingest":
+                with startup_timer.phase("redis"):
+                    self.shared_state = SharedStatePublisher(redis.from_url(REDIS_URL))
+                    self.shared_state.listen_for_commands(self.handle_command)
+                    # the windows for /plots, at most every few seconds
+                    self.shared_state.start_window_publisher(
+                        lambda: list(self.classrooms.values()),
+                        interval=api_config.get("WINDOW_PUBLISH_INTERVAL", 5.0),
+                    )
+            with startup_timer.phase("database"):
+                self.pool.when_ready(ensure_rollup_schema)
+            self.future_data_waiter = FutureDataWaiter()
+            self.sensor_writer = SensorDataWriter(
+                self.pool,
+                batch_size=write_config.get("WRITE_BATCH_SIZE", 500),
+                max_delay=write_config.get("WRITE_MAX_DELAY", 5.0),
+                max_queue_size=write_config.get("WRITE_QUEUE_SIZE", 10000),
+                on_flush=self.on_rows_flushed,
+            )
+            self.sensor_writer.start()
+
+            with startup_timer.phase("database"):
+                self.pool.when_ready(ensure_outbox_schema)
+            self.feedback_sender = FeedbackSender(
+                self.pool,
+                api_config["API_BASE_URL"],
+                {
+                    "X-Api-Key": api_config["POST_API_KEY"],
+                    "Content-Type": api_config["CONTENT_TYPE"],
+                },
+                batch_size=api_config.get("FEEDBACK_BATCH_SIZE", 50),
+                interval=api_config.get("FEEDBACK_SEND_INTERVAL", 5.0),
+                timeout=api_config.get("FEEDBACK_TIMEOUT", 10.0),
+                max_attempts=api_config.get("FEEDBACK_MAX_ATTEMPTS", 20),
+            )
+            self.feedback_sender.start()
+
+            with startup_timer.phase("database"):
+                self.pool.when_ready(ensure_prediction_schema)
+            self.prediction_writer = PredictionWriter(
+                self.pool,
+                batch_size=write_config.get("PREDICTION_BATCH_SIZE", 100),
+                max_delay=write_config.get("PREDICTION_MAX_DELAY", 30.0),
+            )
+            self.prediction_writer.start()
 
-            logistic_regression_model = joblib.load("ml-models/Logistic_Regression.pkl")
-            random_forest_model = joblib.load("ml-models/Random_Forest.pkl")
+            self.register_gauges()
 
-            self.models = {
-                "Logistic Regression": logistic_regression_model,
-                "Random Forest": random_forest_model,
-            }
+            self.models = load_models(
+                "ml-models", ["Logistic Regression", "Random Forest"]
+            )
+
+            # folds new feedback into the logistic regression, 0 disables it
+            online_update_interval = api_config.get("ONLINE_UPDATE_INTERVAL", 3600)
+            if online_update_interval:
+                self.online_updater = OnlineModelUpdater(
+                    self.pool,
+                    self.models,
+                    "Logistic Regression",
+                    "ml-models/Logistic_Regression.npz",
+                    FEATURE_ORDER,
+                    interval=online_update_interval,
+                    min_batch_size=api_config.get("ONLINE_MIN_BATCH_SIZE", 20),
+                    keep_versions=api_config.get("ONLINE_KEEP_VERSIONS", 10),
+                )
+                self.online_updater.start()
         except Exception as e:
             logging.error("initialization error %s", e)
 
-    def on_connect(self, client, userdata, flags, rc):
-        try:
-            logging.info("connected with result code %s", str(rc))
+    def register_gauges(self):
+        registry.gauge(
+            "smart_ventilation_sensor_buffer_rows",
+            "Readings held in the in-memory window of each classroom.",
+            lambda: {
+                (classroom,): state.sensor_buffer.size
+                for classroom, state in list(self.classrooms.items())
+            },
+            label_names=("classroom",),
+        )
+        registry.gauge(
+            "smart_ventilation_sensor_writer_rows",
+            "Sensor writer counters: queued, flushed, dropped and pending rows.",
+            lambda: {
+                (name,): value for name, value in self.sensor_writer.get_counters().items()
+            },
+            label_names=("state",),
+        )
+        registry.gauge(
+            "smart_ventilation_feedback_outbox_rows",
+            "Feedback rows delivered to or rejected by API_BASE_URL since start.",
+            lambda: {
+                (name,): value
+                for name, value in self.feedback_sender.get_counters().items()
+            }
+            if self.feedback_sender is not None
+            else {},
+            label_names=("state",),
+        )
+
+        registry.gauge(
+            "smart_ventilation_prediction_writer_rows",
+            "Prediction writer counters: queued, flushed, dropped and pending rows.",
+            lambda: {
+                (name,): value
+                for name, value in self.prediction_writer.get_counters().items()
+            }
+            if self.prediction_writer is not None
+            else {},
+            label_names=("state",),
+        )
+
+    def model_versions(self):
+        # the online updated model counts its versions, the exported models
+        # are version 0
+        versions = {name: 0 for name in self.models}
+        if self.online_updater is not None and self.online_updater.learner is not None:
+            versions[self.online_updater.model_name] = self.online_updater.learner.version
+        return versions
+
+    def collect_metrics(self):
+        families = registry.collect(role=self.role, pid=os.getpid())
+        if self.role == "web":
+            families.extend(self.shared_state.load_metrics())
+        return families
+
+    def publish_metrics(self):
+        if self.shared_state is not None and self.role == "ingest":
+            self.shared_state.publish_metrics(self.collect_metrics())
+
+    def get_classroom(self, classroom=None):
+        classroom = self.default_classroom if classroom is None else str(classroom)
+        if self.role == "web":
+            return self.shared_state.load_classroom(classroom)
+        state = self.classrooms.get(classroom)
+        if state is None:
+            with self.classrooms_lock:
+                state = self.classrooms.get(classroom)
+                if state is None:
+                    state = ClassroomState(
+                        classroom,
+                        capacity=self.sensor_buffer_capacity,
+                        retention=self.sensor_retention,
+                    )
+                    self.classrooms[classroom] = state
+        return state
 
-            # for datetime and TVOC
-            self.client.subscribe(
-                "application/f4994b60-cc34-4cb5-b77c-dc9a5f9de541/device/24e124707c481005/event/up"
-            )
+    # the web views show the default classroom
+    @property
+    def latest_predictions(self):
+        return self.get_classroom().latest_predictions
 
-            # for Co2, temperature, etc.
-            # self.client.subscribe(
-            #    "application/f4994b60-cc34-4cb5-b77c-dc9a5f9de541/device/0004a30b00fca900/event/up"
-            #)
+    @property
+    def latest_features(self):
+        return self.get_classroom().latest_features
 
-            self.client.subscribe(
-                "application/f4994b60-cc34-4cb5-b77c-dc9a5f9de541/device/0004a30b01045883/event/up"
-            )
+    @property
+    def latest_time(self):
+        return self.get_classroom().latest_time
 
-            # for outdoor temperature
-            self.client.subscribe(
-                "application/f4994b60-cc34-4cb5-b77c-dc9a5f9de541/device/647fda000000aa92/event/up"
-            )
+    @property
+    def combined_data(self):
+        return self.get_classroom().combined_data()
+
+    def on_connect(self, client, userdata, flags, rc):
+        try:
+            logging.info("connected with result code %s", str(rc))
+            CONNECTS.labels(str(rc)).inc()
+
+            for topic in subscription_topics(self.devices):
+                self.client.subscribe(topic)
 
             if not self.prediction_thread.is_alive():
                 logging.warning("the thread was stopped and is being restarted")
@@ -94,138 +323,78 @@ class MQTTClient:
             logging.error("on_connect: error establishing connection %s", e)
 
     def on_message(self, client, userdata, msg):
+        started = time.perf_counter() if registry.enabled else None
         try:
-            topic = msg.topic
-            payload = json.loads(msg.payload.decode())
-
-            def adjust_and_format_time(raw_time):
-                try:
-                    utc_time = dt.datetime.strptime(raw_time, "%Y-%m-%dT%H:%M:%S.%f%z")
-                    berlin_tz = pytz.timezone("Europe/Berlin")
-                    berlin_time = utc_time.astimezone(berlin_tz)
-                    return berlin_time.strftime("%Y-%m-%d %H:%M")
-                except Exception as e:
-                    logging.error(f"error while adjusting datetime: %s", e)
-                    return None
-
-            if topic.endswith("0004a30b01045883/event/up"):
-                formatted_time = adjust_and_format_time(payload["time"])
-                self.latest_time = formatted_time
-                logging.info(f"self.latest_time: {self.latest_time}")
-                humidity_values = payload["object"].get("humidity")
-                temperature_values = payload["object"].get("temperature")
-                co2_values = payload["object"].get("co2")
-
-                if (
-                    formatted_time is not None
-                    and formatted_time not in self.combined_data.get("time", [])
-                ):
-                    self.combined_data.setdefault("time", []).append(formatted_time)
-
-                if humidity_values is not None:
-                    self.combined_data.setdefault("humidity", []).append(
-                        round(humidity_values, 2)
-                    )
-
-                if temperature_values is not None:
-                    self.combined_data.setdefault("temperature", []).append(
-                        round(temperature_values, 2)
-                    )
-
-                if co2_values is not None:
-                    self.combined_data.setdefault("co2", []).append(
-                        round(co2_values, 2)
-                    )
-
-                data_point = {
-                    "time": formatted_time,
-                    "humidity": (
-                        round(humidity_values, 2)
-                        if humidity_values is not None
-                        else None
-                    ),
-                    "temperature": (
-                        round(temperature_values, 2)
-                        if temperature_values is not None
-                        else None
-                    ),
-                    "co2": round(co2_values, 2) if co2_values is not None else None,
-                }
-
-                if all(value is not None for value in data_point.values()):
-                    logging.info(f"data_point is {data_point}")
-                    self.store_first_topic_data(data_point)
+            device = self.devices.get(parse_device_eui(msg.topic))
+            if device is None:
+                return
+
+            timestamp, values = decode_uplink(msg.payload, device["metrics"])
+            if timestamp is None:
+                logging.error("on_message: unexpected time format in message of %s", msg.topic)
+                formatted_time = None
+                timestamp = time.time()
             else:
-                formatted_time = self.latest_time
+                formatted_time = format_minute(int(timestamp // 60))
 
-            if topic.endswith("24e124707c481005/event/up"):
-                tvoc_value = payload["object"].get("tvoc")
+            for classroom in device["classrooms"]:
+                state = self.get_classroom(classroom)
 
-                if tvoc_value is not None:
-                    self.combined_data.setdefault("tvoc", []).append(
-                        round(tvoc_value, 2)
-                    )
+                if device["store"]:
+                    state.latest_time = formatted_time
+                    logging.debug("latest_time of %s: %s", classroom, formatted_time)
 
-            elif topic.endswith("647fda000000aa92/event/up"):
-                ambient_temp_value = payload["object"].get("ambient_temp")
+                    if formatted_time is not None and len(values) == len(device["metrics"]):
+                        data_point = dict(values, time=formatted_time)
+                        logging.debug("data_point is %s", data_point)
+                        self.store_first_topic_data(data_point, classroom)
 
-                if ambient_temp_value is not None:
-                    self.combined_data.setdefault("ambient_temp", []).append(
-                        round(ambient_temp_value, 2)
-                    )
-
-            if (
-                formatted_time is not None
-                and formatted_time not in self.combined_data.get("time", [])
-            ):
-                self.combined_data.setdefault("time", []).append(formatted_time)
-
-            required_keys = {"humidity", "temperature", "co2", "tvoc", "ambient_temp"}
-
-            if any(len(self.combined_data.get(key, [])) > 0 for key in required_keys):
-                self.collect_data(self.combined_data)
+                if values:
+                    self.collect_data(state, int(timestamp), values)
 
             self.check_and_clear_data()
 
         except Exception as e:
             logging.error(f"on_message: error receiving message %s", e)
 
-    def collect_data(self, combined_data):
-        with self.data_lock:
-            try:
-                required_keys = [
-                    "time",
-                    "humidity",
-                    "temperature",
-                    "co2",
-                    "tvoc",
-                    "ambient_temp",
-                ]
-                max_length = max(
-                    len(combined_data[key])
-                    for key in combined_data
-                    if isinstance(combined_data[key], list)
-                )
-
-                for i in range(max_length):
-                    data = {}
-                    for key in combined_data:
-                        if isinstance(combined_data[key], list) and i < len(
-                            combined_data[key]
-                        ):
-                            data[key] = combined_data[key][i]
-                        else:
-                            data[key] = None
-                    for key in required_keys:
-                        if key not in data:
-                            data[key] = None
-                    self.data_points.append(data)
-                    logging.debug(f"collected data points %s", data)
+        finally:
+            if started is not None:
+                MESSAGES.labels(msg.topic).inc()
+                ON_MESSAGE_SECONDS.observe(time.perf_counter() - started)
 
-            except Exception as e:
-                logging.error("collect_data: unexpected error during data collection %s", e)
-                logging.error("collect_data: contents of combined data %s", combined_data)
-                logging.error("collect_data: content of data points %s", self.data_points)
+    def collect_data(self, state, timestamp, values):
+        try:
+            state.collect(timestamp, values)
+            logging.debug(f"collected data point %s %s", timestamp, values)
+            self.publish_event(
+                state,
+                "reading",
+                {
+                    "classroom": state.classroom,
+                    "time": state.latest_time,
+                    "values": values,
+                },
+            )
+        except Exception as e:
+            logging.error("collect_data: unexpected error during data collection %s", e)
+            logging.error("collect_data: contents of values %s", values)
+
+    def publish_event(self, state, event, data):
+        self.event_broadcaster.publish(state.classroom, event, data)
+        if self.shared_state is not None:
+            self.shared_state.publish_snapshot(state, event=(event, data))
+
+    def on_rows_flushed(self, classroom, timestamp):
+        self.future_data_waiter.notify(classroom, timestamp)
+        if self.shared_state is not None:
+            self.shared_state.publish_flushed(classroom, timestamp)
+
+    def handle_command(self, command):
+        # commands sent by the web workers to the ingest process
+        if command.get("command") == "clear_predictions":
+            self.clear_predictions(command.get("classroom"))
+        else:
+            logging.warning("handle_command: unknown command %s", command)
 
     def run_periodic_predictions(self):
         while self.thread_alive:
@@ -235,84 +404,131 @@ class MQTTClient:
                 break
             self.prediction_event.clear()
 
-            if self.predictions_cleared:
-                logging.info("predictions were cleared")
+            started = time.perf_counter()
+            self.predict_classrooms(list(self.classrooms.values()))
+            if registry.enabled:
+                PREDICTION_TICK_SECONDS.observe(time.perf_counter() - started)
+
+    def build_features(self, state):
+        with state.lock:
+            aggregates = state.sensor_buffer.aggregates()
+
+        if not aggregates:
+            return None
+
+        avg_time = datetime.fromtimestamp(
+            aggregates["time"][0], BERLIN_TZ
+        )
+        logging.debug(
+            "timestamp parsing and average calculation successful"
+        )
+
+        avg_data = {
+            name: aggregate[0]
+            for name, aggregate in aggregates.items()
+            if name != "time"
+        }
+        avg_data["avg_time"] = avg_time.timestamp()
+        logging.debug("average date prepared successfully")
+
+        avg_data["hour"] = avg_time.hour
+        avg_data["day_of_week"] = avg_time.weekday()
+        avg_data["month"] = avg_time.month
+
+        features = {}
+        for feature in FEATURE_ORDER:
+            if feature in avg_data:
+                features[feature] = avg_data[feature]
+            elif feature == "tvoc":
+                features[feature] = 100
+            elif feature == "ambient_temp":
+                features[feature] = avg_data.get("temperature", 0)
+            else:
+                features[feature] = 0
+        logging.info("features of %s prepared for predictions %s", state.classroom, features)
+        return features
+
+    def predict_classrooms(self, states):
+        # all classrooms are scored with one predict call per model
+        batch = []
+        for state in states:
+            if state.predictions_cleared:
+                logging.info("predictions were cleared for %s", state.classroom)
                 continue
 
-            if self.data_points:
-                try:
-                    data_points_copy = copy.deepcopy(self.data_points)
-                    df = pd.DataFrame(data_points_copy)
-                    df["parsed_time"] = pd.to_datetime(df["time"])
-                    avg_time = df["parsed_time"].mean()
-                    logging.info(
-                        "timestamp parsing and average calculation successful"
-                    )
-
-                    avg_data = df.mean(numeric_only=True).to_dict()
-                    avg_data["avg_time"] = avg_time.timestamp()
-                    logging.info("average date prepared successfully")
-
-                    avg_data["hour"] = avg_time.hour
-                    avg_data["day_of_week"] = avg_time.dayofweek
-                    avg_data["month"] = avg_time.month
-
-                    features_df = pd.DataFrame([avg_data])
-                    logging.info("features prepared for predictions %s", features_df)
-
-                    correct_order = [
-                        "co2",
-                        "temperature",
-                        "humidity",
-                        "tvoc",
-                        "ambient_temp",
-                        "hour",
-                        "day_of_week",
-                        "month",
-                    ]
-                    for feature in correct_order:
-                        if feature not in features_df.columns:
-                            if feature == "tvoc":
-                                features_df[feature] = 100
-                            elif feature == "ambient_temp":
-                                features_df[feature] = avg_data.get("temperature", 0)
-                            else:
-                                features_df[feature] = 0
-
-                    features_df = features_df[correct_order]
-                    features_array = features_df.to_numpy()
-
-                    restricted_model_order = ["co2", "temperature"]
-                    restricted_features_df = features_df[restricted_model_order]
-                    restricted_features_array = restricted_features_df.to_numpy()
-
-                    predictions = {}
-                    for name, model in self.models.items():
-                        if "Random Forest" in name:
-                            predictions[name] = model.predict(
-                                restricted_features_array
-                            )[0]
-                        else:
-                            predictions[name] = model.predict(features_array)[0]
-
-                    self.combined_data["predictions"] = predictions
-                    self.latest_predictions = predictions
-                    self.latest_predictions["prediction_time"] = (
-                        datetime.now().strftime("%H:%M")
-                    )
-                    logging.info(f"latest predictions are: {self.latest_predictions}")
-                    self.predictions_cleared = False
+            try:
+                features = self.build_features(state)
+            except Exception as e:
+                logging.error("run_periodic_predictions: error preparing features of %s %s", state.classroom, e)
+                continue
 
-                    prediction_id = str(uuid.uuid4())
-                    self.latest_predictions["id"] = prediction_id
+            if features is None:
+                logging.info("run_periodic_predictions: no data collected in the last 10 minutes for %s", state.classroom)
+                continue
+            batch.append((state, features))
 
-                    self.latest_features_df = features_df
+        if not batch:
+            return
 
-                    data_points_copy.clear()
+        try:
+            features_array = np.array(
+                [[features[feature] for feature in FEATURE_ORDER] for _, features in batch]
+            )
+            restricted_features_array = features_array[
+                :, [FEATURE_ORDER.index(feature) for feature in RESTRICTED_FEATURE_ORDER]
+            ]
+
+            # every model is scored on its own, so one that cannot be loaded
+            # or fails does not cost the predictions of the others
+            batch_predictions = {}
+            for name, model in list(self.models.items()):
+                try:
+                    if "Random Forest" in name:
+                        batch_predictions[name] = model.predict(restricted_features_array)
+                    else:
+                        batch_predictions[name] = model.predict(features_array)
+                except ModelUnavailableError as e:
+                    # already logged when the load failed
+                    logging.debug("run_periodic_predictions: skipping %s %s", name, e)
                 except Exception as e:
-                    logging.error("run_periodic_predictions: error while processing predictions %s", e)
-            else:
-                logging.info("run_periodic_predictions: no data collected in the last 10 minutes")
+                    logging.error("run_periodic_predictions: error predicting with %s %s", name, e)
+
+            if not batch_predictions:
+                logging.error("run_periodic_predictions: no model produced predictions")
+                return
+
+            PREDICTED_CLASSROOMS.inc(len(batch))
+            now = datetime.now()
+            prediction_time = now.strftime("%H:%M")
+            model_versions = {
+                name: version
+                for name, version in self.model_versions().items()
+                if name in batch_predictions
+            }
+            for i, (state, features) in enumerate(batch):
+                predictions = {
+                    name: values[i] for name, values in batch_predictions.items()
+                }
+                predictions["prediction_time"] = prediction_time
+                predictions["id"] = str(uuid.uuid4())
+                logging.info(f"latest predictions for {state.classroom} are: {predictions}")
+                if self.prediction_writer is not None:
+                    self.prediction_writer.enqueue(
+                        prediction_row(state.classroom, now, predictions, features, model_versions)
+                    )
+
+                with state.lock:
+                    state.latest_predictions = predictions
+                    state.latest_features = features
+                    state.predictions_cleared = False
+
+                self.publish_event(
+                    state,
+                    "prediction",
+                    {"classroom": state.classroom, "predictions": predictions},
+                )
+        except Exception as e:
+            logging.error("run_periodic_predictions: error while processing predictions %s", e)
 
     def check_and_clear_data(self):
         try:
@@ -327,11 +543,14 @@ class MQTTClient:
 
     def clear_data(self, clear_time):
         try:
-            with self.data_lock:
-                self.data_points.clear()
-                self.combined_data.clear()
-                self.latest_predictions.clear()
-                logging.info(f"data cleared at {clear_time.strftime('%H:%M Uhr')}")
+            # sensor history is bounded by the ring buffer retention,
+            # only the predictions expire every hour
+            for state in list(self.classrooms.values()):
+                with state.lock:
+                    state.latest_predictions.clear()
+                if self.shared_state is not None:
+                    self.shared_state.publish_snapshot(state)
+            logging.info(f"data cleared at {clear_time.strftime('%H:%M Uhr')}")
         except Exception as e:
             logging.error("clear_data: error while deleting the data %s", e)
 
@@ -347,73 +566,106 @@ class MQTTClient:
         except Exception as e:
             logging.error("restart_thread: error restarting thread %s", e)
 
-    def get_latest_sensor_data(self):
+    def get_latest_sensor_data(self, classroom=None):
         try:
-            return self.data_points.copy()
+            if self.role == "web":
+                return self.shared_state.load_window(
+                    self.default_classroom if classroom is None else str(classroom)
+                )
+
+            state = self.get_classroom(classroom)
+            with state.lock:
+                sensor_buffer = state.sensor_buffer
+                times, values = sensor_buffer.window()
+                sensor_data = {
+                    name: np.where(np.isnan(column), None, column).tolist()
+                    for name in sensor_buffer.columns
+                    for column in [sensor_buffer.column(values, name)]
+                }
+                times = times.copy()
+            sensor_data["time"] = format_times(times)
+            return sensor_data
         except Exception as e:
             logging.error("get_latest_sensor_data: error fetching the latest sensor data %s", e)
-            return []
-
-    def store_first_topic_data(self, data_point):
-        with self.data_lock:
-            cursor = self.conn.cursor()
-            try:
-                if all(
-                    data_point.get(key) is not None
-                    for key in ["time", "co2", "temperature", "humidity"]
-                ):
-                    query = """
-                        INSERT INTO classroom_environmental_data
-                        (timestamp, co2_values, temperature, 
-                        humidity, classroom_number)
-                        VALUES (%s, %s, %s, %s, %s)
-                    """
-                    cursor.execute(
-                        query,
-                        (
-                            data_point["time"],
-                            data_point["co2"],
-                            data_point["temperature"],
-                            data_point["humidity"],
-                            "10c",
-                        ),
-                    )
-                self.conn.commit()
-                data_point = None
+            return {}
+
+    def get_plot_data(self, classroom=None, width=None):
+        # (version, json body) of the downsampled /plots series. the body is
+        # cached per data version, so repeated requests between two readings
+        # only cost a version lookup
+        classroom = self.default_classroom if classroom is None else str(classroom)
+        if self.role == "web":
+            version = self.shared_state.load_window_version(classroom)
+        else:
+            state = self.get_classroom(classroom)
+            version = state.sensor_buffer.version
+
+        body = self.plot_cache.get((classroom, version, width))
+        if body is not None:
+            return version, body
+
+        if self.role == "web":
+            version, times, columns = self.shared_state.load_window_columns(classroom)
+        else:
+            with state.lock:
+                sensor_buffer = state.sensor_buffer
+                version = sensor_buffer.version
+                times, values = sensor_buffer.window()
+                times = times.copy()
+                columns = {
+                    name: sensor_buffer.column(values, name).copy()
+                    for name in sensor_buffer.columns
+                }
 
-            except psycopg2.OperationalError as e:
-                logging.error(
-                    f"store_first_topic_data: error saving data to db %s", e)
-                self.reconnect_db()
-                self.store_first_topic_data(data_point)
+        plot_data = build_plot_data(times, columns, width)
+        plot_data["classroom"] = classroom
+        plot_data["version"] = version
+        return version, self.plot_cache.put((classroom, version, width), plot_data)
 
-            except Exception as e:
-                logging.error(
-                    f"store_first_topic_data: error saving data to db %s", e)
-                self.conn.rollback()
-            finally:
-                cursor.close()
+    def store_first_topic_data(self, data_point, classroom=None):
+        classroom = self.default_classroom if classroom is None else str(classroom)
+        try:
+            if all(
+                data_point.get(key) is not None
+                for key in ["time", "co2", "temperature", "humidity"]
+            ):
+                self.sensor_writer.enqueue(
+                    (
+                        data_point["time"],
+                        data_point["co2"],
+                        data_point["temperature"],
+                        data_point["humidity"],
+                        classroom,
+                    )
+                )
+        except Exception as e:
+            logging.error("store_first_topic_data: error queueing data point %s", e)
 
     def store_feedback_data(self, feedback_data):
-        with self.data_lock:
-            cursor = self.conn.cursor()
-            try:
-                if all(
-                    feedback_data.get(key) is not None
-                    for key in [
-                        "temperature",
-                        "humidity",
-                        "co2",
-                        "timestamp",
-                        "outdoor_temperature",
-                        "accurate_prediction",
-                    ]
-                ):
-                    query = """
-                        INSERT INTO feedback_tabelle
-                        (temperature, humidity, co2, timestamp, outdoor_temperature, accurate_prediction)
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                    """
+        # stores the feedback and queues it for API_BASE_URL in one
+        # transaction; the feedback sender delivers it in the background
+        try:
+            if not all(
+                feedback_data.get(key) is not None
+                for key in [
+                    "temperature",
+                    "humidity",
+                    "co2",
+                    "timestamp",
+                    "outdoor_temperature",
+                    "accurate_prediction",
+                ]
+            ):
+                logging.error("not all required data is present in feedback_data")
+                return False
+
+            query = """
+                INSERT INTO feedback_tabelle
+                (temperature, humidity, co2, timestamp, outdoor_temperature, accurate_prediction)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            """
+            with self.pool.connection() as conn:
+                with conn.cursor() as cursor:
                     cursor.execute(
                         query,
                         (
@@ -425,135 +677,102 @@ class MQTTClient:
                             feedback_data["accurate_prediction"],
                         ),
                     )
-                    self.conn.commit()
-                else:
-                    logging.error(
-                        "not all required data is present in feedback_data"
-                    )
-                    self.conn.rollback()
+                    enqueue_feedback(cursor, feedback_data)
+                conn.commit()
 
-            except psycopg2.OperationalError as e:
-                logging.error("store_feedback_data: db connection error while saving feedback data %s", e)
-                self.reconnect_db()
+            if self.feedback_sender is not None:
+                self.feedback_sender.wake()
+            return True
 
-            except Exception as e:
-                logging.error("store_feedback_data: error while saving feedback_data %s", e)
-                self.conn.rollback()
-            finally:
-                cursor.close()
-
-    def fetch_data(self, timestamp):
-        with self.data_lock:
-            cursor = self.conn.cursor()
-            try:
-                logging.info("fetching data for timestamp %s", timestamp)
-                query = """ 
-                SELECT 
-                    AVG(co2_values) as co2_values, 
-                    AVG(temperature) as temperature, 
-                    AVG(humidity) as humidity
-                FROM classroom_environmental_data 
-                WHERE 
-                    timestamp > CAST(%s AS timestamp); 
-                """
-                cursor.execute(query, (timestamp,))
-                result = cursor.fetchone()
-                logging.info("Query successful, data fetched !")
-
-                if result:
-                    averaged_data = {
-                        "timestamp": timestamp,
-                        "co2_values": result[0],
-                        "temperature": result[1],
-                        "humidity": result[2],
-                    }
-                else:
-                    averaged_data = {}
-                return averaged_data
-
-            except psycopg2.OperationalError as e:
-                logging.error("fetch_data: db connection error %s", e)
-                self.reconnect_db()
-                return {}
-
-            except Exception as e:
-                logging.error("fetch_data: error while fetching data %s", e)
-                return {}
-            finally:
-                cursor.close()
-
-    def fetch_future_data(self, timestamp):
-        with self.data_lock:
-            cursor = self.conn.cursor()
-            try:
-                query = """
-                    SELECT 
-                        AVG(co2_values) as co2_values,
-                        AVG(temperature) as temperature,
-                        AVG(humidity) as humidity
-                    FROM classroom_environmental_data
-                    WHERE timestamp > CAST(%s AS timestamp);
-                """
-
-                max_attempts = 30
-                wait_time = 10
-                result = None
-
-                for attempt in range(max_attempts):
-                    logging.info(
-                        f"Query attempt {attempt + 1} at {timestamp}"
-                    )
-                    cursor.execute(query, (timestamp,))
-                    result = cursor.fetchone()
-
-                    if result and any(val is not None for val in result):
-                        break
+        except psycopg2.OperationalError as e:
+            logging.error("store_feedback_data: db connection error while saving feedback data %s", e)
 
-                    logging.info(f"no data, please wait for {wait_time} seconds")
-                    time.sleep(wait_time)
+        except Exception as e:
+            logging.error("store_feedback_data: error while saving feedback_data %s", e)
+        return False
+
+    def fetch_window(self, classroom, timestamp, query):
+        started = time.perf_counter() if registry.enabled else None
+        with self.pool.connection() as conn:
+            result = fetch_window_average(conn, classroom, timestamp, self.rollup_window)
+        if started is not None:
+            QUERY_SECONDS.labels(query).observe(time.perf_counter() - started)
+        return result
+
+    def fetch_data(self, timestamp, classroom=None):
+        classroom = self.default_classroom if classroom is None else str(classroom)
+        try:
+            logging.debug("fetching data for timestamp %s", timestamp)
+            result = self.fetch_window(classroom, timestamp, "current")
+            logging.debug("Query successful, data fetched !")
 
-                if result:
-                    averaged_data = {
-                        "timestamp": timestamp,
-                        "co2_values": (
-                            float(result[0]) if result[0] is not None else None
-                        ),
-                        "temperature": (
-                            float(result[1]) if result[1] is not None else None
-                        ),
-                        "humidity": float(result[2]) if result[2] is not None else None,
-                    }
-                else:
-                    averaged_data = {
-                        "timestamp": timestamp,
-                        "co2_values": None,
-                        "temperature": None,
-                        "humidity": None,
-                    }
-
-                return averaged_data
-
-            except psycopg2.OperationalError as e:
-                logging.error("fetch_future_data: database connection error while fetching future data:",e)
-                self.reconnect_db()
-                return {
+            if result:
+                averaged_data = {
                     "timestamp": timestamp,
-                    "co2_values": None,
-                    "temperature": None,
-                    "humidity": None,
+                    "co2_values": result[0],
+                    "temperature": result[1],
+                    "humidity": result[2],
                 }
+            else:
+                averaged_data = {}
+            return averaged_data
 
-            except Exception as e:
-                logging.error(
-                    "fetch_future_data: Error fetching future data from the database: %s", e)
-                return {
+        except psycopg2.OperationalError as e:
+            logging.error("fetch_data: db connection error %s", e)
+            return {}
+
+        except Exception as e:
+            logging.error("fetch_data: error while fetching data %s", e)
+            return {}
+
+    def fetch_future_data(self, timestamp, wait=0, classroom=None):
+        # never sleeps or holds a lock: returns the averages if rows newer
+        # than timestamp exist, otherwise waits at most `wait` seconds for the
+        # sensor writer to report such a row and then checks once more
+        classroom = self.default_classroom if classroom is None else str(classroom)
+        empty_data = {
+            "timestamp": timestamp,
+            "co2_values": None,
+            "temperature": None,
+            "humidity": None,
+        }
+        try:
+            waiter = self.future_data_waiter
+            if waiter.has_data_after(classroom, timestamp) is False:
+                if wait <= 0 or not waiter.wait_for(classroom, timestamp, wait):
+                    logging.info("no data newer than %s yet", timestamp)
+                    return empty_data
+
+            result = self.fetch_window(classroom, timestamp, "future")
+
+            if (not result or all(val is None for val in result)) and wait > 0:
+                if waiter.wait_for(classroom, timestamp, wait):
+                    result = self.fetch_window(classroom, timestamp, "future")
+
+            if result:
+                averaged_data = {
                     "timestamp": timestamp,
-                    "co2_values": None,
-                    "temperature": None,
-                    "humidity": None,
+                    "co2_values": (
+                        float(result[0]) if result[0] is not None else None
+                    ),
+                    "temperature": (
+                        float(result[1]) if result[1] is not None else None
+                    ),
+                    "humidity": float(result[2]) if result[2] is not None else None,
                 }
-            finally:
-                cursor.close()
+            else:
+                averaged_data = empty_data
+
+            return averaged_data
+
+        except psycopg2.OperationalError as e:
+            logging.error("fetch_future_data: database connection error while fetching future data: %s", e)
+            return empty_data
+
+        except Exception as e:
+            logging.error(
+                "fetch_future_data: Error fetching future data from the database: %s", e)
+            return empty_data
 
     def save_analysis_data(
         self,
@@ -565,8 +784,6 @@ class MQTTClient:
         decision,
     ):
         try:
-            cursor = self.conn.cursor()
-
             query = """
             INSERT INTO environmental_data_analysis (
                     timestamp, current_co2, future_co2, co2_change, 
@@ -593,18 +810,16 @@ class MQTTClient:
                 decision,
             )
 
-            cursor.execute(query, values)
-
-            self.conn.commit()
-
-            cursor.close()
+            with self.pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, values)
+                conn.commit()
 
             logging.info("data saved successfully to the environmental_data_analysis table")
 
         except psycopg2.OperationalError as e:
             logging.error(
                 "save_analysis_data: Database connection error while saving data: %s", e)
-            self.reconnect_db()
 
         except Exception as e:
             logging.error(
@@ -612,39 +827,85 @@ class MQTTClient:
 
     def stop(self):
         try:
+            if self.role == "web":
+                self.pool.closeall()
+                return
+
             self.thread_alive = False
+            self.prediction_event.set()
+            if self.shared_state is not None:
+                self.shared_state.stop()
             self.client.loop_stop()
             self.client.disconnect()
+            self.sensor_writer.stop()
+            self.feedback_sender.stop()
+            if self.prediction_writer is not None:
+                self.prediction_writer.stop()
+            if self.online_updater is not None:
+                self.online_updater.stop()
+            if self.pool is not None:
+                self.pool.closeall()
         except Exception as e:
             logging.error("stop: Error stopping the client: %s", e)
 
-    def reconnect_db(self):
-        try:
-            logging.info("attempting to re-establish the database connection...")
-            self.conn.close()
-            self.conn = connect_to_database(db)
-            logging.info("database connection re-established successfully.")
-        except Exception as e:
-            logging.error(
-                "reconnect_db: Error re-establishing the database connection: %s", e)
-
-    def clear_predictions(self):
+    def clear_predictions(self, classroom=None):
         try:
             logging.info("clearing the old predictions!")
-            with self.data_lock:
-                self.latest_predictions.clear()
-                if "predictions" in self.combined_data:
-                    del self.combined_data["predictions"]
-
-                self.predictions_cleared = True
+            if self.role == "web":
+                # the predictions belong to the ingest process
+                self.shared_state.send_command("clear_predictions", classroom=classroom)
+                return
+
+            state = self.get_classroom(classroom)
+            with state.lock:
+                state.latest_predictions.clear()
+                state.predictions_cleared = True
+            if self.shared_state is not None:
+                self.shared_state.publish_snapshot(state)
 
             logging.info("predictions cleared successfully.")
         except Exception as e:
             logging.error("Error in clear_predictions %s", e)
 
     def initialize(self):
+        if self.role == "web":
+            return
         try:
-            self.client.connect(CLOUD_SERVICE_URL, 8883)
-            self.client.loop_start()
+            with startup_timer.phase("mqtt"):
+                self.client.connect(self.api_config["CLOUD_SERVICE_URL"], 8883)
+                self.client.loop_start()
         except Exception as e:
             logging.error("initialize: Initialization error: %s", e)
+
+
+mqtt_client = None
+mqtt_client_lock = threading.Lock()
+
+
+def get_mqtt_client():
+    # one client per process, shared by the views and helpers.mqtt_data
+    global mqtt_client
+    if mqtt_client is None:
+        with mqtt_client_lock:
+            if mqtt_client is None:
+                client = MQTTClient()
+                client.initialize()
+                mqtt_client = client
+                startup_timer.report()
+    return mqtt_client
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    mqtt_client = MQTTClient(role="ingest")
+    mqtt_client.initialize()
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopped.set())
+    # the web workers serve the metrics of this process from redis
+    metrics_publish_interval = mqtt_client.api_config.get("METRICS_PUBLISH_INTERVAL", 15)
+    startup_timer.report()
+    while not stopped.wait(metrics_publish_interval if registry.enabled else None):
+        mqtt_client.publish_metrics()
+    mqtt_client.stop()